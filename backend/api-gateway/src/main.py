@@ -4,6 +4,9 @@ import httpx
 import asyncio
 from typing import List # <-- ДОБАВЛЕНО: для поддержки списка файлов
 
+from timing import TimingRecorder, install_timing, httpx_event_hooks
+from metrics import install_metrics, instrument_httpx
+
 app = FastAPI(title="API Gateway")
 
 # CORS
@@ -15,6 +18,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Замеры запросов и X-Request-ID (у шлюза нет БД: замеры только в /api/timings)
+timings = TimingRecorder("api-gateway")
+install_timing(app, timings)
+# Метрики Prometheus: /metrics
+install_metrics(app)
+
 # Health check
 @app.get("/health")
 async def health_check():
@@ -24,6 +33,10 @@ async def health_check():
 async def api_health_check():
     return {"status": "healthy", "service": "api-gateway"}
 
+@app.get("/api/timings")
+async def timing_stats():
+    return timings.snapshot()
+
 # Root endpoint
 @app.get("/")
 async def root():
@@ -62,7 +75,7 @@ async def upload_photos(files: List[UploadFile] = File(...)): # <-- ИСПРАВ
         
         # Forward to upload service
         # Используем таймаут 60 секунд, так как загрузка может быть долгой
-        async with httpx.AsyncClient(timeout=60.0) as client: 
+        async with httpx.AsyncClient(timeout=60.0, event_hooks=instrument_httpx(httpx_event_hooks(timings))) as client: 
             
             response = await client.post(
                 target_url,
@@ -96,7 +109,7 @@ async def upload_photos(files: List[UploadFile] = File(...)): # <-- ИСПРАВ
 @app.get("/test-upload-service")
 async def test_upload_service():
     try:
-        async with httpx.AsyncClient() as client:
+        async with httpx.AsyncClient(event_hooks=instrument_httpx(httpx_event_hooks(timings))) as client:
             response = await client.get("http://photo-upload-service:8003/health")
             return {
                 "upload_service_status": response.status_code,
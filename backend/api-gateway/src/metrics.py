@@ -0,0 +1,349 @@
+import math
+import time
+from bisect import bisect_left
+from typing import Dict, Iterator, List, Optional, Sequence, Tuple
+
+# Метрики в текстовом формате Prometheus (одинаковый модуль во всех сервисах).
+#
+# Запись метрики на горячем пути — одна операция над заранее созданным «дочерним»
+# объектом с фиксированными значениями меток (metric.labels(...) один раз при старте
+# или при первом обращении), без блокировок. Инкременты из разных потоков
+# (asyncio.to_thread) под GIL могут изредка теряться — для мониторинга это допустимо.
+# Формирование текста (и суммирование корзин гистограмм) выполняется только при
+# запросе /metrics.
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Корзины по умолчанию, секунды: от миллисекунд до минуты (ML и внешние сервисы)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+BATCH_SIZE_BUCKETS = (1, 2, 4, 8, 16, 32, 64, 128)
+
+Sample = Tuple[str, Tuple[Tuple[str, str], ...], float]
+
+
+def _escape(value: str, quote: bool = True) -> str:
+    value = value.replace("\\", "\\\\").replace("\n", "\\n")
+    return value.replace('"', '\\"') if quote else value
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if value == int(value) and abs(value) < 2 ** 53:
+        return str(int(value))
+    return repr(float(value))
+
+
+class _Metric:
+    type_name = "untyped"
+
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = (), registry: Optional["Registry"] = None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        (registry or REGISTRY).register(self)
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def labels(self, *values: str):
+        """Дочерняя метрика с фиксированными значениями меток (сохраняйте ее, а не вызывайте labels на каждом событии)."""
+        key = tuple(str(value) for value in values)
+        child = self._children.get(key)
+        if child is None:
+            if len(key) != len(self.labelnames):
+                raise ValueError(f"{self.name}: ожидаются метки {self.labelnames}, получено {key}")
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def samples(self) -> Iterator[Sample]:
+        for key, child in list(self._children.items()):
+            labels = tuple(zip(self.labelnames, key))
+            for suffix, extra, value in child.samples():
+                yield self.name + suffix, labels + extra, value
+
+
+class _CounterChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def samples(self) -> Iterator[Sample]:
+        yield "", (), self.value
+
+
+class Counter(_Metric):
+    """Монотонный счетчик (имя с суффиксом _total)."""
+
+    type_name = "counter"
+
+    def _new_child(self):
+        return _CounterChild()
+
+
+class _GaugeChild:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, amount: float = 1.0) -> None:
+        self.value += amount
+
+    def dec(self, amount: float = 1.0) -> None:
+        self.value -= amount
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> Iterator[Sample]:
+        yield "", (), self.value
+
+
+class Gauge(_Metric):
+    type_name = "gauge"
+
+    def _new_child(self):
+        return _GaugeChild()
+
+
+class _HistogramChild:
+    __slots__ = ("upper_bounds", "counts", "sum")
+
+    def __init__(self, upper_bounds: Tuple[float, ...]):
+        self.upper_bounds = upper_bounds
+        # Счетчики корзин не накопительные: накопление — только при чтении
+        self.counts = [0] * len(upper_bounds)
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect_left(self.upper_bounds, value)] += 1
+        self.sum += value
+
+    def samples(self) -> Iterator[Sample]:
+        total = 0
+        for bound, count in zip(self.upper_bounds, self.counts):
+            total += count
+            yield "_bucket", (("le", _format_value(bound)),), total
+        yield "_sum", (), self.sum
+        yield "_count", (), total
+
+
+class Histogram(_Metric):
+    type_name = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+        registry: Optional["Registry"] = None
+    ):
+        self.upper_bounds = tuple(sorted(float(bucket) for bucket in buckets if bucket != math.inf)) + (math.inf,)
+        super().__init__(name, documentation, labelnames, registry)
+
+    def _new_child(self):
+        return _HistogramChild(self.upper_bounds)
+
+
+class HitRatio(_Metric):
+    """Доля попаданий кэша по счетчику обращений (вычисляется при чтении /metrics)."""
+
+    type_name = "gauge"
+
+    def __init__(self, name: str, documentation: str, requests: Counter, registry: Optional["Registry"] = None):
+        self.requests = requests
+        super().__init__(name, documentation, ("cache",), registry)
+
+    def samples(self) -> Iterator[Sample]:
+        totals: Dict[str, List[float]] = {}
+        for (cache, result), child in list(self.requests._children.items()):
+            hits_and_total = totals.setdefault(cache, [0.0, 0.0])
+            hits_and_total[1] += child.value
+            if result == "hit":
+                hits_and_total[0] += child.value
+        for cache, (hits, total) in sorted(totals.items()):
+            if total:
+                yield self.name, (("cache", cache),), hits / total
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric: _Metric) -> None:
+        if any(existing.name == metric.name for existing in self._metrics):
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics.append(metric)
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.append(f"# HELP {metric.name} {_escape(metric.documentation, quote=False)}")
+            lines.append(f"# TYPE {metric.name} {metric.type_name}")
+            for name, labels, value in metric.samples():
+                if labels:
+                    label_text = ",".join(f'{key}="{_escape(label)}"' for key, label in labels)
+                    lines.append(f"{name}{{{label_text}}} {_format_value(value)}")
+                else:
+                    lines.append(f"{name} {_format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+# --- Общие метрики сервисов ---
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds", "Длительность обработки HTTP-запросов по маршрутам",
+    ("method", "route", "status")
+)
+HTTP_REQUESTS_IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP-запросы, обрабатываемые в данный момент")
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds", "Длительность запросов к внешним сервисам и провайдерам",
+    ("upstream", "outcome")
+)
+UPSTREAM_REQUESTS_IN_FLIGHT = Gauge(
+    "upstream_requests_in_flight", "Запросы к внешним сервисам, ожидающие ответа", ("upstream",)
+)
+INFERENCE_BATCH_SIZE = Histogram(
+    "inference_batch_size", "Размер пакета одного вызова ML-модели", ("model",), buckets=BATCH_SIZE_BUCKETS
+)
+INFERENCE_IN_FLIGHT = Gauge("inference_in_flight", "Вызовы ML-модели, выполняющиеся в данный момент", ("model",))
+CACHE_REQUESTS = Counter("cache_requests_total", "Обращения к кэшам: result=hit|miss", ("cache", "result"))
+CACHE_HIT_RATIO = HitRatio("cache_hit_ratio", "Доля попаданий кэша с момента запуска сервиса", CACHE_REQUESTS)
+
+
+class CacheMetrics:
+    """Заранее связанные счетчики попаданий/промахов одного кэша."""
+
+    __slots__ = ("hits", "misses")
+
+    def __init__(self, cache: str):
+        self.hits = CACHE_REQUESTS.labels(cache, "hit")
+        self.misses = CACHE_REQUESTS.labels(cache, "miss")
+
+    def record(self, hit: bool) -> None:
+        (self.hits if hit else self.misses).inc()
+
+
+class UpstreamMetrics:
+    """Заранее связанные метрики одного внешнего сервиса: задержка по исходу и запросы в полете."""
+
+    __slots__ = ("success", "error", "in_flight")
+
+    def __init__(self, upstream: str):
+        self.success = UPSTREAM_REQUEST_DURATION.labels(upstream, "success")
+        self.error = UPSTREAM_REQUEST_DURATION.labels(upstream, "error")
+        self.in_flight = UPSTREAM_REQUESTS_IN_FLIGHT.labels(upstream)
+
+    def observe(self, seconds: float, ok: bool) -> None:
+        (self.success if ok else self.error).observe(seconds)
+
+
+class InferenceMetrics:
+    """Заранее связанные метрики одной ML-модели: размер пакета и вызовы в полете."""
+
+    __slots__ = ("batch_size", "in_flight")
+
+    def __init__(self, model: str):
+        self.batch_size = INFERENCE_BATCH_SIZE.labels(model)
+        self.in_flight = INFERENCE_IN_FLIGHT.labels(model)
+
+    def observe_batch(self, size: int) -> None:
+        self.batch_size.observe(size)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: длительность запросов по шаблону маршрута (/api/datasets/{dataset_id}/stats)
+    и число запросов в обработке. Запросы вне маршрутов учитываются как route="<unmatched>".
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self._in_flight = HTTP_REQUESTS_IN_FLIGHT.labels()
+        self._routes: Dict[object, str] = {}
+        self._children: Dict[Tuple[str, object, int], _HistogramChild] = {}
+
+    def _route_path(self, scope, endpoint) -> str:
+        path = self._routes.get(endpoint)
+        if path is None:
+            # Таблица строится при первом запросе (маршруты добавляются после middleware)
+            routes = scope["app"].router.routes
+            self._routes = {getattr(route, "endpoint", None) or getattr(route, "app", None): route.path for route in routes}
+            path = self._routes.get(endpoint, "<unmatched>")
+        return path
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        self._in_flight.inc()
+        started_at = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            duration = time.perf_counter() - started_at
+            self._in_flight.dec()
+            # Маршрут известен только после маршрутизации (scope["endpoint"])
+            key = (scope["method"], scope.get("endpoint"), status_code)
+            child = self._children.get(key)
+            if child is None:
+                route = self._route_path(scope, key[1]) if key[1] is not None else "<unmatched>"
+                child = self._children.setdefault(key, HTTP_REQUEST_DURATION.labels(key[0], route, key[2]))
+            child.observe(duration)
+
+
+def install_metrics(app) -> None:
+    """Подключает MetricsMiddleware и эндпоинт /metrics."""
+    from fastapi.responses import Response
+
+    app.add_middleware(MetricsMiddleware)
+
+    async def metrics() -> Response:
+        # Заголовок задается целиком: media_type="text/..." starlette дополняет своим charset
+        return Response(REGISTRY.render(), headers={"Content-Type": CONTENT_TYPE})
+
+    app.add_api_route("/metrics", metrics, methods=["GET"], include_in_schema=False)
+
+
+def instrument_httpx(event_hooks: Optional[Dict[str, list]] = None) -> Dict[str, list]:
+    """
+    Хуки для httpx.AsyncClient(event_hooks=...): задержка вызовов других сервисов
+    (upstream = имя хоста, до получения заголовков ответа). Дополняет переданные хуки.
+    """
+    upstreams: Dict[str, UpstreamMetrics] = {}
+
+    async def on_request(request) -> None:
+        request.extensions["metrics_started_at"] = time.perf_counter()
+
+    async def on_response(response) -> None:
+        started_at = response.request.extensions.get("metrics_started_at")
+        if started_at is None:
+            return
+        host = response.request.url.host
+        upstream = upstreams.get(host)
+        if upstream is None:
+            upstream = upstreams.setdefault(host, UpstreamMetrics(host))
+        upstream.observe(time.perf_counter() - started_at, response.status_code < 500)
+
+    hooks = {name: list(handlers) for name, handlers in (event_hooks or {}).items()}
+    hooks.setdefault("request", []).append(on_request)
+    hooks.setdefault("response", []).append(on_response)
+    return hooks
@@ -1,5 +1,6 @@
 from fastapi import FastAPI, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
 import os
 import json
@@ -8,16 +9,31 @@ from PIL import Image
 from PIL.ExifTags import TAGS
 import traceback
 
+from database import create_pool, close_pool
+from timing import TimingRecorder, install_timing
+from metrics import InferenceMetrics, install_metrics
+
 # 1. Модель для входных данных (должна соответствовать JSON, который отправляет Photo Upload Service)
 class ProcessRequest(BaseModel):
     file_id: str
     original_filename: str
     file_path: str # Путь к файлу на общем томе
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # БД нужна только для записи замеров этапов в processing_history
+    app.state.db_pool = await create_pool()
+    timings.start(app.state.db_pool)
+    yield
+    await timings.stop()
+    await close_pool(app.state.db_pool)
+
+
 app = FastAPI(
     title="CV Processing Service",
     description="Сервис компьютерного зрения для детекции зданий на фотографиях",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -28,6 +44,13 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Замеры этапов и X-Request-ID (см. timing.py)
+timings = TimingRecorder("cv-processing-service")
+install_timing(app, timings)
+# Метрики Prometheus: /metrics
+install_metrics(app)
+detector_metrics = InferenceMetrics("building_detector")
+
 # Папки для хранения (должны соответствовать docker-compose.yml)
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "storage/uploaded_photos/raw")
 PROCESSED_DIR = os.getenv("PROCESSED_DIR", "storage/uploaded_photos/processed")
@@ -114,20 +137,29 @@ async def process_photo(request: ProcessRequest):
         )
 
     try:
-        # Проверка, что файл является изображением
-        try:
-            with Image.open(file_path) as img:
-                img.verify() 
-        except Exception as e:
-            raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Невалидное изображение: {e}")
-        
-        print(f"🔄 Обработка изображения: {original_filename_safe} ({file_id})")
-        
-        # 1. Извлекаем метаданные
-        metadata = detector.extract_metadata(file_path)
+        with timings.stage("cv_decode", file_id=file_id):
+            # Проверка, что файл является изображением
+            try:
+                with Image.open(file_path) as img:
+                    img.verify() 
+            except Exception as e:
+                raise HTTPException(status.HTTP_400_BAD_REQUEST, f"Невалидное изображение: {e}")
+            
+            print(f"🔄 Обработка изображения: {original_filename_safe} ({file_id})")
+            
+            # 1. Извлекаем метаданные
+            metadata = detector.extract_metadata(file_path)
         
         # 2. Моковая детекция
-        buildings = detector.mock_detect_buildings(file_path)
+        # Детектор обрабатывает по одному снимку за вызов
+        detector_metrics.observe_batch(1)
+        detector_metrics.in_flight.inc()
+        try:
+            with timings.stage("cv_inference", file_id=file_id) as stage:
+                buildings = detector.mock_detect_buildings(file_path)
+                stage["buildings"] = len(buildings)
+        finally:
+            detector_metrics.in_flight.dec()
         
         result = {
             'metadata': metadata,
@@ -152,6 +184,11 @@ async def process_photo(request: ProcessRequest):
         print(f"❌ Непредвиденная ошибка в CV Service: {traceback.format_exc()}")
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, f"Ошибка обработки: {str(e)}")
 
+@app.get("/api/timings")
+async def timing_stats():
+    """Длительность этапов обработки (p50/p95, CPU) и состояние записи в processing_history."""
+    return timings.snapshot()
+
 @app.get("/model-info")
 async def model_info():
     """Информация о модели"""
@@ -0,0 +1,144 @@
+import asyncio
+import os
+import shutil
+import zipfile
+from typing import AsyncIterator, Callable, List, Sequence, Tuple
+
+from writers import ExportWriter
+
+# ZIP-архив экспорта со снимками, формируемый на лету.
+#
+# zipfile пишет архив в неперематываемый буфер (записи с дескриптором данных), буфер
+# отдается после каждого добавленного снимка: копии архива на диске нет, в памяти —
+# не больше одного файла. JPEG/PNG и уже сжатые форматы кладутся без сжатия (STORED).
+# Файл метаданных выбранного формата пишется во временный каталог за тот же проход
+# курсора и добавляется в конец архива.
+
+PHOTO_VARIANTS = ("original", "detected")
+# Уже сжатые форматы: повторное сжатие только тратит CPU
+STORED_EXTENSIONS = {".jpg", ".jpeg", ".png", ".gz", ".zip", ".xlsx", ".parquet"}
+COPY_BLOCK_SIZE = 1024 * 1024
+
+
+def detected_path(processed_dir: str, file_path: str) -> str:
+    """Визуализация детекций снимка (сохраняет cv-processing-service)."""
+    return os.path.join(processed_dir, f"detected_{os.path.basename(file_path)}")
+
+
+def resolve_storage_path(path: str, storage_dir: str) -> str:
+    """Реальный путь файла внутри storage_dir или пустая строка (нет файла / путь вне хранилища)."""
+    storage_dir = os.path.realpath(storage_dir)
+    real = os.path.realpath(path)
+    if os.path.commonpath([real, storage_dir]) != storage_dir or not os.path.isfile(real):
+        return ""
+    return real
+
+
+class _ZipBuffer:
+    """Приемник zipfile без seek/tell: накопленные байты забираются через take()."""
+
+    def __init__(self):
+        self._parts: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._parts.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def take(self) -> bytes:
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+
+class PhotoArchive:
+    """
+    Потоковый ZIP: снимки (photos/ — оригиналы, detected/ — визуализации детекций),
+    в конце — файл метаданных и список отсутствующих в хранилище файлов.
+    Методы блокирующие (чтение файлов): вызывайте их вне event loop.
+    """
+
+    def __init__(self, storage_dir: str, processed_dir: str, variants: Sequence[str]):
+        self.storage_dir = os.path.realpath(storage_dir)
+        self.processed_dir = processed_dir
+        self.variants = list(variants)
+        self.buffer = _ZipBuffer()
+        self.zip = zipfile.ZipFile(self.buffer, "w")
+        self.files = 0
+        self.missing: List[str] = []
+
+    def _add_file(self, path: str, name: str) -> None:
+        info = zipfile.ZipInfo.from_file(path, name)
+        stored = os.path.splitext(name)[1].lower() in STORED_EXTENSIONS
+        info.compress_type = zipfile.ZIP_STORED if stored else zipfile.ZIP_DEFLATED
+        with open(path, "rb") as source, self.zip.open(info, "w") as target:
+            shutil.copyfileobj(source, target, COPY_BLOCK_SIZE)
+        self.files += 1
+
+    def add_photo(self, file_path: str) -> bytes:
+        """Добавляет файлы снимка и возвращает готовые байты архива."""
+        if not file_path:
+            return b""
+        name = os.path.basename(file_path)
+        candidates = []
+        if "original" in self.variants:
+            candidates.append((file_path, f"photos/{name}"))
+        if "detected" in self.variants:
+            candidates.append((detected_path(self.processed_dir, file_path), f"detected/detected_{name}"))
+        for path, archive_name in candidates:
+            real = resolve_storage_path(path, self.storage_dir)
+            if real:
+                self._add_file(real, archive_name)
+            else:
+                self.missing.append(archive_name)
+        return self.buffer.take()
+
+    def finish(self, metadata_path: str, metadata_name: str) -> bytes:
+        """Метаданные, список отсутствующих файлов и центральный каталог ZIP."""
+        self._add_file(metadata_path, metadata_name)
+        if self.missing:
+            self.zip.writestr("missing_files.txt", "\n".join(self.missing) + "\n", zipfile.ZIP_DEFLATED)
+        self.zip.close()
+        return self.buffer.take()
+
+
+async def stream_archive(
+    archive: PhotoArchive,
+    chunks: AsyncIterator[List[Tuple]],
+    create_metadata_writer: Callable[[str], ExportWriter],
+    metadata_name: str,
+    work_dir: str
+) -> AsyncIterator[bytes]:
+    """
+    Байты ZIP из порций строк курсора: строки пишутся в файл метаданных в каталоге
+    work_dir (удаляется по завершении), файлы снимков (по одному разу на photo_id —
+    строки снимка идут подряд) — сразу в архив.
+    """
+    os.makedirs(work_dir)
+    writer = None
+    try:
+        writer = await asyncio.to_thread(create_metadata_writer, os.path.join(work_dir, metadata_name))
+        photo_id, file_path = writer.stats.index["photo_id"], writer.stats.index["file_path"]
+        last_photo_id = None
+        async for rows in chunks:
+            await asyncio.to_thread(writer.write_rows, rows)
+            for row in rows:
+                if row[photo_id] == last_photo_id:
+                    continue
+                last_photo_id = row[photo_id]
+                data = await asyncio.to_thread(archive.add_photo, row[file_path])
+                if data:
+                    yield data
+        await asyncio.to_thread(writer.close)
+        yield await asyncio.to_thread(archive.finish, writer.path, metadata_name)
+        if archive.missing:
+            print(f"⚠️ В архив не попали отсутствующие файлы: {len(archive.missing)}")
+    except BaseException:
+        if writer is not None:
+            await asyncio.to_thread(writer.abort)
+        raise
+    finally:
+        await chunks.aclose()
+        shutil.rmtree(work_dir, ignore_errors=True)
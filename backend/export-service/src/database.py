@@ -0,0 +1,48 @@
+import os
+from typing import Optional
+
+try:
+    import asyncpg
+except ImportError:  # без БД экспорт недоступен (503), остальные эндпоинты работают
+    asyncpg = None
+
+# Строка подключения к PostgreSQL (см. .env.example)
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+
+
+async def create_pool(min_size: Optional[int] = None, max_size: Optional[int] = None) -> Optional["asyncpg.Pool"]:
+    """
+    Пул соединений asyncpg. Соединения открываются один раз при старте сервиса
+    и переиспользуются запросами. None, если БД не настроена или недоступна.
+    Размер по умолчанию — DB_POOL_MIN_SIZE/DB_POOL_MAX_SIZE (процессам заданий экспорта хватает двух).
+    """
+    min_size = DB_POOL_MIN_SIZE if min_size is None else min_size
+    max_size = DB_POOL_MAX_SIZE if max_size is None else max_size
+    if not DATABASE_URL:
+        print("⚠️ Переменная DATABASE_URL не установлена. Экспорт данных недоступен.")
+        return None
+    if asyncpg is None:
+        print("❌ Пакет asyncpg недоступен. Экспорт данных недоступен.")
+        return None
+
+    try:
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=min_size,
+            max_size=max_size,
+            command_timeout=DB_COMMAND_TIMEOUT,
+        )
+    except Exception as e:
+        print(f"❌ Не удалось подключиться к БД: {e}. Экспорт данных недоступен.")
+        return None
+
+    print(f"✅ Пул соединений с БД создан (min={min_size}, max={max_size})")
+    return pool
+
+
+async def close_pool(pool: Optional["asyncpg.Pool"]) -> None:
+    if pool is not None:
+        await pool.close()
@@ -0,0 +1,206 @@
+import asyncio
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Optional, Tuple
+
+from starlette.requests import Request
+from starlette.responses import FileResponse, Response
+from starlette.types import Receive, Scope, Send
+
+# Скачивание файлов с докачкой (Range) и условными запросами (ETag / If-None-Match).
+#
+# ETag — SHA-256 содержимого файла: он не меняется при копировании или восстановлении файла
+# и совпадает у одинаковых экспортов. Хэш берется из БД (exports.content_hash,
+# photo_metadata.file_hash), иначе считается по файлу и запоминается в LRU-кэше по
+# (путь, размер, mtime). Поддерживается один диапазон bytes=; запрос нескольких диапазонов
+# получает файл целиком (RFC 9110 это допускает). Тело передается через расширение ASGI
+# http.response.zerocopysend (sendfile), если сервер его поддерживает, иначе — блоками.
+
+HASH_BLOCK_SIZE = 1024 * 1024
+HASH_CACHE_SIZE = int(os.getenv("DOWNLOAD_HASH_CACHE_SIZE", 4096))
+
+_hash_cache: "OrderedDict[Tuple[str, int, int], str]" = OrderedDict()
+_hash_cache_lock = threading.Lock()
+
+
+class RangeNotSatisfiable(Exception):
+    """Диапазон за пределами файла (416)."""
+
+
+def file_sha256(path: str) -> str:
+    """SHA-256 файла (hex). Блокирующая: вызывайте вне event loop."""
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(HASH_BLOCK_SIZE), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def cached_sha256(path: str, stat_result: os.stat_result) -> str:
+    """SHA-256 файла из кэша; измененный файл (размер, mtime) хэшируется заново."""
+    key = (path, stat_result.st_size, stat_result.st_mtime_ns)
+    with _hash_cache_lock:
+        digest = _hash_cache.get(key)
+        if digest is not None:
+            _hash_cache.move_to_end(key)
+            return digest
+    digest = file_sha256(path)
+    with _hash_cache_lock:
+        _hash_cache[key] = digest
+        while len(_hash_cache) > HASH_CACHE_SIZE:
+            _hash_cache.popitem(last=False)
+    return digest
+
+
+def parse_range(value: str, size: int) -> Optional[Tuple[int, int]]:
+    """
+    Заголовок Range -> (первый, последний байт) включительно.
+    None — заголовок некорректен или диапазонов несколько (отдается весь файл).
+    """
+    unit, _, spec = value.partition("=")
+    if unit.strip().lower() != "bytes" or "," in spec:
+        return None
+    first, sep, last = spec.strip().partition("-")
+    if not sep or not (first or last) or not all(part.isdigit() for part in (first, last) if part):
+        return None
+    if not first:
+        # bytes=-N: последние N байт
+        length = int(last)
+        if length == 0 or size == 0:
+            raise RangeNotSatisfiable()
+        return max(size - length, 0), size - 1
+    start = int(first)
+    if last and int(last) < start:
+        return None
+    if start >= size:
+        raise RangeNotSatisfiable()
+    return start, min(int(last), size - 1) if last else size - 1
+
+
+def etag_matches(value: str, etag: str) -> bool:
+    """If-None-Match: слабое сравнение со списком тегов или *."""
+    if value.strip() == "*":
+        return True
+    return any(tag.strip().removeprefix("W/") == etag for tag in value.split(","))
+
+
+def range_applies(if_range: Optional[str], etag: str, mtime: float) -> bool:
+    """If-Range: диапазон действует, только если файл не изменился (строгий ETag или дата)."""
+    if not if_range:
+        return True
+    if_range = if_range.strip()
+    if if_range.startswith(("\"", "W/")):
+        return if_range == etag
+    try:
+        return int(parsedate_to_datetime(if_range).timestamp()) == int(mtime)
+    except (TypeError, ValueError):
+        return False
+
+
+def not_modified_since(value: Optional[str], mtime: float) -> bool:
+    """If-Modified-Since (учитывается, только если нет If-None-Match)."""
+    if not value:
+        return False
+    try:
+        return int(mtime) <= int(parsedate_to_datetime(value).timestamp())
+    except (TypeError, ValueError):
+        return False
+
+
+class RangeFileResponse(FileResponse):
+    """FileResponse для файла или его диапазона (206) с передачей через sendfile, если доступен."""
+
+    chunk_size = 256 * 1024
+
+    def __init__(self, path: str, stat_result: os.stat_result, byte_range: Optional[Tuple[int, int]] = None, **kwargs):
+        super().__init__(path, status_code=206 if byte_range else 200, stat_result=stat_result, **kwargs)
+        self.byte_range = byte_range
+        if byte_range is not None:
+            start, end = byte_range
+            self.headers["content-range"] = f"bytes {start}-{end}/{stat_result.st_size}"
+            self.headers["content-length"] = str(end - start + 1)
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        start, end = self.byte_range or (0, self.stat_result.st_size - 1)
+        await send({"type": "http.response.start", "status": self.status_code, "headers": self.raw_headers})
+        if self.send_header_only or end < start:
+            await send({"type": "http.response.body", "body": b"", "more_body": False})
+        else:
+            file = await asyncio.to_thread(open, self.path, "rb")
+            try:
+                if "http.response.zerocopysend" in scope.get("extensions", {}):
+                    # Данные копирует ядро (sendfile): файл не проходит через память процесса
+                    await send({
+                        "type": "http.response.zerocopysend",
+                        "file": file,
+                        "offset": start,
+                        "count": end - start + 1,
+                        "more_body": False,
+                    })
+                else:
+                    await asyncio.to_thread(file.seek, start)
+                    remaining = end - start + 1
+                    while remaining > 0:
+                        chunk = await asyncio.to_thread(file.read, min(self.chunk_size, remaining))
+                        if not chunk:
+                            raise RuntimeError(f"Файл {self.path} укоротился во время отправки")
+                        remaining -= len(chunk)
+                        await send({"type": "http.response.body", "body": chunk, "more_body": remaining > 0})
+            finally:
+                file.close()
+        if self.background is not None:
+            await self.background()
+
+
+async def file_response(
+    request: Request,
+    path: str,
+    content_hash: Optional[str] = None,
+    filename: Optional[str] = None,
+    media_type: Optional[str] = None,
+    inline: bool = False
+) -> Response:
+    """
+    Ответ на GET/HEAD файла: 304 (If-None-Match / If-Modified-Since), 206 (Range),
+    416 (диапазон вне файла) или 200. content_hash — SHA-256 файла, если уже известен.
+    """
+    stat_result = await asyncio.to_thread(os.stat, path)
+    if not content_hash:
+        content_hash = await asyncio.to_thread(cached_sha256, path, stat_result)
+    etag = f"\"{content_hash}\""
+    headers = {
+        "ETag": etag,
+        "Last-Modified": formatdate(stat_result.st_mtime, usegmt=True),
+        "Accept-Ranges": "bytes",
+        # Кэш может хранить файл, но обязан сверять ETag
+        "Cache-Control": "no-cache",
+    }
+
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        if etag_matches(if_none_match, etag):
+            return Response(status_code=304, headers=headers)
+    elif not_modified_since(request.headers.get("if-modified-since"), stat_result.st_mtime):
+        return Response(status_code=304, headers=headers)
+
+    byte_range = None
+    range_header = request.headers.get("range")
+    if range_header and range_applies(request.headers.get("if-range"), etag, stat_result.st_mtime):
+        try:
+            byte_range = parse_range(range_header, stat_result.st_size)
+        except RangeNotSatisfiable:
+            return Response(status_code=416, headers={**headers, "Content-Range": f"bytes */{stat_result.st_size}"})
+
+    return RangeFileResponse(
+        path,
+        stat_result,
+        byte_range,
+        headers=headers,
+        media_type=media_type,
+        filename=filename,
+        method=request.method,
+        content_disposition_type="inline" if inline else "attachment",
+    )
@@ -0,0 +1,327 @@
+import asyncio
+import hashlib
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import uuid
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Set, Tuple
+
+from archive import PhotoArchive, stream_archive
+from database import create_pool, close_pool
+from downloads import file_sha256
+from repository import ExportJobRepository, ExportQuery, ExportRepository
+from writers import ENCODERS, create_writer, export_file_name
+
+# Фоновые задания экспорта.
+#
+# Каждое задание выполняется в собственном процессе (spawn), одновременно — не больше
+# EXPORT_WORKERS: выборка, кодирование и сжатие больших экспортов не отнимают CPU у обработки
+# HTTP-запросов, а падение процесса (OOM, segfault) затрагивает только его задание. У каждого
+# процесса свой event loop и пул из двух соединений (курсор и обновление прогресса). Состояние — в таблице exports: queued -> processing -> completed | failed,
+# прогресс — exported_records / total_records. Одинаковые запросы, пока задание не завершено,
+# объединяются по request_hash (частичный уникальный индекс idx_exports_in_flight).
+#
+# Готовые файлы — кэш: запрос с тем же request_hash получает завершенный экспорт, пока данные
+# выборки не изменились (ExportRepository.unchanged_since). Размер каталога экспортов
+# ограничен EXPORT_CACHE_MAX_BYTES: сверх него удаляются давно не использованные файлы
+# (exports.last_accessed_at), их экспорты переходят в статус expired.
+
+# Папка для экспортов
+EXPORT_DIR = os.getenv("EXPORT_DIR", "storage/exports")
+os.makedirs(EXPORT_DIR, exist_ok=True)
+
+# Строк в одной порции курсора (столько строк экспорта одновременно в памяти)
+EXPORT_CHUNK_SIZE = int(os.getenv("EXPORT_CHUNK_SIZE", 5000))
+
+# Общее хранилище снимков (пути из photo_metadata.file_path) и визуализации детекций
+STORAGE_DIR = os.getenv("STORAGE_DIR") or "storage"
+PROCESSED_DIR = os.getenv("PROCESSED_DIR") or "storage/uploaded_photos/processed"
+
+# Одновременных заданий (процессов) и ожидающих заданий сверх них
+EXPORT_WORKERS = int(os.getenv("EXPORT_WORKERS", 2))
+EXPORT_MAX_QUEUED = int(os.getenv("EXPORT_MAX_QUEUED", 20))
+# Как часто (секунды) задание обновляет exported_records
+EXPORT_PROGRESS_INTERVAL = float(os.getenv("EXPORT_PROGRESS_INTERVAL", 2.0))
+# Предельный размер готовых файлов экспорта (байты, по умолчанию 10 ГБ)
+EXPORT_CACHE_MAX_BYTES = int(os.getenv("EXPORT_CACHE_MAX_BYTES", 10 * 1024 ** 3))
+
+
+class ExportJob:
+    """Параметры задания. Передаются в процесс заданий, поэтому содержат только простые данные."""
+
+    def __init__(
+        self,
+        export_id: str,
+        export_format: str,
+        query: ExportQuery,
+        compress: bool = False,
+        photo_variants: Optional[Sequence[str]] = None
+    ):
+        self.export_id = export_id
+        self.export_format = export_format
+        self.query = query
+        # XLSX и Parquet сжаты сами: gzip влияет только на текстовые форматы
+        self.compress = compress and export_format in ENCODERS
+        self.photo_variants = sorted(set(photo_variants)) if photo_variants else None
+
+    @property
+    def file_name(self) -> str:
+        if self.photo_variants:
+            return f"{self.export_id}.zip"
+        return export_file_name(self.export_id, self.export_format, self.compress, bool(self.query.partition_by))
+
+    def fingerprint(self) -> str:
+        """SHA-256 канонического запроса: одинаковые выборки в одинаковом формате совпадают."""
+        canonical = {
+            "query": self.query.canonical(),
+            "format": self.export_format,
+            "gzip": self.compress,
+            "photo_variants": self.photo_variants,
+        }
+        return hashlib.sha256(json.dumps(canonical, sort_keys=True).encode("utf-8")).hexdigest()
+
+
+class ExportProgress:
+    """Счетчик выгруженных строк; в БД пишется не чаще раза в EXPORT_PROGRESS_INTERVAL."""
+
+    def __init__(self, jobs: ExportJobRepository, export_id: str):
+        self.jobs = jobs
+        self.export_id = export_id
+        self.rows = 0
+        self._reported_at = time.monotonic()
+
+    async def add(self, rows: int) -> None:
+        self.rows += rows
+        if time.monotonic() - self._reported_at >= EXPORT_PROGRESS_INTERVAL:
+            self._reported_at = time.monotonic()
+            await self.jobs.progress(self.export_id, self.rows)
+
+
+async def track_progress(chunks: AsyncIterator[List[Tuple]], progress: ExportProgress) -> AsyncIterator[List[Tuple]]:
+    try:
+        async for rows in chunks:
+            yield rows
+            await progress.add(len(rows))
+    finally:
+        await chunks.aclose()
+
+
+def open_archive_stream(
+    chunks: AsyncIterator[List[Tuple]],
+    query: ExportQuery,
+    export_format: str,
+    compress: bool,
+    photo_variants: Sequence[str],
+    owner_id: str
+) -> AsyncIterator[bytes]:
+    """
+    Поток байтов ZIP со снимками и метаданными в формате export_format. Рабочий каталог
+    {owner_id}.part.archive убирает remove_partial_files, если процесс упал посреди архива.
+    """
+    archive = PhotoArchive(STORAGE_DIR, PROCESSED_DIR, photo_variants)
+    return stream_archive(
+        archive,
+        chunks,
+        lambda path: create_writer(path, export_format, query.columns, compress, query.partition_by),
+        export_file_name("export", export_format, compress, bool(query.partition_by)),
+        os.path.join(EXPORT_DIR, f"{owner_id}.part.archive")
+    )
+
+
+async def create_export_file(chunks: AsyncIterator[List[Tuple]], file_path: str, job: ExportJob) -> None:
+    """
+    Создание файла экспорта: строки из курсора БД порциями передаются писателю,
+    в памяти находится только текущая порция.
+    """
+    writer = None
+    try:
+        writer = create_writer(file_path, job.export_format, job.query.columns, job.compress, job.query.partition_by)
+        async for rows in chunks:
+            # Запись в файл блокирующая: выполняется вне event loop
+            await asyncio.to_thread(writer.write_rows, rows)
+        await asyncio.to_thread(writer.close)
+    except BaseException:
+        await chunks.aclose()
+        if writer is not None:
+            await asyncio.to_thread(writer.abort)
+        raise
+
+
+async def create_archive_file(chunks: AsyncIterator[List[Tuple]], file_path: str, job: ExportJob) -> None:
+    """ZIP со снимками: тот же поток, что и у /api/export/stream, но в файл."""
+    temp_path = os.path.join(EXPORT_DIR, job.file_name.replace(".", ".part.", 1))
+    stream = open_archive_stream(chunks, job.query, job.export_format, job.compress, job.photo_variants, job.export_id)
+    try:
+        with open(temp_path, "wb") as f:
+            async for data in stream:
+                await asyncio.to_thread(f.write, data)
+        os.replace(temp_path, file_path)
+    except BaseException:
+        await stream.aclose()
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        raise
+
+
+async def execute_export_job(job: ExportJob) -> None:
+    pool = await create_pool(min_size=1, max_size=2)
+    if pool is None:
+        raise RuntimeError("База данных недоступна")
+    jobs = ExportJobRepository(pool)
+    try:
+        started_at = time.perf_counter()
+        repository = ExportRepository(pool)
+        await jobs.start(job.export_id, await repository.count(job.query))
+        progress = ExportProgress(jobs, job.export_id)
+        chunks = track_progress(repository.stream(job.query, EXPORT_CHUNK_SIZE), progress)
+        file_path = os.path.join(EXPORT_DIR, job.file_name)
+        if job.photo_variants:
+            await create_archive_file(chunks, file_path, job)
+        else:
+            await create_export_file(chunks, file_path, job)
+        # SHA-256 файла — ETag при скачивании; водяной знак — основа следующего
+        # инкрементального экспорта (since_export_id) и, вместе с версией состава датасетов,
+        # проверки актуальности при повторном использовании
+        content_hash = await asyncio.to_thread(file_sha256, file_path)
+        await jobs.complete(
+            job.export_id, file_path, os.path.getsize(file_path), content_hash, progress.rows,
+            repository.watermark, repository.data_version
+        )
+        print(f"✅ Файл экспорта создан: {file_path} ({progress.rows} строк, {time.perf_counter() - started_at:.1f} с)")
+    except Exception as e:
+        print(f"❌ Ошибка создания файла экспорта {job.export_id}: {e}")
+        await jobs.fail(job.export_id, f"{type(e).__name__}: {e}")
+    finally:
+        await close_pool(pool)
+
+
+def remove_partial_files(export_id: str = "") -> int:
+    """
+    Недописанные файлы и рабочие каталоги ({id}.part.*) задания или, без export_id,
+    всех прерванных заданий и потоковых выгрузок.
+    """
+    removed = 0
+    for entry in os.scandir(EXPORT_DIR):
+        if entry.name.startswith(f"{export_id}.part.") if export_id else ".part." in entry.name:
+            if entry.is_dir(follow_symlinks=False):
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                os.remove(entry.path)
+            removed += 1
+    return removed
+
+
+def export_files() -> Dict[str, Tuple[str, int, float]]:
+    """Готовые файлы экспорта: id -> (путь, размер, mtime). Временные файлы и каталоги пропускаются."""
+    files = {}
+    for entry in os.scandir(EXPORT_DIR):
+        export_id = entry.name.partition(".")[0]
+        if ".part." in entry.name or not entry.is_file():
+            continue
+        try:
+            uuid.UUID(export_id)
+        except ValueError:
+            continue
+        stat_result = entry.stat()
+        files[export_id] = (entry.path, stat_result.st_size, stat_result.st_mtime)
+    return files
+
+
+async def evict_exports(jobs: ExportJobRepository, keep: str = "", max_bytes: int = EXPORT_CACHE_MAX_BYTES) -> int:
+    """
+    Удаляет давно не использованные файлы экспорта, пока их общий размер больше max_bytes.
+    Файлы без завершенного экспорта в БД упорядочиваются по mtime; keep не удаляется.
+    """
+    files = await asyncio.to_thread(export_files)
+    total = sum(size for _, size, _ in files.values())
+    if total <= max_bytes:
+        return 0
+    accessed = {
+        export_id: accessed_at.timestamp()
+        for export_id, accessed_at in (await jobs.last_accessed(list(files))).items()
+    }
+    evicted = []
+    for export_id in sorted(files, key=lambda i: accessed.get(i, files[i][2])):
+        if total <= max_bytes:
+            break
+        if export_id == keep:
+            continue
+        path, size, _ = files[export_id]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+        total -= size
+        evicted.append(export_id)
+    await jobs.expire(evicted)
+    print(f"🔄 Из кэша экспортов удалено файлов: {len(evicted)} (осталось {total / 1024 ** 2:.1f} МБ)")
+    return len(evicted)
+
+
+def run_export_job(job: ExportJob) -> None:
+    """Точка входа процесса заданий."""
+    asyncio.run(execute_export_job(job))
+
+
+class ExportWorkerPool:
+    """
+    Процессы заданий экспорта: не больше workers заданий одновременно и не больше
+    max_queued ожидающих. Задание, процесс которого завершился аварийно, помечается failed;
+    остальные задания это не затрагивает.
+    """
+
+    def __init__(self, workers: int = EXPORT_WORKERS, max_queued: int = EXPORT_MAX_QUEUED):
+        self.workers = workers
+        self.max_queued = max_queued
+        # spawn: процессы заданий не наследуют event loop и потоки сервера
+        self._context = multiprocessing.get_context("spawn")
+        self._slots: Optional[asyncio.Semaphore] = None
+        self._tasks: Set[asyncio.Task] = set()
+        self._processes: Set[multiprocessing.process.BaseProcess] = set()
+
+    def start(self) -> None:
+        self._slots = asyncio.Semaphore(self.workers)
+        print(f"✅ Пул заданий экспорта: {self.workers} процессов, очередь до {self.max_queued}")
+
+    @property
+    def active(self) -> int:
+        """Заданий в работе и в очереди."""
+        return len(self._tasks)
+
+    def full(self) -> bool:
+        return self.active >= self.workers + self.max_queued
+
+    def submit(self, job: ExportJob, jobs: ExportJobRepository) -> None:
+        task = asyncio.create_task(self._run(job, jobs))
+        self._tasks.add(task)
+        task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, job: ExportJob, jobs: ExportJobRepository) -> None:
+        async with self._slots:
+            process = self._context.Process(target=run_export_job, args=(job,), name=f"export-{job.export_id[:8]}")
+            process.start()
+            self._processes.add(process)
+            try:
+                await asyncio.to_thread(process.join)
+            finally:
+                self._processes.discard(process)
+
+        if process.exitcode != 0:
+            # Ошибки экспорта задание записывает само; сюда попадает падение процесса
+            error = f"Процесс задания экспорта завершился с кодом {process.exitcode}"
+            print(f"❌ Задание экспорта {job.export_id} не выполнено: {error}")
+            remove_partial_files(job.export_id)
+            await jobs.fail(job.export_id, error)
+            return
+        try:
+            await evict_exports(jobs, keep=job.export_id)
+        except Exception as e:
+            print(f"⚠️ Ошибка очистки кэша экспортов: {e}")
+
+    async def stop(self) -> None:
+        for task in list(self._tasks):
+            task.cancel()
+        for process in list(self._processes):
+            process.terminate()
@@ -1,18 +1,48 @@
-from fastapi import FastAPI, HTTPException, BackgroundTasks
+from fastapi import FastAPI, HTTPException, Request
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import FileResponse
+from fastapi.responses import StreamingResponse
+from contextlib import asynccontextmanager
 from pydantic import BaseModel
-from typing import List, Optional, Dict
-import pandas as pd
+from typing import List, Optional
 import os
 import uuid
-from datetime import datetime
-import json
+from datetime import datetime, time, timezone
+
+from metrics import install_metrics
+from archive import PHOTO_VARIANTS, detected_path, resolve_storage_path
+from database import create_pool, close_pool
+from downloads import file_response
+from jobs import (
+    EXPORT_CHUNK_SIZE, EXPORT_DIR, PROCESSED_DIR, STORAGE_DIR, ExportJob, ExportWorkerPool,
+    evict_exports, open_archive_stream, remove_partial_files
+)
+from repository import PARTITION_KEYS, ExportJobRepository, ExportQuery, ExportRepository, PhotoRepository
+from writers import (
+    ENCODERS, FILE_FORMATS, GZIP_MEDIA_TYPE, ZIP_MEDIA_TYPE,
+    encode_stream, export_file_name, media_type_for
+)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    app.state.db_pool = await create_pool()
+    # Задания экспорта выполняются в отдельных процессах (см. jobs.py)
+    app.state.export_workers = ExportWorkerPool()
+    if app.state.db_pool is not None:
+        interrupted = await ExportJobRepository(app.state.db_pool).fail_unfinished("Прервано перезапуском сервиса экспорта")
+        if interrupted:
+            print(f"⚠️ Незавершенные экспорты помечены как failed: {interrupted}")
+        remove_partial_files()
+        await evict_exports(ExportJobRepository(app.state.db_pool))
+        app.state.export_workers.start()
+    yield
+    await app.state.export_workers.stop()
+    await close_pool(app.state.db_pool)
 
 app = FastAPI(
     title="Export Service",
-    description="Сервис экспорта данных в XLSX и другие форматы",
-    version="1.0.0"
+    description="Сервис экспорта данных в XLSX, Parquet, CSV, JSON/NDJSON и GeoJSON",
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -23,19 +53,27 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-# Папка для экспортов
-EXPORT_DIR = "storage/exports"
-os.makedirs(EXPORT_DIR, exist_ok=True)
+# Метрики Prometheus: /metrics (см. metrics.py)
+install_metrics(app)
 
 # Модели данных
 class ExportRequest(BaseModel):
     dataset_ids: Optional[List[int]] = None
     date_from: Optional[str] = None
     date_to: Optional[str] = None
-    include_photos: bool = True
+    # ZIP с файлом метаданных и снимками: original — оригиналы, detected — detected_* визуализации
+    include_photos: bool = False
+    photo_variants: List[str] = ["original"]
     include_detections: bool = True
     include_geocoding: bool = True
     format: str = "xlsx"
+    gzip: bool = False
+    # Только для parquet: dataset_id, taken_date, taken_month
+    partition_by: Optional[List[str]] = None
+    # Инкрементальный экспорт: строки снимков, измененных начиная с момента since (ISO 8601)
+    # или после водяного знака завершенного экспорта since_export_id
+    since: Optional[str] = None
+    since_export_id: Optional[str] = None
 
 class ExportResponse(BaseModel):
     export_id: str
@@ -51,7 +89,10 @@ async def root():
         "endpoints": [
             "/health",
             "/api/export",
-            "/api/export/{export_id}/download"
+            "/api/export/stream",
+            "/api/export/formats",
+            "/api/export/{export_id}/download",
+            "/api/photos/{photo_uuid}/download"
         ]
     }
 
@@ -60,135 +101,301 @@ async def health_check():
     return {"status": "healthy", "service": "export-service"}
 
 @app.post("/api/export", response_model=ExportResponse)
-async def create_export(request: ExportRequest, background_tasks: BackgroundTasks):
-    """Создание экспорта данных"""
-    try:
-        export_id = str(uuid.uuid4())
-        
-        # В реальности здесь будет запрос к БД для получения данных
-        # Сейчас используем mock данные
-        mock_data = generate_mock_export_data()
-        
-        # Создаем файл экспорта в фоновом режиме
-        background_tasks.add_task(create_export_file, export_id, mock_data, request.format)
-        
+async def create_export(request: ExportRequest):
+    """Создание экспорта данных (задание в пуле процессов экспорта, состояние — в таблице exports)"""
+    if app.state.db_pool is None:
+        raise HTTPException(503, "База данных недоступна: экспорт невозможен")
+
+    if request.format not in FILE_FORMATS:
+        raise HTTPException(400, f"Неподдерживаемый формат: {request.format} (доступны: {', '.join(FILE_FORMATS)})")
+
+    query = await build_export_query(request)
+    job = ExportJob(
+        str(uuid.uuid4()),
+        request.format,
+        query,
+        compress=request.gzip,
+        photo_variants=request.photo_variants if request.include_photos else None
+    )
+    request_hash = job.fingerprint()
+    jobs = ExportJobRepository(app.state.db_pool)
+
+    # Готовый экспорт того же запроса, если данные выборки с тех пор не менялись
+    cached = await find_reusable_export(jobs, query, request_hash)
+    if cached is not None:
         return ExportResponse(
-            export_id=export_id,
-            status="processing",
-            message="Экспорт начат. Файл будет готов через несколько секунд."
+            export_id=cached,
+            status="completed",
+            file_path=f"/api/export/{cached}/download",
+            message="Использован готовый экспорт с теми же параметрами: данные с тех пор не менялись."
+        )
+
+    # Такой же запрос уже в работе: возвращается его задание, даже если очередь заполнена
+    in_flight = await jobs.find_in_flight(request_hash)
+    if in_flight is not None:
+        return in_flight_response(in_flight)
+
+    workers: ExportWorkerPool = app.state.export_workers
+    if workers.full():
+        raise HTTPException(429, f"Очередь экспорта заполнена ({workers.active} заданий). Повторите позже.")
+
+    try:
+        export_id, created = await jobs.create(
+            job.export_id,
+            download_name(job.export_id, job.file_name),
+            request.format,
+            query,
+            request.model_dump(),
+            request_hash
         )
-        
     except Exception as e:
         raise HTTPException(500, f"Ошибка создания экспорта: {str(e)}")
 
-@app.get("/api/export/{export_id}/download")
-async def download_export(export_id: str):
-    """Скачивание готового экспорта"""
-    file_path = os.path.join(EXPORT_DIR, f"{export_id}.xlsx")
+    if not created:
+        # Такой же экспорт поставлен параллельным запросом после проверки выше
+        return in_flight_response(export_id)
+
+    workers.submit(job, jobs)
+    return ExportResponse(
+        export_id=export_id,
+        status="queued",
+        message="Экспорт поставлен в очередь. Прогресс — в /api/export/{export_id}/status."
+    )
+
+@app.post("/api/export/stream")
+async def stream_export(request: ExportRequest):
+    """
+    Экспорт потоком без файла на диске: строки из курсора БД кодируются порциями
+    и сразу отдаются клиенту (chunked). Для CSV, JSON, NDJSON и GeoJSON;
+    с include_photos — ZIP со снимками и файлом метаданных любого формата.
+    """
+    streamable = FILE_FORMATS if request.include_photos else list(ENCODERS)
+    if request.format not in streamable:
+        raise HTTPException(400, f"Формат {request.format} не поддерживает потоковую выдачу (доступны: {', '.join(streamable)})")
+    if app.state.db_pool is None:
+        raise HTTPException(503, "База данных недоступна: экспорт невозможен")
+
+    query = await build_export_query(request)
+    if request.include_photos:
+        chunks = ExportRepository(app.state.db_pool).stream(query, EXPORT_CHUNK_SIZE)
+        return StreamingResponse(
+            open_archive_stream(chunks, query, request.format, request.gzip, request.photo_variants, f"stream-{uuid.uuid4()}"),
+            media_type=ZIP_MEDIA_TYPE,
+            headers={"Content-Disposition": f'attachment; filename="geo_photo_export_{datetime.now():%Y%m%d_%H%M%S}.zip"'}
+        )
+    encoder = ENCODERS[request.format](query.columns)
+    chunks = ExportRepository(app.state.db_pool).stream(query, EXPORT_CHUNK_SIZE)
+    filename = export_file_name(f"geo_photo_export_{datetime.now():%Y%m%d_%H%M%S}", request.format, request.gzip)
+    return StreamingResponse(
+        encode_stream(encoder, chunks, request.gzip),
+        media_type=GZIP_MEDIA_TYPE if request.gzip else encoder.media_type,
+        headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+async def find_reusable_export(jobs: ExportJobRepository, query: ExportQuery, request_hash: str) -> Optional[str]:
+    """id завершенного экспорта того же запроса, если его файл на месте и данные актуальны."""
+    cached = await jobs.find_completed(request_hash)
+    if cached is None or cached["watermark"] is None or cached["data_version"] is None:
+        return None
+    if find_export_file(cached["export_id"]) is None:
+        return None
+    repository = ExportRepository(app.state.db_pool)
+    if not await repository.unchanged_since(query, cached["watermark"], cached["data_version"]):
+        return None
+    # Обращение продлевает жизнь файла в кэше (LRU); файл могли вытеснить после проверки
+    if await jobs.touch(cached["export_id"]) is None:
+        return None
+    return cached["export_id"]
+
+def in_flight_response(export_id: str) -> ExportResponse:
+    """Ответ на повтор запроса, который уже выполняется: возвращается существующее задание."""
+    return ExportResponse(
+        export_id=export_id,
+        status="processing",
+        message="Такой же экспорт уже выполняется: возвращено существующее задание."
+    )
+
+def validate_export_id(export_id: str) -> None:
+    try:
+        uuid.UUID(export_id)
+    except ValueError:
+        raise HTTPException(404, "Экспорт не найден")
+
+def download_name(export_id: str, file_name: str) -> str:
+    """Имя файла для пользователя: geo_photo_export_<8 символов id>.<расширения>."""
+    return f"geo_photo_export_{export_id[:8]}{file_name[len(export_id):]}"
+
+def find_export_file(export_id: str) -> Optional[str]:
+    """Готовый файл экспорта (любого формата) или None."""
+    validate_export_id(export_id)
+    prefix = f"{export_id}."
+    for name in os.listdir(EXPORT_DIR):
+        # Незавершенные файлы пишутся во временные {export_id}.part.*
+        if name.startswith(prefix) and not name.startswith(f"{prefix}part."):
+            return os.path.join(EXPORT_DIR, name)
+    return None
+
+@app.api_route("/api/export/{export_id}/download", methods=["GET", "HEAD"])
+async def download_export(export_id: str, request: Request):
+    """Скачивание готового экспорта (докачка через Range, ETag — SHA-256 файла)"""
+    file_path = find_export_file(export_id)
     
-    if not os.path.exists(file_path):
+    if file_path is None:
         raise HTTPException(404, "Файл экспорта не найден или еще не готов")
     
-    filename = f"geo_photo_export_{export_id[:8]}.xlsx"
+    name = os.path.basename(file_path)
+    # Хэш записан заданием экспорта; без БД он считается по файлу (см. downloads.py).
+    # Скачивание отмечает обращение к экспорту для LRU-вытеснения файлов
+    content_hash = None
+    if app.state.db_pool is not None:
+        content_hash = await ExportJobRepository(app.state.db_pool).touch(export_id)
     
-    return FileResponse(
-        path=file_path,
-        filename=filename,
-        media_type='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
+    return await file_response(
+        request,
+        file_path,
+        content_hash,
+        filename=download_name(export_id, name),
+        media_type=media_type_for(name)
     )
 
+@app.api_route("/api/photos/{photo_uuid}/download", methods=["GET", "HEAD"])
+async def download_photo(photo_uuid: str, request: Request, variant: str = "original"):
+    """Скачивание снимка (original) или визуализации детекций (detected) с поддержкой Range и ETag"""
+    if variant not in PHOTO_VARIANTS:
+        raise HTTPException(400, f"Неизвестный вариант снимка: {variant}. Доступны: {', '.join(PHOTO_VARIANTS)}")
+    try:
+        uuid.UUID(photo_uuid)
+    except ValueError:
+        raise HTTPException(404, "Снимок не найден")
+    if app.state.db_pool is None:
+        raise HTTPException(503, "База данных недоступна")
+
+    photo = await PhotoRepository(app.state.db_pool).get(photo_uuid)
+    if photo is None:
+        raise HTTPException(404, "Снимок не найден")
+
+    if variant == "original":
+        path, filename = photo["file_path"], photo["original_filename"]
+        # file_hash — SHA-256 оригинала, записанный при загрузке
+        content_hash, media_type = photo["file_hash"], photo["mime_type"]
+    else:
+        path, filename = detected_path(PROCESSED_DIR, photo["file_path"]), f"detected_{photo['original_filename']}"
+        content_hash, media_type = None, None
+    real_path = resolve_storage_path(path, STORAGE_DIR)
+    if not real_path:
+        raise HTTPException(404, "Файл снимка отсутствует в хранилище")
+
+    return await file_response(request, real_path, content_hash, filename=filename, media_type=media_type, inline=True)
+
 @app.get("/api/export/{export_id}/status")
 async def get_export_status(export_id: str):
-    """Получение статуса экспорта"""
-    file_path = os.path.join(EXPORT_DIR, f"{export_id}.xlsx")
-    
-    if os.path.exists(file_path):
-        return {
-            "export_id": export_id,
-            "status": "completed",
-            "file_path": file_path,
-            "file_size": os.path.getsize(file_path),
+    """Получение статуса и прогресса экспорта"""
+    validate_export_id(export_id)
+    if app.state.db_pool is None:
+        raise HTTPException(503, "База данных недоступна: статус экспорта неизвестен")
+
+    job = await ExportJobRepository(app.state.db_pool).get(export_id)
+    if job is None:
+        raise HTTPException(404, "Экспорт не найден")
+
+    total, exported = job["total_records"], job["exported_records"]
+    status = {
+        "export_id": export_id,
+        "status": job["status"],
+        "format": job["export_format"],
+        "total_records": total,
+        "exported_records": exported,
+        "progress": round(min(exported / total, 1.0), 4) if total else None,
+        # since — нижняя граница инкрементального экспорта, watermark — для следующего
+        "since": job["since_watermark"],
+        "watermark": job["watermark"],
+        "created_at": job["created_at"],
+        "started_at": job["started_at"],
+        "completed_at": job["completed_at"],
+        "last_accessed_at": job["last_accessed_at"],
+    }
+    if job["status"] == "completed":
+        status.update({
+            "file_path": job["file_path"],
+            "file_size": job["file_size"],
+            "sha256": job["content_hash"],
             "download_url": f"/api/export/{export_id}/download"
-        }
-    else:
-        return {
-            "export_id": export_id,
-            "status": "processing",
-            "message": "Экспорт все еще обрабатывается"
-        }
-
-def generate_mock_export_data() -> List[Dict]:
-    """Генерация mock данных для экспорта"""
-    return [
-        {
-            "photo_id": f"photo_{i}",
-            "filename": f"building_{i}.jpg",
-            "taken_at": datetime.now().isoformat(),
-            "latitude": 55.7558 + (i * 0.001),
-            "longitude": 37.6173 + (i * 0.001),
-            "building_count": 1,
-            "confidence": 0.85 + (i * 0.01),
-            "address": f"Москва, ул. Примерная, д. {i}",
-            "status": "completed"
-        }
-        for i in range(1, 6)
-    ]
-
-def create_export_file(export_id: str, data: List[Dict], format: str):
-    """Создание файла экспорта"""
+        })
+    elif job["status"] == "failed":
+        status["error"] = job["error_message"]
+    elif job["status"] == "expired":
+        status["error"] = "Файл экспорта удален из кэша: создайте экспорт заново"
+    return status
+
+def parse_export_date(value: Optional[str], end_of_day: bool = False) -> Optional[datetime]:
+    """
+    Дата фильтра в формате ISO 8601. Дата без времени для date_to включает весь день;
+    время без часового пояса считается UTC.
+    """
+    if not value:
+        return None
     try:
-        # Создаем DataFrame
-        df = pd.DataFrame(data)
-        
-        # Создаем Excel файл с несколькими листами
-        file_path = os.path.join(EXPORT_DIR, f"{export_id}.xlsx")
-        
-        with pd.ExcelWriter(file_path, engine='openpyxl') as writer:
-            # Основные данные
-            df.to_excel(writer, sheet_name='Фотографии', index=False)
-            
-            # Статистика
-            stats_data = {
-                'Метрика': ['Всего фото', 'Фото с координатами', 'Успешно обработано', 'Средняя уверенность'],
-                'Значение': [
-                    len(data),
-                    len([d for d in data if d.get('latitude')]),
-                    len([d for d in data if d.get('status') == 'completed']),
-                    df['confidence'].mean() if 'confidence' in df.columns else 0
-                ]
-            }
-            stats_df = pd.DataFrame(stats_data)
-            stats_df.to_excel(writer, sheet_name='Статистика', index=False)
-            
-            # Детекции
-            detections_data = []
-            for item in data:
-                if item.get('building_count', 0) > 0:
-                    detections_data.append({
-                        'photo_id': item['photo_id'],
-                        'building_count': item['building_count'],
-                        'confidence': item.get('confidence', 0),
-                        'address': item.get('address', 'Не определен')
-                    })
-            
-            if detections_data:
-                detections_df = pd.DataFrame(detections_data)
-                detections_df.to_excel(writer, sheet_name='Детекции', index=False)
-        
-        print(f"✅ Файл экспорта создан: {file_path}")
-        
-    except Exception as e:
-        print(f"❌ Ошибка создания файла экспорта: {e}")
+        parsed = datetime.fromisoformat(value)
+    except ValueError:
+        raise HTTPException(400, f"Некорректная дата: {value} (ожидается YYYY-MM-DD или ISO 8601)")
+    if end_of_day and len(value) == 10:
+        parsed = datetime.combine(parsed.date(), time.max)
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+async def parse_since(request: ExportRequest) -> Optional[datetime]:
+    """Нижняя граница инкрементального экспорта: since или водяной знак since_export_id."""
+    if request.since and request.since_export_id:
+        raise HTTPException(400, "Укажите только одно из since и since_export_id")
+    if not request.since_export_id:
+        return parse_export_date(request.since)
+    validate_export_id(request.since_export_id)
+    watermark = await ExportJobRepository(app.state.db_pool).watermark(request.since_export_id)
+    if watermark is None:
+        raise HTTPException(404, f"Завершенный экспорт {request.since_export_id} с водяным знаком не найден")
+    return watermark
+
+async def build_export_query(request: ExportRequest) -> ExportQuery:
+    """Фильтры ExportRequest -> выборка из photo_detection_view."""
+    date_from = parse_export_date(request.date_from)
+    date_to = parse_export_date(request.date_to, end_of_day=True)
+    if date_from and date_to and date_from > date_to:
+        raise HTTPException(400, "date_from позже date_to")
+    if request.include_photos:
+        unknown_variants = [variant for variant in request.photo_variants if variant not in PHOTO_VARIANTS]
+        if unknown_variants or not request.photo_variants:
+            raise HTTPException(400, f"Некорректные photo_variants: {request.photo_variants} (доступны: {', '.join(PHOTO_VARIANTS)})")
+    partition_by = request.partition_by or []
+    if partition_by and request.format != "parquet":
+        raise HTTPException(400, "partition_by поддерживается только для формата parquet")
+    unknown = [key for key in partition_by if key not in PARTITION_KEYS]
+    if unknown or len(set(partition_by)) != len(partition_by):
+        raise HTTPException(400, f"Некорректные ключи partition_by: {partition_by} (доступны: {', '.join(PARTITION_KEYS)})")
+    return ExportQuery(
+        dataset_ids=request.dataset_ids,
+        date_from=date_from,
+        date_to=date_to,
+        include_detections=request.include_detections,
+        include_geocoding=request.include_geocoding,
+        partition_by=partition_by,
+        since=await parse_since(request)
+    )
 
 @app.get("/api/export/formats")
 async def get_export_formats():
     """Получение доступных форматов экспорта"""
     return {
         "formats": [
-            {"value": "xlsx", "label": "Excel (.xlsx)", "description": "Формат Microsoft Excel"},
-            {"value": "csv", "label": "CSV (.csv)", "description": "Текстовый формат с разделителями"},
-            {"value": "json", "label": "JSON (.json)", "description": "JavaScript Object Notation"}
-        ]
+            {"value": "xlsx", "label": "Excel (.xlsx)", "description": "Формат Microsoft Excel", "streaming": False},
+            {"value": "parquet", "label": "Parquet (.parquet)", "description": "Колоночный формат для pandas/DuckDB; partition_by — ZIP с партициями", "streaming": False},
+            {"value": "csv", "label": "CSV (.csv)", "description": "Текстовый формат с разделителями", "streaming": True},
+            {"value": "json", "label": "JSON (.json)", "description": "JavaScript Object Notation", "streaming": True},
+            {"value": "ndjson", "label": "NDJSON (.ndjson)", "description": "JSON Lines: объект на строку", "streaming": True},
+            {"value": "geojson", "label": "GeoJSON (.geojson)", "description": "FeatureCollection с точками зданий", "streaming": True}
+        ],
+        # gzip: true — сжатие .gz для текстовых форматов
+        "gzip": list(ENCODERS),
+        # include_photos: true — ZIP со снимками (photo_variants) и файлом метаданных любого формата
+        "photo_variants": list(PHOTO_VARIANTS)
     }
 
 if __name__ == "__main__":
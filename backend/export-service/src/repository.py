@@ -0,0 +1,396 @@
+import json
+from datetime import datetime
+from typing import Any, AsyncIterator, Dict, List, Optional, Sequence, Tuple
+
+# Чтение строк экспорта из photo_detection_view.
+#
+# Строки читаются курсором на стороне сервера (asyncpg: портал с ограничением числа строк)
+# порциями по chunk_size внутри одной read-only транзакции REPEATABLE READ: в памяти
+# сервиса одновременно находится только текущая порция, а весь экспорт видит один
+# снимок данных. Порядок — (photo_id, detection_id): детекции одного снимка идут подряд.
+# При разбиении на партиции (Parquet) строки сначала сортируются по ключам партиций:
+# каждая партиция приходит одним непрерывным участком.
+#
+# Инкрементальный экспорт (since) выгружает все строки снимков, измененных начиная с водяного
+# знака: photo_metadata.updated_at, geocoding_results.updated_at или новые детекции
+# (detection_results.detected_at). Граница включается: изменения транзакции, начатой ровно
+# в момент водяного знака, не теряются. Множество измененных снимков берется по индексам на этих
+# колонках, поэтому стоимость выборки пропорциональна объему изменений. Удаления не выгружаются.
+
+# (имя колонки в файле, выражение над photo_detection_view v)
+PHOTO_COLUMNS = [
+    ("photo_id", "v.photo_id"),
+    ("photo_uuid", "v.photo_uuid::text"),
+    ("dataset_id", "v.dataset_id"),
+    ("original_filename", "v.original_filename"),
+    ("file_path", "v.file_path"),
+    ("processing_status", "v.processing_status"),
+    ("taken_at", "v.taken_at"),
+    ("photo_lat", "v.photo_lat::float8"),
+    ("photo_lng", "v.photo_lng::float8"),
+    ("updated_at", "v.updated_at"),
+]
+DETECTION_COLUMNS = [
+    ("detection_id", "v.detection_id"),
+    ("object_class", "v.object_class"),
+    ("confidence_score", "v.confidence_score::float8"),
+]
+GEOCODING_COLUMNS = [
+    ("building_lat", "v.building_lat::float8"),
+    ("building_lng", "v.building_lng::float8"),
+    ("formatted_address", "v.formatted_address"),
+    ("city", "v.city"),
+    ("country", "v.country"),
+]
+
+# Ключи партиций: имя -> выражение сортировки (даты съемки — в UTC)
+PARTITION_KEYS = {
+    "dataset_id": "v.dataset_id",
+    "taken_month": "date_trunc('month', v.taken_at AT TIME ZONE 'UTC')",
+    "taken_date": "(v.taken_at AT TIME ZONE 'UTC')::date",
+}
+
+
+class ExportQuery:
+    """SQL и параметры выборки экспорта по фильтрам ExportRequest."""
+
+    def __init__(
+        self,
+        dataset_ids: Optional[Sequence[int]] = None,
+        date_from: Optional[datetime] = None,
+        date_to: Optional[datetime] = None,
+        include_detections: bool = True,
+        include_geocoding: bool = True,
+        partition_by: Optional[Sequence[str]] = None,
+        since: Optional[datetime] = None
+    ):
+        self.dataset_ids = sorted(set(dataset_ids)) if dataset_ids else None
+        self.date_from = date_from
+        self.date_to = date_to
+        self.include_detections = include_detections
+        self.include_geocoding = include_geocoding and include_detections
+        self.partition_by: List[str] = list(partition_by or [])
+        self.since = since
+
+        columns = list(PHOTO_COLUMNS)
+        if self.include_detections:
+            columns += DETECTION_COLUMNS
+        if self.include_geocoding:
+            columns += GEOCODING_COLUMNS
+        self.columns: List[str] = [name for name, _ in columns]
+        self._select = ", ".join(f"{expression} AS {name}" for name, expression in columns)
+
+    def where(self) -> Tuple[str, List[Any]]:
+        """Условие WHERE (даты — по дате съемки taken_at) и его параметры."""
+        conditions: List[str] = []
+        args: List[Any] = []
+        if self.dataset_ids is not None:
+            args.append(self.dataset_ids)
+            conditions.append(f"v.dataset_id = ANY(${len(args)}::int[])")
+        if self.date_from is not None:
+            args.append(self.date_from)
+            conditions.append(f"v.taken_at >= ${len(args)}")
+        if self.date_to is not None:
+            args.append(self.date_to)
+            conditions.append(f"v.taken_at <= ${len(args)}")
+        if self.since is not None:
+            args.append(self.since)
+            since = f"${len(args)}"
+            conditions.append(f"""v.photo_id IN (
+                SELECT pm.id FROM photo_metadata pm WHERE pm.updated_at >= {since}
+                UNION
+                SELECT dr.photo_id FROM geocoding_results gr
+                JOIN detection_results dr ON dr.id = gr.detection_id
+                WHERE gr.updated_at >= {since}
+                UNION
+                SELECT dr.photo_id FROM detection_results dr WHERE dr.detected_at >= {since}
+            )""")
+        return (" AND ".join(conditions) or "TRUE"), args
+
+    def canonical(self) -> Dict[str, Any]:
+        """Параметры выборки в каноническом виде (для ключа дедупликации)."""
+        return {
+            "dataset_ids": self.dataset_ids,
+            "date_from": self.date_from.isoformat() if self.date_from else None,
+            "date_to": self.date_to.isoformat() if self.date_to else None,
+            "include_detections": self.include_detections,
+            "include_geocoding": self.include_geocoding,
+            "partition_by": self.partition_by,
+            "since": self.since.isoformat() if self.since else None,
+        }
+
+    def count_sql(self) -> Tuple[str, List[Any]]:
+        """Число строк, которое вернет sql() (для прогресса экспорта)."""
+        where, args = self.where()
+        counted = "*" if self.include_detections else "DISTINCT v.photo_id"
+        return f"SELECT count({counted}) FROM photo_detection_view v WHERE {where}", args
+
+    def sql(self) -> Tuple[str, List[Any]]:
+        where, args = self.where()
+        # Ключи партиций определяются снимком, поэтому порядок внутри снимка не меняется
+        order = [PARTITION_KEYS[key] for key in self.partition_by] + ["v.photo_id"]
+        if self.include_detections:
+            # Строка на каждую детекцию (снимки без детекций — одной строкой)
+            query = f"""
+                SELECT {self._select}
+                FROM photo_detection_view v
+                WHERE {where}
+                ORDER BY {", ".join(order)}, v.detection_id
+            """
+        else:
+            # Строка на снимок (сортирует PostgreSQL, память сервиса от объема не зависит)
+            query = f"""
+                SELECT DISTINCT ON ({", ".join(order)}) {self._select}
+                FROM photo_detection_view v
+                WHERE {where}
+                ORDER BY {", ".join(order)}
+            """
+        return query, args
+
+
+# Водяной знак снимка данных: изменения с updated_at не позже него видны экспорту.
+# updated_at ставится временем начала транзакции (CURRENT_TIMESTAMP), поэтому транзакции,
+# начатые раньше и еще не завершенные, сдвигают знак назад к своему началу: их изменения
+# попадут в следующий инкрементальный экспорт (возможны повторы строк, но не пропуски).
+WATERMARK_SQL = """
+    SELECT least(now(), min(xact_start))
+    FROM pg_stat_activity
+    WHERE datname = current_database() AND pid <> pg_backend_pid() AND xact_start IS NOT NULL
+"""
+
+# Версия состава датасетов выборки (NULL — все датасеты): число снимков по датасетам из
+# dataset_photo_stats. Меняется при удалении снимков и переносе между датасетами —
+# изменениях, которых не видно по updated_at. Выборка без фильтра по датасетам включает
+# и снимки без датасета: их в dataset_photo_stats нет, число считается по
+# idx_photo_metadata_dataset.
+DATA_VERSION_SQL = """
+    SELECT md5(
+        coalesce(string_agg(dataset_id || ':' || total_photos, ',' ORDER BY dataset_id), '')
+        || CASE WHEN $1::int[] IS NULL
+                THEN ';' || (SELECT count(*) FROM photo_metadata WHERE dataset_id IS NULL)
+                ELSE '' END
+    )
+    FROM dataset_photo_stats
+    WHERE $1::int[] IS NULL OR dataset_id = ANY($1::int[])
+"""
+
+
+class ExportRepository:
+    """Потоковое чтение строк экспорта."""
+
+    def __init__(self, pool):
+        self.pool = pool
+        # Водяной знак и версия состава датасетов снимка, из которого прочитан последний stream()
+        self.watermark: Optional[datetime] = None
+        self.data_version: Optional[str] = None
+
+    async def count(self, query: ExportQuery) -> int:
+        sql, args = query.count_sql()
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(sql, *args)
+
+    async def stream(self, query: ExportQuery, chunk_size: int) -> AsyncIterator[List[Tuple]]:
+        """
+        Порции строк (кортежи в порядке query.columns) по chunk_size.
+        Соединение занято до конца чтения: прерванный обход закрывайте через aclose().
+        """
+        sql, args = query.sql()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                self.watermark = await conn.fetchval(WATERMARK_SQL)
+                self.data_version = await conn.fetchval(DATA_VERSION_SQL, query.dataset_ids)
+                cursor = await conn.cursor(sql, *args)
+                while True:
+                    rows = await cursor.fetch(chunk_size)
+                    if not rows:
+                        return
+                    yield [tuple(row) for row in rows]
+
+    async def unchanged_since(self, query: ExportQuery, watermark: datetime, data_version: str) -> bool:
+        """
+        Данные выборки не менялись с водяного знака готового экспорта: в ее датасетах нет
+        измененных снимков (даты съемки не учитываются — снимок мог выйти из диапазона)
+        и число снимков по датасетам то же. Стоимость пропорциональна объему изменений.
+        """
+        changes = ExportQuery(dataset_ids=query.dataset_ids, include_detections=False, since=watermark)
+        where, args = changes.where()
+        async with self.pool.acquire() as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                if await conn.fetchval(DATA_VERSION_SQL, query.dataset_ids) != data_version:
+                    return False
+                return not await conn.fetchval(
+                    f"SELECT EXISTS (SELECT 1 FROM photo_detection_view v WHERE {where})", *args
+                )
+
+
+# Незавершенное задание того же запроса (не больше одного: уникальный индекс по request_hash)
+IN_FLIGHT_SQL = """
+    SELECT export_uuid::text FROM exports
+    WHERE request_hash = $1 AND status IN ('queued', 'processing')
+"""
+
+
+class ExportJobRepository:
+    """Состояние заданий экспорта в таблице exports."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def create(
+        self,
+        export_id: str,
+        export_name: str,
+        export_format: str,
+        query: ExportQuery,
+        filters: Dict[str, Any],
+        request_hash: str
+    ) -> Tuple[str, bool]:
+        """
+        Новое задание в статусе queued -> (export_id, True). Если такой же запрос уже
+        выполняется -> (id существующего задания, False).
+        """
+        async with self.pool.acquire() as conn:
+            # Повтор: незавершенное задание могло завершиться между INSERT и SELECT
+            for _ in range(3):
+                created = await conn.fetchval("""
+                    INSERT INTO exports (
+                        export_uuid, export_name, export_format, filters_applied,
+                        date_range_start, date_range_end, since_watermark, request_hash, status
+                    )
+                    VALUES ($1, $2, $3, $4::jsonb, $5, $6, $7, $8, 'queued')
+                    ON CONFLICT (request_hash) WHERE status IN ('queued', 'processing') DO NOTHING
+                    RETURNING export_uuid::text
+                """, export_id, export_name, export_format, json.dumps(filters),
+                    query.date_from, query.date_to, query.since, request_hash)
+                if created is not None:
+                    return created, True
+                existing = await conn.fetchval(IN_FLIGHT_SQL, request_hash)
+                if existing is not None:
+                    return existing, False
+        raise RuntimeError("Не удалось создать задание экспорта")
+
+    async def find_in_flight(self, request_hash: str) -> Optional[str]:
+        """id незавершенного (queued / processing) задания того же запроса."""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(IN_FLIGHT_SQL, request_hash)
+
+    async def find_completed(self, request_hash: str) -> Optional[Dict[str, Any]]:
+        """Последний завершенный экспорт того же запроса (кандидат на повторное использование)."""
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT export_uuid::text AS export_id, watermark, data_version FROM exports
+                WHERE request_hash = $1 AND status = 'completed'
+                ORDER BY completed_at DESC LIMIT 1
+            """, request_hash)
+        return dict(row) if row else None
+
+    async def get(self, export_id: str) -> Optional[Dict[str, Any]]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT export_uuid::text AS export_id, export_name, export_format, status,
+                       total_records, exported_records, file_path, file_size, content_hash, error_message,
+                       since_watermark, watermark, created_at, started_at, completed_at, last_accessed_at
+                FROM exports WHERE export_uuid = $1::uuid
+            """, export_id)
+        return dict(row) if row else None
+
+    async def touch(self, export_id: str) -> Optional[str]:
+        """
+        Отмечает обращение к завершенному экспорту (LRU) и возвращает SHA-256 его файла
+        (ETag при скачивании).
+        """
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("""
+                UPDATE exports SET last_accessed_at = now()
+                WHERE export_uuid = $1::uuid AND status = 'completed'
+                RETURNING content_hash
+            """, export_id)
+
+    async def last_accessed(self, export_ids: List[str]) -> Dict[str, datetime]:
+        """Время последнего обращения (или завершения) к завершенным экспортам."""
+        async with self.pool.acquire() as conn:
+            rows = await conn.fetch("""
+                SELECT export_uuid::text AS export_id, coalesce(last_accessed_at, completed_at) AS accessed_at
+                FROM exports WHERE export_uuid = ANY($1::uuid[]) AND status = 'completed'
+            """, export_ids)
+        return {row["export_id"]: row["accessed_at"] for row in rows}
+
+    async def expire(self, export_ids: List[str]) -> None:
+        """Завершенные экспорты, файлы которых вытеснены из кэша."""
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE exports SET status = 'expired'
+                WHERE export_uuid = ANY($1::uuid[]) AND status = 'completed'
+            """, export_ids)
+
+    async def watermark(self, export_id: str) -> Optional[datetime]:
+        """Водяной знак завершенного экспорта (None — нет такого или не завершен)."""
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval("""
+                SELECT watermark FROM exports
+                WHERE export_uuid = $1::uuid AND status = 'completed'
+            """, export_id)
+
+    async def start(self, export_id: str, total_records: int) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE exports SET status = 'processing', total_records = $2, started_at = now()
+                WHERE export_uuid = $1::uuid
+            """, export_id, total_records)
+
+    async def progress(self, export_id: str, exported_records: int) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute(
+                "UPDATE exports SET exported_records = $2 WHERE export_uuid = $1::uuid",
+                export_id, exported_records
+            )
+
+    async def complete(
+        self,
+        export_id: str,
+        file_path: str,
+        file_size: int,
+        content_hash: str,
+        exported_records: int,
+        watermark: Optional[datetime],
+        data_version: Optional[str]
+    ) -> None:
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE exports
+                SET status = 'completed', file_path = $2, file_size = $3, content_hash = $4,
+                    exported_records = $5, watermark = $6, data_version = $7, completed_at = now()
+                WHERE export_uuid = $1::uuid
+            """, export_id, file_path, file_size, content_hash, exported_records, watermark, data_version)
+
+    async def fail(self, export_id: str, error: str) -> None:
+        """Помечает незавершенное задание как failed (завершенное не меняется)."""
+        async with self.pool.acquire() as conn:
+            await conn.execute("""
+                UPDATE exports SET status = 'failed', error_message = $2, completed_at = now()
+                WHERE export_uuid = $1::uuid AND status IN ('queued', 'processing')
+            """, export_id, error[:2000])
+
+    async def fail_unfinished(self, error: str) -> int:
+        """Задания, прерванные остановкой сервиса (вызывается при старте)."""
+        async with self.pool.acquire() as conn:
+            result = await conn.execute("""
+                UPDATE exports SET status = 'failed', error_message = $1, completed_at = now()
+                WHERE status IN ('queued', 'processing')
+            """, error)
+        return int(result.split()[-1])
+
+
+class PhotoRepository:
+    """Файлы снимков из photo_metadata."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def get(self, photo_uuid: str) -> Optional[Dict[str, Any]]:
+        async with self.pool.acquire() as conn:
+            row = await conn.fetchrow("""
+                SELECT original_filename, file_path, file_hash, mime_type
+                FROM photo_metadata WHERE photo_uuid = $1::uuid
+            """, photo_uuid)
+        return dict(row) if row else None
@@ -0,0 +1,577 @@
+import asyncio
+import csv
+import io
+import json
+import os
+import zipfile
+import zlib
+from datetime import date, datetime, timezone
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Sequence, Tuple, Type
+
+import pyarrow as pa
+import pyarrow.parquet as pq
+import xlsxwriter
+
+# Запись экспорта порциями строк.
+#
+# Писатель получает колонки один раз и затем порции строк (кортежи в порядке колонок)
+# по мере чтения курсора; данные экспорта целиком в памяти не собираются. Файл пишется
+# во временный <id>.part.<расширение> и переименовывается только после close():
+# наличие итогового файла означает, что экспорт завершен.
+#
+# Текстовые форматы (CSV, JSON, NDJSON, GeoJSON) построены на кодировщиках строк в байты
+# (RowEncoder): один и тот же кодировщик пишет файл (EncodedExportWriter) или отдает
+# поток чанков в HTTP-ответ (encode_stream), при необходимости со сжатием gzip.
+
+
+class ExportStats:
+    """Сводные показатели экспорта, накапливаемые по мере записи строк."""
+
+    def __init__(self, columns: Sequence[str]):
+        self.index = {name: position for position, name in enumerate(columns)}
+        self.rows = 0
+        self.photos = 0
+        self.photos_with_coords = 0
+        self.completed_photos = 0
+        self.detections = 0
+        self.confidence_total = 0.0
+        # Класс объекта -> [детекций, фото, с геокодированием, сумма уверенности, последний photo_id]
+        self.classes: Dict[str, List[Any]] = {}
+        self._last_photo_id: Optional[int] = None
+
+    def add(self, rows: List[Tuple]) -> None:
+        photo_id, status = self.index["photo_id"], self.index["processing_status"]
+        photo_lat = self.index["photo_lat"]
+        detection_id = self.index.get("detection_id")
+        confidence = self.index.get("confidence_score")
+        object_class = self.index.get("object_class")
+        building_lat = self.index.get("building_lat")
+        for row in rows:
+            self.rows += 1
+            # Строки упорядочены по photo_id: новый снимок — смена photo_id
+            if row[photo_id] != self._last_photo_id:
+                self._last_photo_id = row[photo_id]
+                self.photos += 1
+                self.photos_with_coords += row[photo_lat] is not None
+                self.completed_photos += row[status] == "completed"
+            if detection_id is not None and row[detection_id] is not None:
+                self.detections += 1
+                self.confidence_total += row[confidence]
+
+                totals = self.classes.get(row[object_class])
+                if totals is None:
+                    totals = self.classes[row[object_class]] = [0, 0, 0, 0.0, None]
+                totals[0] += 1
+                if totals[4] != row[photo_id]:
+                    totals[4] = row[photo_id]
+                    totals[1] += 1
+                if building_lat is not None and row[building_lat] is not None:
+                    totals[2] += 1
+                totals[3] += row[confidence]
+
+    def summary(self) -> List[Tuple[str, Any]]:
+        summary = [
+            ("Всего фото", self.photos),
+            ("Фото с координатами", self.photos_with_coords),
+            ("Успешно обработано", self.completed_photos),
+        ]
+        if "detection_id" in self.index:
+            summary += [
+                ("Всего детекций", self.detections),
+                ("Средняя уверенность", round(self.confidence_total / self.detections, 3) if self.detections else 0),
+            ]
+        return summary
+
+    def classes_summary(self) -> Optional[List[Tuple[str, int, int, int, float]]]:
+        """По классам объектов: детекций, фото, с геокодированием, средняя уверенность (None без детекций)."""
+        if "detection_id" not in self.index:
+            return None
+        return [
+            (name, detections, photos, geocoded, round(confidence_total / detections, 3))
+            for name, (detections, photos, geocoded, confidence_total, _) in sorted(
+                self.classes.items(), key=lambda item: -item[1][0]
+            )
+        ]
+
+
+class ExportWriter:
+    """Базовый писатель экспорта."""
+
+    extension = ""
+    media_type = "application/octet-stream"
+
+    def __init__(self, path: str, columns: Sequence[str]):
+        self.path = path
+        directory, name = os.path.split(path)
+        stem, _, extension = name.partition(".")
+        self.temp_path = os.path.join(directory, f"{stem}.part.{extension}")
+        self.columns = list(columns)
+        self.stats = ExportStats(columns)
+
+    def write_rows(self, rows: List[Tuple]) -> None:
+        self.stats.add(rows)
+        self._write_rows(rows)
+
+    def _write_rows(self, rows: List[Tuple]) -> None:
+        raise NotImplementedError
+
+    def close(self) -> None:
+        """Завершает файл и делает его доступным под итоговым именем."""
+        self._close()
+        os.replace(self.temp_path, self.path)
+
+    def _close(self) -> None:
+        raise NotImplementedError
+
+    def _discard(self) -> None:
+        """Освобождает ресурсы без завершения файла."""
+
+    def abort(self) -> None:
+        """Удаляет недописанный файл после ошибки."""
+        try:
+            self._discard()
+        except Exception:
+            pass
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+
+class XlsxExportWriter(ExportWriter):
+    """
+    XLSX через xlsxwriter в режиме constant_memory: каждая строка сразу сбрасывается во
+    временный файл листа, книга в памяти не строится. Листы «Детекции» (по классам
+    объектов) и «Статистика» — накопленные за тот же проход агрегаты, дописываются при close().
+    """
+
+    extension = "xlsx"
+    media_type = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+    DATA_SHEET = "Фотографии"
+    # Предел строк листа Excel: дальше строки продолжаются на листе «Фотографии 2» и т.д.
+    MAX_SHEET_ROWS = 1048576
+
+    def __init__(self, path: str, columns: Sequence[str]):
+        super().__init__(path, columns)
+        # Даты из БД приходят в UTC: часовой пояс отбрасывается (Excel его не хранит)
+        self.workbook = xlsxwriter.Workbook(self.temp_path, {
+            "constant_memory": True,
+            "remove_timezone": True,
+            "default_date_format": "yyyy-mm-dd hh:mm:ss",
+        })
+        self._sheet_index = 0
+        self._row = 0
+        self._sheet = self._new_data_sheet()
+
+    def _new_data_sheet(self):
+        self._sheet_index += 1
+        title = self.DATA_SHEET if self._sheet_index == 1 else f"{self.DATA_SHEET} {self._sheet_index}"
+        sheet = self.workbook.add_worksheet(title)
+        sheet.write_row(0, 0, self.columns)
+        self._row = 1
+        return sheet
+
+    def _write_rows(self, rows: List[Tuple]) -> None:
+        write_row = self._sheet.write_row
+        for row in rows:
+            if self._row >= self.MAX_SHEET_ROWS:
+                self._sheet = self._new_data_sheet()
+                write_row = self._sheet.write_row
+            write_row(self._row, 0, row)
+            self._row += 1
+
+    def _write_table(self, title: str, header: List[str], rows: List[Tuple]) -> None:
+        sheet = self.workbook.add_worksheet(title)
+        sheet.write_row(0, 0, header)
+        for number, row in enumerate(rows, 1):
+            sheet.write_row(number, 0, row)
+
+    def _close(self) -> None:
+        classes = self.stats.classes_summary()
+        if classes is not None:
+            self._write_table(
+                "Детекции",
+                ["Класс объекта", "Детекций", "Фото", "С геокодированием", "Средняя уверенность"],
+                classes
+            )
+        self._write_table("Статистика", ["Метрика", "Значение"], self.stats.summary())
+        self.workbook.close()
+
+    def _discard(self) -> None:
+        self.workbook.close()
+
+
+def json_default(value: Any) -> Any:
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    return str(value)
+
+
+class RowEncoder:
+    """Кодирование порций строк в байты: begin() + encode(rows)... + end()."""
+
+    extension = ""
+    media_type = "application/octet-stream"
+
+    def __init__(self, columns: Sequence[str]):
+        self.columns = list(columns)
+
+    def begin(self) -> bytes:
+        return b""
+
+    def encode(self, rows: List[Tuple]) -> bytes:
+        raise NotImplementedError
+
+    def end(self) -> bytes:
+        return b""
+
+
+class CsvEncoder(RowEncoder):
+    extension = "csv"
+    media_type = "text/csv"  # charset=utf-8 добавляет Starlette
+
+    def begin(self) -> bytes:
+        return self.encode([tuple(self.columns)])
+
+    def encode(self, rows: List[Tuple]) -> bytes:
+        buffer = io.StringIO()
+        csv.writer(buffer, lineterminator="\n").writerows(rows)
+        return buffer.getvalue().encode("utf-8")
+
+
+class NdjsonEncoder(RowEncoder):
+    """JSON Lines: объект на строку."""
+
+    extension = "ndjson"
+    media_type = "application/x-ndjson"
+
+    def __init__(self, columns: Sequence[str]):
+        super().__init__(columns)
+        self.json = json.JSONEncoder(ensure_ascii=False, default=json_default)
+
+    def encode(self, rows: List[Tuple]) -> bytes:
+        columns, encode = self.columns, self.json.encode
+        return "".join(encode(dict(zip(columns, row))) + "\n" for row in rows).encode("utf-8")
+
+
+class JsonEncoder(NdjsonEncoder):
+    """JSON-массив объектов (пишется потоком, как и NDJSON)."""
+
+    extension = "json"
+    media_type = "application/json"
+
+    def __init__(self, columns: Sequence[str]):
+        super().__init__(columns)
+        self._separator = "\n"
+
+    def begin(self) -> bytes:
+        return b"["
+
+    def encode(self, rows: List[Tuple]) -> bytes:
+        if not rows:
+            return b""
+        columns, encode = self.columns, self.json.encode
+        text = self._separator + ",\n".join(encode(dict(zip(columns, row))) for row in rows)
+        self._separator = ",\n"
+        return text.encode("utf-8")
+
+    def end(self) -> bytes:
+        return b"\n]\n"
+
+
+class GeoJsonEncoder(JsonEncoder):
+    """
+    GeoJSON FeatureCollection: точка — координаты здания (геокодирование), иначе
+    координаты снимка из EXIF, иначе geometry = null. Все колонки — в properties.
+    """
+
+    extension = "geojson"
+    media_type = "application/geo+json"
+
+    def __init__(self, columns: Sequence[str]):
+        super().__init__(columns)
+        index = {name: position for position, name in enumerate(self.columns)}
+        self._coordinates = [
+            (index[lat], index[lng])
+            for lat, lng in (("building_lat", "building_lng"), ("photo_lat", "photo_lng"))
+            if lat in index
+        ]
+
+    def begin(self) -> bytes:
+        return b'{"type": "FeatureCollection", "features": ['
+
+    def feature(self, row: Tuple) -> Dict[str, Any]:
+        geometry = None
+        for lat, lng in self._coordinates:
+            if row[lat] is not None and row[lng] is not None:
+                geometry = {"type": "Point", "coordinates": [row[lng], row[lat]]}
+                break
+        return {"type": "Feature", "geometry": geometry, "properties": dict(zip(self.columns, row))}
+
+    def encode(self, rows: List[Tuple]) -> bytes:
+        if not rows:
+            return b""
+        encode = self.json.encode
+        text = self._separator + ",\n".join(encode(self.feature(row)) for row in rows)
+        self._separator = ",\n"
+        return text.encode("utf-8")
+
+    def end(self) -> bytes:
+        return b"\n]}\n"
+
+
+ENCODERS: Dict[str, Type[RowEncoder]] = {
+    encoder.extension: encoder for encoder in (CsvEncoder, JsonEncoder, NdjsonEncoder, GeoJsonEncoder)
+}
+GZIP_MEDIA_TYPE = "application/gzip"
+ZIP_MEDIA_TYPE = "application/zip"
+
+
+class Gzip:
+    """Потоковое сжатие в формат gzip (zlib с заголовком gzip)."""
+
+    def __init__(self, level: int = 6):
+        self._compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+
+    def compress(self, data: bytes) -> bytes:
+        return self._compressor.compress(data)
+
+    def flush(self) -> bytes:
+        return self._compressor.flush()
+
+
+class EncodedExportWriter(ExportWriter):
+    """Файл текстового формата (при compress — .gz) из кодировщика RowEncoder."""
+
+    def __init__(self, path: str, columns: Sequence[str], encoder: RowEncoder, compress: bool = False):
+        super().__init__(path, columns)
+        self.encoder = encoder
+        self.gzip = Gzip() if compress else None
+        self.file = open(self.temp_path, "wb")
+        self._write(encoder.begin())
+
+    def _write(self, data: bytes) -> None:
+        if self.gzip is not None:
+            data = self.gzip.compress(data)
+        if data:
+            self.file.write(data)
+
+    def _write_rows(self, rows: List[Tuple]) -> None:
+        self._write(self.encoder.encode(rows))
+
+    def _close(self) -> None:
+        self._write(self.encoder.end())
+        if self.gzip is not None:
+            self.file.write(self.gzip.flush())
+        self.file.close()
+
+    def _discard(self) -> None:
+        self.file.close()
+
+
+# Типы колонок Parquet (остальные — строки); категории — словарные
+PARQUET_CATEGORY = pa.dictionary(pa.int32(), pa.string())
+PARQUET_TYPES = {
+    "photo_id": pa.int64(),
+    "dataset_id": pa.int32(),
+    "processing_status": PARQUET_CATEGORY,
+    "taken_at": pa.timestamp("us", tz="UTC"),
+    "photo_lat": pa.float64(),
+    "photo_lng": pa.float64(),
+    "updated_at": pa.timestamp("us", tz="UTC"),
+    "detection_id": pa.int64(),
+    "object_class": PARQUET_CATEGORY,
+    "confidence_score": pa.float64(),
+    "building_lat": pa.float64(),
+    "building_lng": pa.float64(),
+    "city": PARQUET_CATEGORY,
+    "country": PARQUET_CATEGORY,
+}
+# Ключи партиций по дате съемки (UTC) -> формат значения в пути
+PARTITION_DATE_FORMATS = {"taken_date": "%Y-%m-%d", "taken_month": "%Y-%m"}
+# Значение ключа NULL (соглашение Hive, понимают pyarrow, pandas и DuckDB)
+PARTITION_NULL = "__HIVE_DEFAULT_PARTITION__"
+
+
+class ParquetExportWriter(ExportWriter):
+    """
+    Parquet (pyarrow): каждая порция курсора превращается в RecordBatch, батчи копятся
+    до ROW_GROUP_ROWS строк и записываются одной группой строк.
+
+    С partition_by результат — ZIP без сжатия в раскладке Hive
+    (dataset_id=1/taken_date=2024-01-01/part-0.parquet). Строки приходят отсортированными
+    по ключам партиций (ExportQuery.partition_by), поэтому в работе всегда один файл партиции.
+    """
+
+    extension = "parquet"
+    media_type = "application/vnd.apache.parquet"
+    ROW_GROUP_ROWS = 128 * 1024
+    COMPRESSION = "zstd"
+
+    def __init__(self, path: str, columns: Sequence[str], partition_by: Optional[Sequence[str]] = None):
+        super().__init__(path, columns)
+        self.partition_by = list(partition_by or [])
+        index = {name: position for position, name in enumerate(self.columns)}
+        self._partition_values = [self._partition_value(key, index) for key in self.partition_by]
+        # Значения ключей-колонок хранятся в пути партиции, а не в файле
+        self._file_columns = [position for position, name in enumerate(self.columns) if name not in self.partition_by]
+        self.schema = pa.schema([
+            pa.field(self.columns[position], PARQUET_TYPES.get(self.columns[position], pa.string()))
+            for position in self._file_columns
+        ])
+        self.archive = zipfile.ZipFile(self.temp_path, "w", zipfile.ZIP_STORED) if self.partition_by else None
+        self.partitions = 0
+        self._partition: Optional[Tuple] = None
+        self._file: Optional[pq.ParquetWriter] = None
+        self._batches: List[pa.RecordBatch] = []
+        self._pending_rows = 0
+        if self.archive is None:
+            self._file = pq.ParquetWriter(self.temp_path, self.schema, compression=self.COMPRESSION)
+
+    @staticmethod
+    def _partition_value(key: str, index: Dict[str, int]) -> Callable[[Tuple], Any]:
+        if key in PARTITION_DATE_FORMATS:
+            position, date_format = index["taken_at"], PARTITION_DATE_FORMATS[key]
+            return lambda row: row[position].astimezone(timezone.utc).strftime(date_format) if row[position] else None
+        position = index[key]
+        return lambda row: row[position]
+
+    @property
+    def _partition_file(self) -> str:
+        return f"{self.temp_path}.partition"
+
+    def _batch(self, rows: List[Tuple]) -> pa.RecordBatch:
+        values = list(zip(*rows))
+        arrays = []
+        for position, field in zip(self._file_columns, self.schema):
+            if pa.types.is_dictionary(field.type):
+                arrays.append(pa.array(values[position], pa.string()).dictionary_encode())
+            else:
+                arrays.append(pa.array(values[position], field.type))
+        return pa.RecordBatch.from_arrays(arrays, schema=self.schema)
+
+    def _flush(self) -> None:
+        if self._batches:
+            self._file.write_table(pa.Table.from_batches(self._batches), row_group_size=self._pending_rows)
+            self._batches, self._pending_rows = [], 0
+
+    def _append(self, rows: List[Tuple]) -> None:
+        self._batches.append(self._batch(rows))
+        self._pending_rows += len(rows)
+        if self._pending_rows >= self.ROW_GROUP_ROWS:
+            self._flush()
+
+    def _finish_partition(self) -> None:
+        if self._file is None:
+            return
+        self._flush()
+        self._file.close()
+        self._file = None
+        path = "/".join(
+            f"{key}={PARTITION_NULL if value is None else value}"
+            for key, value in zip(self.partition_by, self._partition)
+        )
+        self.archive.write(self._partition_file, f"{path}/part-0.parquet")
+        os.remove(self._partition_file)
+
+    def _write_rows(self, rows: List[Tuple]) -> None:
+        if self.archive is None:
+            self._append(rows)
+            return
+        # Порция может захватить границу партиций: режем на непрерывные участки
+        start = 0
+        for position, row in enumerate(rows):
+            partition = tuple(value(row) for value in self._partition_values)
+            if partition != self._partition:
+                if position > start:
+                    self._append(rows[start:position])
+                self._finish_partition()
+                self._partition = partition
+                self._file = pq.ParquetWriter(self._partition_file, self.schema, compression=self.COMPRESSION)
+                self.partitions += 1
+                start = position
+        if start < len(rows):
+            self._append(rows[start:])
+
+    def _close(self) -> None:
+        if self.archive is None:
+            self._flush()
+            self._file.close()
+            return
+        self._finish_partition()
+        self.archive.close()
+
+    def _discard(self) -> None:
+        if self._file is not None:
+            self._file.close()
+        if self.archive is not None:
+            self.archive.close()
+            if os.path.exists(self._partition_file):
+                os.remove(self._partition_file)
+
+
+FILE_FORMATS = ["xlsx", "parquet", *ENCODERS]
+
+
+def export_file_name(export_id: str, export_format: str, compress: bool = False, partitioned: bool = False) -> str:
+    # XLSX и Parquet сжаты сами: gzip применяется только к текстовым форматам
+    if export_format == "parquet" and partitioned:
+        return f"{export_id}.parquet.zip"
+    compress = compress and export_format in ENCODERS
+    return f"{export_id}.{export_format}{'.gz' if compress else ''}"
+
+
+def media_type_for(file_name: str) -> str:
+    """MIME-тип файла экспорта по его имени."""
+    if file_name.endswith(".gz"):
+        return GZIP_MEDIA_TYPE
+    extension = file_name.rsplit(".", 1)[-1]
+    if extension == "zip":
+        return ZIP_MEDIA_TYPE
+    for writer in (XlsxExportWriter, ParquetExportWriter):
+        if extension == writer.extension:
+            return writer.media_type
+    encoder = ENCODERS.get(extension)
+    return encoder.media_type if encoder else "application/octet-stream"
+
+
+def create_writer(
+    path: str,
+    export_format: str,
+    columns: Sequence[str],
+    compress: bool = False,
+    partition_by: Optional[Sequence[str]] = None
+) -> ExportWriter:
+    if export_format == "xlsx":
+        return XlsxExportWriter(path, columns)
+    if export_format == "parquet":
+        return ParquetExportWriter(path, columns, partition_by)
+    return EncodedExportWriter(path, columns, ENCODERS[export_format](columns), compress)
+
+
+async def encode_stream(
+    encoder: RowEncoder,
+    chunks: AsyncIterator[List[Tuple]],
+    compress: bool = False
+) -> AsyncIterator[bytes]:
+    """
+    Байты ответа из порций строк курсора. Кодирование и сжатие порции — в потоке,
+    чтобы не блокировать event loop. При отключении клиента чтение курсора прекращается.
+    """
+    gzip = Gzip() if compress else None
+
+    def encode(data: bytes) -> bytes:
+        return gzip.compress(data) if gzip is not None else data
+
+    def encode_rows(rows: List[Tuple]) -> bytes:
+        return encode(encoder.encode(rows))
+
+    try:
+        yield encode(encoder.begin())
+        async for rows in chunks:
+            data = await asyncio.to_thread(encode_rows, rows)
+            if data:
+                yield data
+        data = encode(encoder.end())
+        yield data + gzip.flush() if gzip is not None else data
+    finally:
+        await chunks.aclose()
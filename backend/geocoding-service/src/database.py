@@ -0,0 +1,45 @@
+import os
+from typing import Optional
+
+try:
+    import asyncpg
+except ImportError:  # сервис работает и без БД: недоступны только запросы к сохраненным результатам
+    asyncpg = None
+
+# Строка подключения к PostgreSQL (см. .env.example)
+DATABASE_URL = os.getenv("DATABASE_URL")
+DB_POOL_MIN_SIZE = int(os.getenv("DB_POOL_MIN_SIZE", 1))
+DB_POOL_MAX_SIZE = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+DB_COMMAND_TIMEOUT = float(os.getenv("DB_COMMAND_TIMEOUT", 30))
+
+
+async def create_pool() -> Optional["asyncpg.Pool"]:
+    """
+    Пул соединений asyncpg. Соединения открываются один раз при старте сервиса
+    и переиспользуются запросами. None, если БД не настроена или недоступна.
+    """
+    if not DATABASE_URL:
+        print("⚠️ Переменная DATABASE_URL не установлена. Запросы к сохраненным результатам недоступны.")
+        return None
+    if asyncpg is None:
+        print("❌ Пакет asyncpg недоступен. Запросы к сохраненным результатам недоступны.")
+        return None
+
+    try:
+        pool = await asyncpg.create_pool(
+            DATABASE_URL,
+            min_size=DB_POOL_MIN_SIZE,
+            max_size=DB_POOL_MAX_SIZE,
+            command_timeout=DB_COMMAND_TIMEOUT,
+        )
+    except Exception as e:
+        print(f"❌ Не удалось подключиться к БД: {e}. Запросы к сохраненным результатам недоступны.")
+        return None
+
+    print(f"✅ Пул соединений с БД создан (min={DB_POOL_MIN_SIZE}, max={DB_POOL_MAX_SIZE})")
+    return pool
+
+
+async def close_pool(pool: Optional["asyncpg.Pool"]) -> None:
+    if pool is not None:
+        await pool.close()
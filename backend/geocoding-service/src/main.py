@@ -1,9 +1,10 @@
 from fastapi import FastAPI, HTTPException, Query
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel
-from typing import Optional, List, Dict, Protocol, Any, Type, cast
+from typing import Optional, List, Dict, Protocol, Any, Tuple, cast
 import httpx 
 import os
+import asyncio
 from PIL import Image
 from PIL.ExifTags import TAGS
 from contextlib import asynccontextmanager 
@@ -16,6 +17,7 @@ class IBuildingGeolocator(Protocol):
     """Интерфейс, определяющий ожидаемые методы для ML-обработчика геокодирования."""
     def __init__(self, model_path: Optional[str]): ...
     def predict_coordinates(self, image: Image.Image, building_bbox: List[float]) -> Dict: ...
+    def predict_coordinates_batch(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Dict]: ...
 
 # ----------------------------------------------------\
 # 2. Устойчивый импорт ML-модуля и определение заглушки
@@ -25,8 +27,14 @@ class IBuildingGeolocator(Protocol):
 # Обратите внимание, что они должны быть в папке providers/
 from providers.openstreetmap import OpenStreetMapProvider
 from providers.geonames import GeoNamesProvider
-
-ML_GEOLOCATOR_CLASS: Type[IBuildingGeolocator]
+from providers.governance import UpstreamGovernor, UpstreamUnavailableError
+from providers.geolocator_loader import GeolocatorLoader
+from providers.spatial_prior import SpatialPrior, SpatialPriorIndex
+from database import create_pool, close_pool
+from repository import GeocodingResultsRepository, ResultsQueryTimeout
+from timing import TimingRecorder, install_timing, httpx_event_hooks
+from metrics import CacheMetrics, InferenceMetrics, install_metrics
+from utils.image_regions import apply_draft
 
 class StubBuildingGeolocator:
     """Заглушка для ML-геолокатора."""
@@ -40,50 +48,71 @@ class StubBuildingGeolocator:
             "confidence": 0.5,
             "method": "ml_stub"
         }
+    def predict_coordinates_batch(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Dict]:
+        return [self.predict_coordinates(image, bbox) for image, bbox in items]
 
 ML_MODEL_PATH = os.getenv("ML_MODEL_PATH")
-ML_GEOLOCATOR_AVAILABLE = False
-
-try:
-    # Если ML-модуль доступен, импортируем его под алиасом RealBuildingGeolocator
-    from providers.bulding_geolocation import BuildingGeolocator as RealBuildingGeolocator
-    ML_GEOLOCATOR_CLASS = RealBuildingGeolocator
-    if ML_MODEL_PATH:
-        ML_GEOLOCATOR_AVAILABLE = True
-        print(f"✅ ML-геолокатор загружен по пути: {ML_MODEL_PATH}")
-    else:
-        ML_GEOLOCATOR_CLASS = StubBuildingGeolocator
-        print("⚠️ Переменная ML_MODEL_PATH не установлена. Используется заглушка ML_GEOLOCATOR_CLASS.")
-        
-except ImportError as e:
-    ML_GEOLOCATOR_CLASS = StubBuildingGeolocator
-    print(f"❌ ML-зависимости (Torch/Torchvision) недоступны ({e}). Используется заглушка ML_GEOLOCATOR_CLASS.")
-except Exception as e:
-    ML_GEOLOCATOR_CLASS = StubBuildingGeolocator
-    print(f"❌ Ошибка инициализации ML-геолокатора: {e}. Используется заглушка ML_GEOLOCATOR_CLASS.")
-finally:
-    # Инициализация заглушки или реального класса
-    # Присваиваем объект глобальной переменной для использования в эндпоинтах
-    ml_geolocator = ML_GEOLOCATOR_CLASS(ML_MODEL_PATH)
+# worker: модель в отдельном процессе инференса; inprocess: в процессе HTTP-сервера
+# retrieval: поиск похожих зданий по индексу эмбеддингов (scripts/build_embedding_index.py)
+ML_INFERENCE_MODE = os.getenv("ML_INFERENCE_MODE", "worker")
+ML_INDEX_PATH = os.getenv("ML_INDEX_PATH")
+
+# ML-стек (torch, torchvision, веса) не импортируется при старте:
+# модель загружается в фоне после запуска HTTP-сервера, до этого работает заглушка.
+# Используйте ml_loader.geolocator для предсказаний и ml_loader.available для проверки готовности.
+ml_loader = GeolocatorLoader(
+    ML_INDEX_PATH if ML_INFERENCE_MODE == "retrieval" else ML_MODEL_PATH,
+    ML_INFERENCE_MODE,
+    StubBuildingGeolocator(ML_MODEL_PATH)
+)
 
 
 # --- УПРАВЛЕНИЕ ЖИЗНЕННЫМ ЦИКЛОМ HTTPX КЛИЕНТА ---
 # Используем lifespan для инициализации httpx.AsyncClient и провайдеров.
 @asynccontextmanager
 async def lifespan(app: FastAPI):
+    # Фоновая загрузка ML-геолокатора: сервис отвечает на запросы (с заглушкой) сразу
+    app.state.ml_loading_task = asyncio.create_task(asyncio.to_thread(ml_loader.load))
+
     # Инициализация клиента при запуске
-    app.state.http_client = httpx.AsyncClient()
+    app.state.http_client = httpx.AsyncClient(event_hooks=httpx_event_hooks(timings))
+    
+    # Лимиты запросов к внешним сервисам (переопределяются переменными OSM_* / GEONAMES_*)
+    # Политика Nominatim: не более 1 запроса в секунду
+    app.state.osm_governor = UpstreamGovernor.from_env(
+        "openstreetmap", "OSM", rate_per_sec=1.0, burst=1.0
+    )
+    app.state.geonames_governor = UpstreamGovernor.from_env(
+        "geonames", "GEONAMES", rate_per_sec=2.0, burst=5.0
+    )
     
     # Инициализация провайдеров с клиентом
-    app.state.osm_provider = OpenStreetMapProvider(client=app.state.http_client)
+    app.state.osm_provider = OpenStreetMapProvider(
+        client=app.state.http_client,
+        governor=app.state.osm_governor
+    )
     app.state.geonames_provider = GeoNamesProvider(
         username=os.getenv("GEONAMES_USERNAME", "demo"),
-        client=app.state.http_client
+        client=app.state.http_client,
+        governor=app.state.geonames_governor
+    )
+    
+    # БД с сохраненными результатами (пространственные запросы)
+    app.state.db_pool = await create_pool()
+    app.state.results_repository = (
+        GeocodingResultsRepository(app.state.db_pool, RESULTS_QUERY_TIMEOUT_MS) if app.state.db_pool else None
     )
+    timings.start(app.state.db_pool)
     
     yield
     # Закрытие клиента при завершении работы
     await app.state.http_client.aclose()
+    await timings.stop()
+    await close_pool(app.state.db_pool)
+    # Остановка процесса инференса (если используется)
+    if not app.state.ml_loading_task.done():
+        await app.state.ml_loading_task
+    ml_loader.close()
 
 
 app = FastAPI(
@@ -101,15 +130,46 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Замеры этапов и X-Request-ID (см. timing.py)
+timings = TimingRecorder("geocoding-service")
+install_timing(app, timings)
+# Метрики Prometheus: /metrics (провайдеры — в UpstreamGovernor)
+install_metrics(app)
+geolocator_metrics = InferenceMetrics("building_geolocator")
+image_cache_metrics = CacheMetrics("building_image")
+
 # Конфигурация хранения (путь к общему хранилищу)
 UPLOAD_DIR_BASE = os.getenv("UPLOAD_DIR_BASE", "storage/uploaded_photos/raw") 
 
+# Максимальный размер пакета для одного forward-прохода ML-модели
+ML_MAX_BATCH_SIZE = int(os.getenv("ML_MAX_BATCH_SIZE", 16))
+# Сколько зданий пакета одновременно проходят обратное геокодирование
+# (лимиты самих провайдеров соблюдает UpstreamGovernor)
+GEOCODE_ENRICH_CONCURRENCY = int(os.getenv("GEOCODE_ENRICH_CONCURRENCY", 8))
+
+# Ограничения пространственных запросов к сохраненным результатам
+MAX_PAGE_SIZE = int(os.getenv("GEOCODING_RESULTS_MAX_PAGE_SIZE", 1000))
+MAX_RADIUS_M = float(os.getenv("GEOCODING_RESULTS_MAX_RADIUS_M", 50000))
+# Глубина выдачи (строк от начала) и лимит времени на страницу: страница на глубине N
+# стоит O(N), дальше нужно уточнить окно или радиус (см. repository.py)
+MAX_RESULTS_DEPTH = int(os.getenv("GEOCODING_RESULTS_MAX_DEPTH", 10000))
+RESULTS_QUERY_TIMEOUT_MS = int(os.getenv("GEOCODING_RESULTS_QUERY_TIMEOUT_MS", 2000))
+
+# Априор по камерам/датасетам (scripts/build_spatial_prior.py): если источник снимка
+# знает свое положение точнее SPATIAL_PRIOR_MAX_SPREAD_M, ML-модель не вызывается
+SPATIAL_PRIOR_PATH = os.getenv("SPATIAL_PRIOR_PATH", "storage/spatial_prior.json")
+SPATIAL_PRIOR_MAX_SPREAD_M = float(os.getenv("SPATIAL_PRIOR_MAX_SPREAD_M", 150))
+spatial_prior = SpatialPriorIndex.load(SPATIAL_PRIOR_PATH)
+
 
 # --- МОДЕЛИ ДАННЫХ ---
 class BuildingGeocodingRequest(BaseModel):
     file_id: str
     # 🌟 ИСПРАВЛЕНИЕ: Используем Any, чтобы принять List[int], List[float] или что-либо другое
     building_bbox: Optional[List[Any]] = None
+    # Источник снимка (камера из Excel-импорта / датасет) для пространственного априора
+    camera_id: Optional[str] = None
+    dataset_id: Optional[int] = None
     
 # --- ВСПОМОГАТЕЛЬНЫЕ ФУНКЦИИ ---
 
@@ -143,8 +203,93 @@ def get_exif_geolocation(image: Image.Image) -> Optional[Dict[str, float]]:
 @app.get("/health")
 async def health_check():
     """Проверка работоспособности сервиса."""
-    ml_status = "available" if ML_GEOLOCATOR_AVAILABLE else "stub"
-    return {"status": "healthy", "service": "geocoding", "ml_geolocator": ml_status}
+    # Сервис здоров сразу после старта; готовность ML-модели сообщается отдельно
+    ml_health = ml_loader.health()
+    return {
+        "status": "healthy",
+        "service": "geocoding",
+        "ml_geolocator": ml_health["status"],
+        "ml_ready": ml_health["ready"],
+        "ml": ml_health
+    }
+
+@app.get("/api/timings")
+async def timing_stats():
+    """Длительность этапов (геолокация, вызовы провайдеров) и состояние записи в processing_history."""
+    return timings.snapshot()
+
+@app.get("/api/providers/stats")
+async def providers_stats():
+    """Статистика запросов к внешним провайдерам: задержки, повторы, отказы."""
+    return {
+        "openstreetmap": app.state.osm_governor.snapshot(),
+        "geonames": app.state.geonames_governor.snapshot()
+    }
+
+def results_repository() -> GeocodingResultsRepository:
+    if app.state.results_repository is None:
+        raise HTTPException(503, "База данных недоступна")
+    return app.state.results_repository
+
+
+def parse_results_cursor(cursor: Optional[str]) -> Tuple[float, int, int]:
+    """
+    Курсор next_cursor вида "<расстояние>:<id>:<глубина>" -> ключ последней строки
+    предыдущей страницы и число уже выданных строк.
+    """
+    if not cursor:
+        return (-1.0, 0, 0)
+    try:
+        distance, last_id, depth = cursor.split(":")
+        after = (float(distance), int(last_id), int(depth))
+    except ValueError:
+        raise HTTPException(400, f"Некорректный курсор: {cursor}")
+    if after[2] >= MAX_RESULTS_DEPTH:
+        raise HTTPException(
+            400, f"Выдача ограничена первыми {MAX_RESULTS_DEPTH} строками: уточните окно карты или радиус"
+        )
+    return after
+
+
+@app.get("/api/geocoding-results/viewport")
+async def geocoding_results_in_viewport(
+    min_lat: float = Query(..., ge=-90, le=90),
+    min_lng: float = Query(..., ge=-180, le=180),
+    max_lat: float = Query(..., ge=-90, le=90),
+    max_lng: float = Query(..., ge=-180, le=180),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Геокодированные здания в окне карты, от центра к краям (постранично, курсор из next_cursor)."""
+    if min_lat > max_lat or min_lng > max_lng:
+        raise HTTPException(400, "Некорректное окно: min_lat/min_lng должны быть не больше max_lat/max_lng")
+
+    try:
+        items, next_cursor = await results_repository().in_viewport(
+            min_lat, min_lng, max_lat, max_lng, limit, parse_results_cursor(cursor)
+        )
+    except ResultsQueryTimeout as e:
+        raise HTTPException(503, f"{e}: уточните окно карты")
+    return {"results": items, "count": len(items), "next_cursor": next_cursor}
+
+
+@app.get("/api/geocoding-results/nearby")
+async def geocoding_results_nearby(
+    lat: float = Query(..., ge=-90, le=90),
+    lng: float = Query(..., ge=-180, le=180),
+    radius_m: float = Query(..., gt=0, le=MAX_RADIUS_M),
+    limit: int = Query(100, ge=1, le=MAX_PAGE_SIZE),
+    cursor: Optional[str] = None
+):
+    """Геокодированные здания в радиусе radius_m метров, от ближайших (постранично)."""
+    try:
+        items, next_cursor = await results_repository().within_radius(
+            lat, lng, radius_m, limit, parse_results_cursor(cursor)
+        )
+    except ResultsQueryTimeout as e:
+        raise HTTPException(503, f"{e}: уточните радиус")
+    return {"results": items, "count": len(items), "next_cursor": next_cursor}
+
 
 @app.post("/api/reverse-geocode")
 async def reverse_geocode_endpoint(lat: float = Query(...), lon: float = Query(...)):
@@ -173,6 +318,8 @@ async def reverse_geocode_endpoint(lat: float = Query(...), lon: float = Query(.
                 }
             }
         }
+    except UpstreamUnavailableError as e:
+        raise HTTPException(status_code=503, detail=f"Внешний сервис временно недоступен: {str(e)}")
     except httpx.HTTPError as e:
         # ИСПРАВЛЕНИЕ: Используем getattr() для безопасного доступа к атрибуту 'response'
         # Это устраняет предупреждение Pylance о том, что атрибут может быть неизвестен.
@@ -183,140 +330,279 @@ async def reverse_geocode_endpoint(lat: float = Query(...), lon: float = Query(.
         raise HTTPException(status_code=500, detail=f"Ошибка обратного геокодирования: {str(e)}")
 
 
-@app.post("/api/geocode-building")
-async def geocode_building(request: BuildingGeocodingRequest):
+def open_building_image(file_id: str) -> Image.Image:
+    """Открывает снимок из общего хранилища (декодирование откладывается до первого обращения к пикселям)."""
+    image_path = os.path.join(UPLOAD_DIR_BASE, file_id)
+    if not os.path.exists(image_path):
+        raise HTTPException(status_code=404, detail=f"Файл '{file_id}' не найден в хранилище.")
+    return Image.open(image_path)
+
+
+def has_building_bbox(request: BuildingGeocodingRequest) -> bool:
+    # 🌟 УСИЛЕННАЯ ПРОВЕРКА: Проверяем, что это список и он не пуст
+    return isinstance(request.building_bbox, list) and len(request.building_bbox) > 0
+
+
+def lookup_prior(request: BuildingGeocodingRequest) -> Optional[SpatialPrior]:
+    return spatial_prior.lookup(request.camera_id, request.dataset_id)
+
+
+def is_tight_prior(prior: Optional[SpatialPrior]) -> bool:
+    """Источник снимка сам по себе определяет положение достаточно точно."""
+    return prior is not None and prior.spread_m <= SPATIAL_PRIOR_MAX_SPREAD_M
+
+
+def prior_location(prior: SpatialPrior, note: str) -> Dict[str, Any]:
+    """Координаты по априору: центр известных позиций источника."""
+    return {
+        "latitude": prior.center[0],
+        "longitude": prior.center[1],
+        # 1.0 для неподвижной камеры, 0.5 на границе SPATIAL_PRIOR_MAX_SPREAD_M
+        "confidence": SPATIAL_PRIOR_MAX_SPREAD_M / (SPATIAL_PRIOR_MAX_SPREAD_M + prior.spread_m),
+        "method": "spatial_prior",
+        "note": f"{note} ({prior.source}, {prior.count} снимков, разброс {prior.spread_m:.0f} м)."
+    }
+
+
+def locate_building(
+    request: BuildingGeocodingRequest,
+    image: Image.Image,
+    ml_prediction: Optional[Dict] = None
+) -> Dict[str, Any]:
     """
-    Геокодирование здания: сначала ML, потом обратное геокодирование.
+    Определение координат здания: априор источника / BBOX (ML) -> EXIF -> априор / заглушка.
+    ml_prediction передается, если предсказание уже получено пакетно.
     """
-    osm_provider = app.state.osm_provider
-    geonames_provider = app.state.geonames_provider
+    prior = lookup_prior(request)
 
-    image_path = os.path.join(UPLOAD_DIR_BASE, request.file_id)
-    if not os.path.exists(image_path):
-        raise HTTPException(status_code=404, detail=f"Файл '{request.file_id}' не найден в хранилище.")
-    
-    try:
-        image = Image.open(image_path)
-        
-        # 🌟 ДИАГНОСТИКА: Выводим полученный BBOX
-        print(f"🔄 Geocoding: Полученный BBOX: {request.building_bbox} (Тип: {type(request.building_bbox)})") 
-        
-        ml_lat: float
-        ml_lng: float
-        ml_confidence: float
-        note: str
-        method: str
-        
-        # 🌟 УСИЛЕННАЯ ПРОВЕРКА: Проверяем, что это список и он не пуст
-        bbox_is_present = isinstance(request.building_bbox, list) and len(request.building_bbox) > 0
-        exif_coords = get_exif_geolocation(image)
+    # --- 1. ПРИОРИТЕТ 1: BBOX присутствует (от CV) ---
+    if has_building_bbox(request):
+        # Камера/датасет уже точно определяют положение: ML не нужен
+        if is_tight_prior(prior):
+            return prior_location(cast(SpatialPrior, prior), "Координаты определены по известному положению источника снимка")
 
-        # --- 1. ПРИОРИТЕТ 1: BBOX присутствует (от CV) ---
-        if bbox_is_present:
-            
+        if ml_prediction is None:
             # 🌟 ИСПРАВЛЕНИЕ ТИПИЗАЦИИ: Явно приводим тип к List[float] для ML-модели
             # Мы уверены, что это список, и его элементы будут конвертированы в float в ML-коде
             valid_bbox: List[float] = cast(List[float], request.building_bbox) 
-            
-            # --- 1a. Использование реального ML-модуля ---
-            if ML_GEOLOCATOR_AVAILABLE:
-                ml_prediction = ml_geolocator.predict_coordinates(image, valid_bbox)
-                ml_lat = ml_prediction["coordinates"]["latitude"]
-                ml_lng = ml_prediction["coordinates"]["longitude"]
-                ml_confidence = ml_prediction["confidence"]
-                
-                note = "Координаты получены с помощью ML-модели на основе BBOX."
-                method = "ml_geolocation"
-            
-            # --- 1b. Использование ML-заглушки (если BBOX есть, но ML недоступен) ---
-            else:
-                ml_prediction = ml_geolocator.predict_coordinates(image, valid_bbox)
-                ml_lat = ml_prediction["coordinates"]["latitude"]
-                ml_lng = ml_prediction["coordinates"]["longitude"]
-                ml_confidence = ml_prediction["confidence"]
-                
-                # 🌟 КОРРЕКТНАЯ NOTE
-                note = "BBOX присутствует. Использована заглушка ML-геолокатора." 
-                method = "ml_stub"
-        
-        # --- 2. ПРИОРИТЕТ 2: BBOX отсутствует, но есть EXIF ---
-        elif exif_coords:
-            ml_lat = exif_coords["latitude"]
-            ml_lng = exif_coords["longitude"]
-            ml_confidence = 1.0 
-            
-            note = "BBOX отсутствует. Координаты получены из EXIF данных изображения."
-            method = "exif_geolocation"
-            
-        # --- 3. ПРИОРИТЕТ 3: Ни BBOX, ни EXIF ---
+            geolocator_metrics.observe_batch(1)
+            geolocator_metrics.in_flight.inc()
+            try:
+                with timings.stage("geolocation", buildings=1):
+                    ml_prediction = ml_loader.geolocator.predict_coordinates(image, valid_bbox)
+            finally:
+                geolocator_metrics.in_flight.dec()
+
+        # --- 1a. Использование реального ML-модуля ---
+        # (решение по самому предсказанию: модель могла загрузиться во время запроса)
+        if ml_prediction.get("method") == "ml_retrieval":
+            note = "Координаты получены по наиболее похожим зданиям архива с известным GPS."
+            method = "ml_retrieval"
+        elif ml_prediction.get("method") != "ml_stub":
+            note = "Координаты получены с помощью ML-модели на основе BBOX."
+            method = "ml_geolocation"
+        # --- 1b. Использование ML-заглушки (если BBOX есть, но ML недоступен) ---
+        elif prior is not None:
+            return prior_location(prior, "BBOX присутствует, ML-геолокатор недоступен. Использован априор источника снимка")
         else:
-            # Используем ML-заглушку с нулевым BBOX, как запасной вариант
-            stub_prediction = ml_geolocator.predict_coordinates(image, [0.0, 0.0, 0.0, 0.0]) 
-            ml_lat = stub_prediction["coordinates"]["latitude"]
-            ml_lng = stub_prediction["coordinates"]["longitude"]
-            ml_confidence = stub_prediction["confidence"]
-            
-            note = "BBOX и EXIF отсутствуют. Использована заглушка ML-геолокатора."
+            # 🌟 КОРРЕКТНАЯ NOTE
+            note = "BBOX присутствует. Использована заглушка ML-геолокатора." 
             method = "ml_stub"
-        
-        # 4. Обратное геокодирование: прямые асинхронные вызовы провайдеров
-        osm_result = await osm_provider.reverse(ml_lat, ml_lng) 
-        address = osm_result.get("display_name", "Адрес не найден")
-        
-        timezone_info = await geonames_provider.get_timezone(ml_lat, ml_lng)
-        elevation = await geonames_provider.get_elevation(ml_lat, ml_lng)
-        
+
+        latitude = ml_prediction["coordinates"]["latitude"]
+        longitude = ml_prediction["coordinates"]["longitude"]
+        if prior is not None and method != "ml_stub":
+            # Предсказание приводится к известным позициям источника
+            latitude, longitude = prior.constrain(latitude, longitude)
+            note += f" Уточнено по известным позициям источника ({prior.source})."
+
         return {
-            "success": True,
-            "building_id": request.file_id,
-            "coordinates": {
-                "latitude": ml_lat,
-                "longitude": ml_lng
-            },
-            "address": address,
-            "confidence": ml_confidence,
+            "latitude": latitude,
+            "longitude": longitude,
+            "confidence": ml_prediction["confidence"],
             "method": method,
-            "note": note,
-            "meta": {
-                "timezone": timezone_info.get("timezoneId"),
-                "elevation": elevation
-            }
+            "note": note
+        }
+
+    # --- 2. ПРИОРИТЕТ 2: BBOX отсутствует, но есть EXIF ---
+    exif_coords = get_exif_geolocation(image)
+    if exif_coords:
+        return {
+            "latitude": exif_coords["latitude"],
+            "longitude": exif_coords["longitude"],
+            "confidence": 1.0,
+            "method": "exif_geolocation",
+            "note": "BBOX отсутствует. Координаты получены из EXIF данных изображения."
+        }
+
+    # --- 3. ПРИОРИТЕТ 3: Ни BBOX, ни EXIF ---
+    if prior is not None:
+        return prior_location(prior, "BBOX и EXIF отсутствуют. Использован априор источника снимка")
+
+    # Используем ML-заглушку с нулевым BBOX, как запасной вариант
+    stub_prediction = ml_loader.stub.predict_coordinates(image, [0.0, 0.0, 0.0, 0.0]) 
+    return {
+        "latitude": stub_prediction["coordinates"]["latitude"],
+        "longitude": stub_prediction["coordinates"]["longitude"],
+        "confidence": stub_prediction["confidence"],
+        "method": "ml_stub",
+        "note": "BBOX и EXIF отсутствуют. Использована заглушка ML-геолокатора."
+    }
+
+
+async def enrich_location(request: BuildingGeocodingRequest, location: Dict[str, Any]) -> Dict:
+    """Обратное геокодирование найденных координат и формирование ответа."""
+    osm_provider = app.state.osm_provider
+    geonames_provider = app.state.geonames_provider
+
+    ml_lat = location["latitude"]
+    ml_lng = location["longitude"]
+
+    # Независимые запросы к провайдерам выполняются параллельно
+    osm_result, timezone_info, elevation = await asyncio.gather(
+        osm_provider.reverse(ml_lat, ml_lng),
+        geonames_provider.get_timezone(ml_lat, ml_lng),
+        geonames_provider.get_elevation(ml_lat, ml_lng)
+    )
+    address = osm_result.get("display_name", "Адрес не найден")
+    
+    return {
+        "success": True,
+        "building_id": request.file_id,
+        "coordinates": {
+            "latitude": ml_lat,
+            "longitude": ml_lng
+        },
+        "address": address,
+        "confidence": location["confidence"],
+        "method": location["method"],
+        "note": location["note"],
+        "meta": {
+            "timezone": timezone_info.get("timezoneId"),
+            "elevation": elevation
         }
+    }
+
+
+def as_http_exception(e: Exception) -> HTTPException:
+    """Приводит ошибку обработки здания к HTTPException в едином формате."""
+    if isinstance(e, HTTPException):
+        return e
+    if isinstance(e, UpstreamUnavailableError):
+        return HTTPException(503, f"Building geocoding error: {str(e)}")
+    return HTTPException(500, f"Building geocoding error: {str(e)}")
+
+
+def building_error(request: BuildingGeocodingRequest, e: Exception) -> Dict:
+    """Элемент пакетного ответа для здания, которое не удалось обработать."""
+    return {
+        "success": False,
+        "building_file_id": request.file_id,
+        "error": as_http_exception(e).detail
+    }
+
+
+@app.post("/api/geocode-building")
+async def geocode_building(request: BuildingGeocodingRequest):
+    """
+    Геокодирование здания: сначала ML, потом обратное геокодирование.
+    """
+    try:
+        with open_building_image(request.file_id) as image:
+            # 🌟 ДИАГНОСТИКА: Выводим полученный BBOX
+            print(f"🔄 Geocoding: Полученный BBOX: {request.building_bbox} (Тип: {type(request.building_bbox)})") 
+            # ML-инференс выполняется вне event loop
+            location = await asyncio.to_thread(locate_building, request, image)
+
+        return await enrich_location(request, location)
         
-    except HTTPException as he:
-        raise he
     except Exception as e:
-        raise HTTPException(500, f"Building geocoding error: {str(e)}")
+        raise as_http_exception(e)
 
 
 @app.post("/api/geocode-buildings")
 async def geocode_buildings(buildings_request: List[BuildingGeocodingRequest]):
     """
-    Пакетное геокодирование нескольких зданий
+    Пакетное геокодирование нескольких зданий.
+    Каждый снимок открывается один раз, здания с BBOX проходят через ML-модель
+    пакетами до ML_MAX_BATCH_SIZE, обратное геокодирование выполняется параллельно
+    (не более GEOCODE_ENRICH_CONCURRENCY зданий одновременно).
     """
-    results = []
-    for request in buildings_request:
-        try:
-            result = await geocode_building(request)
-            results.append(result)
-        except HTTPException as he:
-             results.append({
-                "success": False,
-                "building_file_id": request.file_id,
-                "error": he.detail
-            })
-        except Exception as e:
-            results.append({
-                "success": False,
-                "building_file_id": request.file_id,
-                "error": str(e)
-            })
+    results: List[Optional[Dict]] = [None] * len(buildings_request)
+    ml_queue: List[Tuple[int, Image.Image]] = []
+    images: Dict[str, Image.Image] = {}
+    enrich_tasks: List[asyncio.Task] = []
+    semaphore = asyncio.Semaphore(GEOCODE_ENRICH_CONCURRENCY)
+
+    async def enrich(index: int, location: Dict[str, Any]) -> None:
+        request = buildings_request[index]
+        async with semaphore:
+            try:
+                results[index] = await enrich_location(request, location)
+            except Exception as e:
+                results[index] = building_error(request, e)
+
+    def schedule_enrich(index: int, location: Dict[str, Any]) -> None:
+        # Обратное геокодирование начинается, не дожидаясь остальных пакетов ML
+        enrich_tasks.append(asyncio.create_task(enrich(index, location)))
+
+    try:
+        # 1. Открываем каждый снимок один раз; здания без BBOX определяются сразу (EXIF / заглушка)
+        for index, request in enumerate(buildings_request):
+            try:
+                # Снимок с несколькими зданиями декодируется один раз за запрос
+                image_cache_metrics.record(request.file_id in images)
+                if request.file_id not in images:
+                    images[request.file_id] = open_building_image(request.file_id)
+                image = images[request.file_id]
+                if has_building_bbox(request) and not is_tight_prior(lookup_prior(request)):
+                    ml_queue.append((index, image))
+                else:
+                    schedule_enrich(index, locate_building(request, image))
+            except Exception as e:
+                results[index] = building_error(request, e)
+
+        # 2. Пакетный инференс ML-модели (здания одного снимка вырезаются за одно декодирование).
+        # Здания снимка могут попасть в разные пакеты: масштаб декодирования JPEG выбирается
+        # заранее по всем его зданиям, иначе области следующих пакетов окажутся мельче входа модели
+        image_bboxes: Dict[int, Tuple[Image.Image, List[List[float]]]] = {}
+        for index, image in ml_queue:
+            image_bboxes.setdefault(id(image), (image, []))[1].append(
+                cast(List[float], buildings_request[index].building_bbox)
+            )
+        for image, bboxes in image_bboxes.values():
+            apply_draft(image, bboxes)
+
+        for batch_start in range(0, len(ml_queue), ML_MAX_BATCH_SIZE):
+            batch = ml_queue[batch_start:batch_start + ML_MAX_BATCH_SIZE]
+            geolocator_metrics.observe_batch(len(batch))
+            try:
+                geolocator_metrics.in_flight.inc()
+                try:
+                    with timings.stage("geolocation", buildings=len(batch)):
+                        predictions = await asyncio.to_thread(ml_loader.geolocator.predict_coordinates_batch, [
+                            (image, cast(List[float], buildings_request[index].building_bbox))
+                            for index, image in batch
+                        ])
+                finally:
+                    geolocator_metrics.in_flight.dec()
+                for (index, image), prediction in zip(batch, predictions):
+                    schedule_enrich(index, locate_building(buildings_request[index], image, prediction))
+            except Exception as e:
+                for index, _ in batch:
+                    results[index] = building_error(buildings_request[index], e)
+    finally:
+        for image in images.values():
+            image.close()
+
+        # 3. Дожидаемся обратного геокодирования (ошибки уже записаны в results)
+        await asyncio.gather(*enrich_tasks)
     
     return {
         "success": True,
         "buildings": results,
         "processed": len(results),
-        "successful": len([r for r in results if r.get("success")])
+        "successful": len([r for r in results if r and r.get("success")])
     }
 
 
@@ -2,13 +2,15 @@ import torch
 import torch.nn as nn
 from PIL import Image
 import numpy as np
-from typing import List, Dict, Optional, cast
+from typing import List, Dict, Optional, Tuple, cast
 import torchvision.transforms as T
 import torchvision.models
 from torchvision.models import ResNet50_Weights
 from torch import Tensor
 import os # <-- НОВЫЙ ИМПОРТ
 
+from utils.image_regions import crop_image_items, crop_regions
+
 class BuildingGeolocationModel(nn.Module):
     """ML модель для определения координат здания по изображению"""
 
@@ -30,20 +32,56 @@ class BuildingGeolocationModel(nn.Module):
         confidence = torch.sigmoid(self.confidence_head(features))
         return coords, confidence
 
+# Варианты подготовки модели к инференсу на CPU
+MODEL_FORMATS = ("fp32", "dynamic_int8", "torchscript")
+
+IMAGENET_MEAN = [0.485, 0.456, 0.406]
+IMAGENET_STD = [0.229, 0.224, 0.225]
+
+
+def arrays_to_tensor(images: np.ndarray) -> Tensor:
+    """Пакет RGB-изображений (N, H, W, 3, uint8) -> нормализованный тензор (N, 3, H, W)"""
+    batch = torch.from_numpy(images).permute(0, 3, 1, 2).float().div_(255)
+    mean = torch.tensor(IMAGENET_MEAN).view(1, 3, 1, 1)
+    std = torch.tensor(IMAGENET_STD).view(1, 3, 1, 1)
+    return batch.sub_(mean).div_(std).contiguous()
+
+
+def prepare_inference_model(model: nn.Module, model_format: str = "fp32") -> nn.Module:
+    """
+    Подготовка модели к инференсу:
+    - fp32: модель как есть;
+    - dynamic_int8: динамическая квантизация линейных слоев (веса int8);
+    - torchscript: трассировка и заморозка графа (сворачивание BatchNorm в свертки).
+    """
+    if model_format not in MODEL_FORMATS:
+        raise ValueError(f"Неизвестный формат модели: {model_format}. Допустимые: {', '.join(MODEL_FORMATS)}")
+
+    model.eval()
+    if model_format == "dynamic_int8":
+        return torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+    if model_format == "torchscript":
+        with torch.inference_mode():
+            traced = torch.jit.trace(model, torch.zeros(1, 3, 224, 224))
+        return torch.jit.freeze(traced)
+    return model
+
+
 class BuildingGeolocator:
-    def __init__(self, model_path: Optional[str] = None):
+    def __init__(self, model_path: Optional[str] = None, model_format: str = "fp32"):
         # Инициализируем модель, которую нам не нужно экспортировать
-        self.model = BuildingGeolocationModel()
+        model = BuildingGeolocationModel()
 
         if model_path:
             # map_location='cpu' позволяет загружаться, даже если нет GPU
-            self.model.load_state_dict(torch.load(model_path, map_location='cpu'))
-        self.model.eval()
+            model.load_state_dict(torch.load(model_path, map_location='cpu'))
+        self.model_format = model_format
+        self.model = prepare_inference_model(model, model_format)
 
         self.transform = T.Compose([
             T.Resize((224, 224)),
             T.ToTensor(),
-            T.Normalize(mean=[0.485, 0.456, 0.406], std=[0.229, 0.224, 0.225]),
+            T.Normalize(mean=IMAGENET_MEAN, std=IMAGENET_STD),
         ])
 
         # --- КРИТИЧНОЕ ИЗМЕНЕНИЕ: ЧТЕНИЕ ГРАНИЦ ИЗ ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
@@ -56,49 +94,76 @@ class BuildingGeolocator:
 
     def predict_coordinates(self, image: Image.Image, building_bbox: List[float]) -> Dict:
         """Предсказание координат для здания"""
-        cropped_building = self.crop_building(image, building_bbox)
+        return self.predict_coordinates_batch([(image, building_bbox)])[0]
 
-        # Используем cast для устранения ошибки статического анализатора (Pylance)
-        processed_tensor = cast(Tensor, self.transform(cropped_building))
+    def predict_coordinates_batch(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Dict]:
+        """
+        Пакетное предсказание координат: все вырезанные здания собираются в один тензор
+        и проходят через модель за один forward-проход.
+        """
+        if not items:
+            return []
 
-        processed_image = processed_tensor.unsqueeze(0)
+        processed_batch = torch.stack([self.preprocess(crop) for crop in self.crop_buildings(items)])
+        return self.predict_tensor(processed_batch)
 
-        with torch.no_grad():
-            coords, confidence = self.model(processed_image)
+    def predict_tensor(self, processed_batch: Tensor) -> List[Dict]:
+        """Forward-проход для уже подготовленного тензора (N, 3, 224, 224) и денормализация."""
+        with torch.inference_mode():
+            coords, confidence = self.model(processed_batch)
 
         # --- КРИТИЧНОЕ ИЗМЕНЕНИЕ: ДЕНОРМАЛИЗАЦИЯ С ИСПОЛЬЗОВАНИЕМ ПЕРЕМЕННЫХ ОКРУЖЕНИЯ ---
         # Нормализованные ML-выходы (coords) находятся в диапазоне [-1, 1].
         # Денормализация: Min + (Нормализованное значение + 1) / 2 * Range
-        # (coords[0, 0].item() + 1) / 2 преобразует [-1, 1] в [0, 1]
+        # (coords[i, 0] + 1) / 2 преобразует [-1, 1] в [0, 1]
         
-        # lat = self.lat_min + (coords[0, 0].item() + 1) / 2 * self.lat_range
-        # lng = self.lng_min + (coords[0, 1].item() + 1) / 2 * self.lng_range
+        # lat = self.lat_min + (coords[i, 0] + 1) / 2 * self.lat_range
+        # lng = self.lng_min + (coords[i, 1] + 1) / 2 * self.lng_range
         
         # Упрощенная денормализация, если модель обучалась на нормализованных данных от 0 до 1
         # ИЛИ для регрессии, где tanh() используется для привязки к диапазону [-1, 1].
         # Используем более простую форму, соответствующую изначальному стилю:
-        lat = self.lat_min + coords[0, 0].item() * self.lat_range
-        lng = self.lng_min + coords[0, 1].item() * self.lng_range
+        coords_list = coords.tolist()
+        confidence_list = confidence.view(-1).tolist()
         # ---------------------------------------------------------------------------------
 
-        return {
-            "coordinates": {"latitude": lat, "longitude": lng},
-            "confidence": confidence.item(),
-            "method": "ml_geolocation"
-        }
+        return [
+            {
+                "coordinates": {
+                    "latitude": self.lat_min + lat_norm * self.lat_range,
+                    "longitude": self.lng_min + lng_norm * self.lng_range
+                },
+                "confidence": item_confidence,
+                "method": "ml_geolocation"
+            }
+            for (lat_norm, lng_norm), item_confidence in zip(coords_list, confidence_list)
+        ]
 
     def crop_building(self, image: Image.Image, bbox: List[float]) -> Image.Image:
         """Вырезает здание по bounding box"""
-        x1, y1, x2, y2 = bbox
-        return image.crop((x1, y1, x2, y2))
+        return crop_regions(image, [bbox])[0]
+
+    def crop_buildings(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Image.Image]:
+        """
+        Вырезает здания, группируя их по снимку: каждый снимок декодируется один раз
+        и только в том разрешении, которого достаточно для входа модели.
+        """
+        return crop_image_items(items)
 
     def preprocess(self, image: Image.Image) -> torch.Tensor:
         """Препроцессинг изображения"""
         # Ресайз, нормализация и т.д.
         # Поскольку transform уже содержит все шаги, просто вызываем его:
         # Для корректного статического анализа используем cast
+        # Модель ожидает 3 канала: PNG с альфа-каналом и ч/б снимки приводим к RGB
+        if image.mode != "RGB":
+            image = image.convert("RGB")
         processed_tensor = cast(Tensor, self.transform(image))
         return processed_tensor
 
+    def preprocess_arrays(self, images: np.ndarray) -> Tensor:
+        """Препроцессинг пакета уже приведенных к 224x224 RGB изображений (N, H, W, 3, uint8)"""
+        return arrays_to_tensor(images)
+
 # Класс BuildingGeolocationModel (nn.Module) остается без изменений,
 # так как он отвечает только за архитектуру и forward-проход.
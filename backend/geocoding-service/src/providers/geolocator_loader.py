@@ -0,0 +1,91 @@
+import importlib
+import time
+from typing import Any, Optional
+
+# Реализации ML-геолокатора по режиму инференса (модуль, класс).
+# Модули импортируются только при загрузке: torch/torchvision не нужны для старта сервиса.
+GEOLOCATOR_IMPLEMENTATIONS = {
+    "worker": ("providers.geolocator_worker", "GeolocatorWorkerClient"),
+    "inprocess": ("providers.bulding_geolocation", "BuildingGeolocator"),
+    # Поиск по индексу эмбеддингов архивных снимков (model_path — каталог индекса)
+    "retrieval": ("providers.retrieval_geolocation", "RetrievalGeolocator"),
+}
+
+
+class GeolocatorLoader:
+    """
+    Отложенная загрузка ML-геолокатора.
+
+    До окончания загрузки (или если ML отключен / загрузка не удалась)
+    запросы обслуживает заглушка.
+    """
+
+    DISABLED = "stub"
+    LOADING = "loading"
+    READY = "available"
+    FAILED = "failed"
+
+    def __init__(self, model_path: Optional[str], mode: str, stub: Any):
+        self.model_path = model_path
+        self.mode = mode
+        self.stub = stub
+        self.geolocator = stub
+        self.error: Optional[str] = None
+        self.load_time_s: Optional[float] = None
+        self.status = self.LOADING if model_path else self.DISABLED
+
+        if not model_path:
+            print("⚠️ Переменная ML_MODEL_PATH не установлена. Используется заглушка ML_GEOLOCATOR_CLASS.")
+
+    @property
+    def available(self) -> bool:
+        return self.status == self.READY
+
+    def load(self) -> None:
+        """Импорт ML-стека и загрузка модели (блокирующий вызов, выполняется в фоне)."""
+        if self.status != self.LOADING:
+            return
+
+        started_at = time.perf_counter()
+        try:
+            if self.mode not in GEOLOCATOR_IMPLEMENTATIONS:
+                raise ValueError(f"Неизвестный режим инференса: {self.mode}")
+            module_name, class_name = GEOLOCATOR_IMPLEMENTATIONS[self.mode]
+            geolocator_class = getattr(importlib.import_module(module_name), class_name)
+
+            geolocator = geolocator_class(self.model_path)
+            if hasattr(geolocator, "start"):
+                geolocator.start()
+        except ImportError as e:
+            self._fail(f"ML-зависимости (Torch/Torchvision) недоступны ({e})")
+            return
+        except Exception as e:
+            self._fail(f"Ошибка инициализации ML-геолокатора: {e}")
+            return
+
+        self.geolocator = geolocator
+        self.load_time_s = round(time.perf_counter() - started_at, 2)
+        self.status = self.READY
+        print(f"✅ ML-геолокатор загружен по пути: {self.model_path} ({self.mode}, {self.load_time_s} с)")
+
+    def _fail(self, message: str) -> None:
+        self.error = message
+        self.status = self.FAILED
+        print(f"❌ {message}. Используется заглушка ML_GEOLOCATOR_CLASS.")
+
+    def close(self) -> None:
+        if hasattr(self.geolocator, "close"):
+            self.geolocator.close()
+
+    def health(self) -> dict:
+        """Состояние ML-геолокатора для /health."""
+        info = {
+            "status": self.status,
+            "ready": self.available,
+            "mode": self.mode if self.model_path else None,
+        }
+        if self.load_time_s is not None:
+            info["load_time_s"] = self.load_time_s
+        if self.error:
+            info["error"] = self.error
+        return info
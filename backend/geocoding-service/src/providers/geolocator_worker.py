@@ -0,0 +1,169 @@
+import multiprocessing
+import os
+import threading
+from multiprocessing.connection import Connection
+from typing import Any, Dict, List, Optional, Tuple
+
+from PIL import Image
+
+from utils.image_regions import crop_image_items, to_model_input
+
+# Модуль намеренно не импортирует torch: в процессе HTTP-сервера выполняются только
+# вырезание и ресайз зданий, а модель живет в отдельном процессе инференса.
+
+
+def default_intra_op_threads() -> int:
+    """Число доступных процессу ядер (с учетом ограничений контейнера по affinity)."""
+    try:
+        return max(len(os.sched_getaffinity(0)), 1)
+    except AttributeError:
+        return os.cpu_count() or 1
+
+
+def serve(conn: Connection, config: Dict[str, Any]) -> None:
+    """Цикл процесса инференса: принимает пакеты изображений и возвращает предсказания."""
+    try:
+        import torch
+
+        # Настройки потоков должны быть заданы до первой параллельной операции
+        torch.set_num_threads(config["intra_op_threads"])
+        torch.set_num_interop_threads(config["inter_op_threads"])
+
+        from providers.bulding_geolocation import BuildingGeolocator
+
+        geolocator = BuildingGeolocator(config["model_path"], model_format=config["model_format"])
+    except Exception as e:
+        conn.send(("error", f"{type(e).__name__}: {e}"))
+        return
+
+    conn.send(("ready", {
+        "pid": os.getpid(),
+        "model_format": geolocator.model_format,
+        "intra_op_threads": torch.get_num_threads(),
+        "inter_op_threads": torch.get_num_interop_threads(),
+    }))
+
+    while True:
+        try:
+            command, payload = conn.recv()
+        except EOFError:
+            return
+
+        if command == "stop":
+            return
+
+        try:
+            if command == "predict":
+                result: Any = geolocator.predict_tensor(geolocator.preprocess_arrays(payload))
+            else:
+                raise ValueError(f"Неизвестная команда: {command}")
+            conn.send(("ok", result))
+        except Exception as e:
+            conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+class GeolocatorWorkerClient:
+    """
+    ML-геолокатор в отдельном процессе (локальный IPC через multiprocessing.Pipe).
+
+    Реализует тот же интерфейс, что и BuildingGeolocator. Родительский процесс
+    только вырезает здания и приводит их к 224x224; тензоры, torch и веса модели
+    находятся в процессе инференса с явно заданным числом потоков.
+    """
+
+    def __init__(
+        self,
+        model_path: Optional[str],
+        model_format: Optional[str] = None,
+        intra_op_threads: Optional[int] = None,
+        inter_op_threads: Optional[int] = None,
+        start_timeout: Optional[float] = None,
+    ):
+        self.config = {
+            "model_path": model_path,
+            "model_format": model_format or os.getenv("ML_MODEL_FORMAT", "fp32"),
+            "intra_op_threads": intra_op_threads or int(os.getenv("ML_INTRA_OP_THREADS", 0)) or default_intra_op_threads(),
+            "inter_op_threads": inter_op_threads or int(os.getenv("ML_INTER_OP_THREADS", 1)),
+        }
+        self.start_timeout = start_timeout or float(os.getenv("ML_WORKER_START_TIMEOUT", 300))
+        self.info: Dict[str, Any] = {}
+
+        # Один запрос к процессу за раз: вызовы приходят из пула потоков
+        self._lock = threading.Lock()
+        self._process: Optional[multiprocessing.process.BaseProcess] = None
+        self._conn: Optional[Connection] = None
+
+    def start(self) -> None:
+        """Запуск процесса инференса и ожидание загрузки модели (вызывается при старте сервиса)."""
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                self._start()
+
+    def _start(self) -> None:
+        # spawn: дочерний процесс не наследует состояние event loop и потоков сервера
+        context = multiprocessing.get_context("spawn")
+        parent_conn, child_conn = context.Pipe()
+        process = context.Process(
+            target=serve,
+            args=(child_conn, self.config),
+            name="geolocator-worker",
+            daemon=True,
+        )
+        process.start()
+        child_conn.close()
+
+        if not parent_conn.poll(self.start_timeout):
+            process.kill()
+            raise RuntimeError("Процесс ML-геолокатора не запустился за отведенное время")
+
+        status, payload = parent_conn.recv()
+        if status != "ready":
+            process.join(timeout=5)
+            raise RuntimeError(f"Ошибка запуска процесса ML-геолокатора: {payload}")
+
+        self._process, self._conn, self.info = process, parent_conn, payload
+        print(f"✅ Процесс ML-геолокатора запущен: {payload}")
+
+    def _request(self, command: str, payload: Any) -> Any:
+        with self._lock:
+            if self._process is None or not self._process.is_alive():
+                print("⚠️ Процесс ML-геолокатора не запущен. Запуск...")
+                self._start()
+            assert self._conn is not None
+            try:
+                self._conn.send((command, payload))
+                status, result = self._conn.recv()
+            except (EOFError, OSError) as e:
+                # Процесс упал посреди запроса: следующий вызов перезапустит его
+                self._process = None
+                raise RuntimeError(f"Процесс ML-геолокатора недоступен: {e}")
+
+        if status != "ok":
+            raise RuntimeError(f"Ошибка ML-геолокатора: {result}")
+        return result
+
+    def predict_coordinates(self, image: Image.Image, building_bbox: List[float]) -> Dict:
+        """Предсказание координат для здания"""
+        return self.predict_coordinates_batch([(image, building_bbox)])[0]
+
+    def predict_coordinates_batch(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Dict]:
+        """Пакетное предсказание: вырезание здесь, forward-проход в процессе инференса."""
+        if not items:
+            return []
+        return self._request("predict", to_model_input(crop_image_items(items)))
+
+    def close(self) -> None:
+        """Остановка процесса инференса."""
+        with self._lock:
+            if self._conn is not None:
+                try:
+                    self._conn.send(("stop", None))
+                except (EOFError, OSError):
+                    pass
+                self._conn.close()
+                self._conn = None
+            if self._process is not None:
+                self._process.join(timeout=5)
+                if self._process.is_alive():
+                    self._process.kill()
+                self._process = None
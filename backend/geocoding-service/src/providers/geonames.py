@@ -1,9 +1,16 @@
 import httpx
 from typing import Dict, List, Optional
 
+from providers.governance import UpstreamGovernor
+
 class GeoNamesProvider:
     # ИСПРАВЛЕНИЕ: Добавляем логику, чтобы убедиться, что 'demo' используется, если переданная строка пуста
-    def __init__(self, username: str = "demo", client: Optional[httpx.AsyncClient] = None):
+    def __init__(
+        self,
+        username: str = "demo",
+        client: Optional[httpx.AsyncClient] = None,
+        governor: Optional[UpstreamGovernor] = None,
+    ):
         self.base_url = "http://api.geonames.org"
         
         # 🎯 КРИТИЧЕСКОЕ ИСПРАВЛЕНИЕ: Используем 'demo', если полученное имя пользователя пусто
@@ -11,6 +18,24 @@ class GeoNamesProvider:
         
         # Сохраняем асинхронный клиент
         self.client = client if client else httpx.AsyncClient()
+        # Лимит скорости, объединение запросов и предохранитель
+        self.governor = governor
+
+    async def _get(self, path: str, params: Dict) -> Dict:
+        """GET-запрос к GeoNames через общий слой управления запросами"""
+        async def send() -> Dict:
+            # Используем асинхронный клиент
+            response = await self.client.get(
+                f"{self.base_url}/{path}", 
+                params=params, 
+                timeout=10
+            )
+            response.raise_for_status()
+            return response.json()
+
+        if self.governor is None:
+            return await send()
+        return await self.governor.call((path, tuple(sorted(params.items()))), send)
     
     async def get_elevation(self, lat: float, lng: float) -> Optional[float]:
         """Получение высоты над уровнем моря"""
@@ -21,15 +46,7 @@ class GeoNamesProvider:
                 "username": self.username
             }
             
-            # Используем асинхронный клиент
-            response = await self.client.get(
-                f"{self.base_url}/srtm3JSON", 
-                params=params, 
-                timeout=10
-            )
-            response.raise_for_status()
-            
-            data = response.json()
+            data = await self._get("srtm3JSON", params)
             elevation = data.get("srtm3")
             
             # Корректная обработка None и строки "null"
@@ -49,15 +66,7 @@ class GeoNamesProvider:
             "username": self.username
         }
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/timezoneJSON", 
-            params=params, 
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        return response.json()
+        return await self._get("timezoneJSON", params)
     
     async def search_places(self, query: str, country: str = "", max_rows: int = 10) -> Dict:
         """Поиск мест"""
@@ -71,15 +80,7 @@ class GeoNamesProvider:
         if country:
             params["country"] = country.upper()
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/searchJSON", 
-            params=params, 
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        return response.json()
+        return await self._get("searchJSON", params)
     
     async def get_country_info(self, country_code: str) -> Dict:
         """Информация о стране"""
@@ -88,12 +89,4 @@ class GeoNamesProvider:
             "username": self.username
         }
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/countryInfoJSON", 
-            params=params, 
-            timeout=10
-        )
-        response.raise_for_status()
-        
-        return response.json()
\ No newline at end of file
+        return await self._get("countryInfoJSON", params)
\ No newline at end of file
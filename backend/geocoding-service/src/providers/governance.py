@@ -0,0 +1,331 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, Hashable, Optional, Tuple, TypeVar
+
+import httpx
+
+from metrics import CacheMetrics, UpstreamMetrics
+
+T = TypeVar("T")
+
+# Коды ответа, при которых имеет смысл повторить запрос к внешнему сервису
+RETRYABLE_STATUS_CODES = {429, 500, 502, 503, 504}
+
+
+class UpstreamUnavailableError(Exception):
+    """Запрос к внешнему сервису отклонен локально (лимит скорости или открытый предохранитель)."""
+
+    def __init__(self, provider: str, reason: str):
+        self.provider = provider
+        self.reason = reason
+        super().__init__(f"{provider}: запрос отклонен ({reason})")
+
+
+class TokenBucket:
+    """
+    Ограничитель скорости по алгоритму token bucket.
+    Ожидающий запрос сразу резервирует токен (баланс уходит в минус), поэтому время
+    ожидания учитывает всех, кто встал в очередь раньше, а спят ожидающие параллельно.
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = max(capacity, 1.0)
+        self._tokens = self.capacity
+        self._updated_at = time.monotonic()
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated_at) * self.rate)
+        self._updated_at = now
+
+    async def acquire(self, max_wait: float) -> bool:
+        """Забирает один токен. Возвращает False, если ждать пришлось бы дольше max_wait секунд."""
+        if self.rate <= 0:
+            return True
+
+        # Между проверкой и резервированием нет await: блокировка не нужна
+        self._refill()
+        wait = max(0.0, (1 - self._tokens) / self.rate)
+        if wait > max_wait:
+            return False
+        self._tokens -= 1
+        if wait > 0:
+            try:
+                await asyncio.sleep(wait)
+            except asyncio.CancelledError:
+                # Отмененный запрос возвращает зарезервированный токен
+                self._tokens += 1
+                raise
+        return True
+
+
+class CircuitBreaker:
+    """Предохранитель: closed -> open после серии ошибок, затем half-open с пробным запросом."""
+
+    CLOSED = "closed"
+    OPEN = "open"
+    HALF_OPEN = "half_open"
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_in_flight = False
+
+    def allow(self) -> bool:
+        """Можно ли отправить запрос прямо сейчас."""
+        if self.state == self.CLOSED:
+            return True
+
+        if self.state == self.OPEN:
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                return False
+            self.state = self.HALF_OPEN
+            self._probe_in_flight = False
+
+        # HALF_OPEN: пропускаем только один пробный запрос
+        if self._probe_in_flight:
+            return False
+        self._probe_in_flight = True
+        return True
+
+    def record_success(self) -> None:
+        self.state = self.CLOSED
+        self._failures = 0
+        self._probe_in_flight = False
+
+    def release_probe(self) -> None:
+        """Пробный запрос так и не был отправлен."""
+        self._probe_in_flight = False
+
+    def record_failure(self) -> None:
+        self._failures += 1
+        if self.state == self.HALF_OPEN or self._failures >= self.failure_threshold:
+            self.state = self.OPEN
+            self._opened_at = time.monotonic()
+        self._probe_in_flight = False
+
+
+class SingleFlight:
+    """Объединяет одинаковые запросы, выполняющиеся одновременно, в один вызов."""
+
+    def __init__(self):
+        self._in_flight: Dict[Hashable, "asyncio.Future[Any]"] = {}
+
+    def is_in_flight(self, key: Hashable) -> bool:
+        return key in self._in_flight
+
+    async def do(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        task = self._in_flight.get(key)
+        if task is None:
+            task = asyncio.ensure_future(fn())
+            self._in_flight[key] = task
+            task.add_done_callback(lambda _: self._in_flight.pop(key, None))
+        # shield: отмена одного ожидающего не должна прерывать запрос для остальных
+        return await asyncio.shield(task)
+
+
+class ProviderStats:
+    """Счетчики и задержки запросов к одному внешнему сервису."""
+
+    def __init__(self, window: int = 256):
+        self.requests = 0
+        self.successes = 0
+        self.failures = 0
+        self.retries = 0
+        self.coalesced = 0
+        self.rejected_rate_limited = 0
+        self.rejected_circuit_open = 0
+        self.latency_total_ms = 0.0
+        self.latency_max_ms = 0.0
+        self._recent: Deque[float] = deque(maxlen=window)
+
+    def observe_latency(self, latency_ms: float) -> None:
+        self.latency_total_ms += latency_ms
+        self.latency_max_ms = max(self.latency_max_ms, latency_ms)
+        self._recent.append(latency_ms)
+
+    def snapshot(self) -> Dict[str, Any]:
+        recent = sorted(self._recent)
+        calls = self.successes + self.failures
+
+        def percentile(p: float) -> Optional[float]:
+            if not recent:
+                return None
+            return round(recent[min(len(recent) - 1, int(len(recent) * p))], 1)
+
+        return {
+            "requests": self.requests,
+            "successes": self.successes,
+            "failures": self.failures,
+            "retries": self.retries,
+            "coalesced": self.coalesced,
+            "rejected": {
+                "rate_limited": self.rejected_rate_limited,
+                "circuit_open": self.rejected_circuit_open,
+            },
+            "latency_ms": {
+                "avg": round(self.latency_total_ms / calls, 1) if calls else None,
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": round(self.latency_max_ms, 1),
+            },
+        }
+
+
+class UpstreamGovernor:
+    """
+    Управление запросами к одному внешнему провайдеру:
+    объединение одинаковых запросов, лимит скорости, предохранитель и повторы с джиттером.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        rate_per_sec: float = 1.0,
+        burst: float = 1.0,
+        max_wait: float = 10.0,
+        failure_threshold: int = 5,
+        reset_timeout: float = 30.0,
+        max_retries: int = 2,
+        backoff_base: float = 0.5,
+        backoff_max: float = 8.0,
+    ):
+        self.name = name
+        self.max_wait = max_wait
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+
+        self.bucket = TokenBucket(rate_per_sec, burst)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+        self.single_flight = SingleFlight()
+        self.stats = ProviderStats()
+        # Метрики Prometheus; объединенный запрос считается попаданием в кэш single-flight
+        self.metrics = UpstreamMetrics(name)
+        self.coalesce_metrics = CacheMetrics(f"{name}_single_flight")
+
+    @classmethod
+    def from_env(cls, name: str, prefix: str, **defaults: Any) -> "UpstreamGovernor":
+        """Создание с параметрами из переменных окружения вида <PREFIX>_RATE_LIMIT_PER_SEC."""
+        env_names = {
+            "rate_per_sec": (f"{prefix}_RATE_LIMIT_PER_SEC", float),
+            "burst": (f"{prefix}_RATE_LIMIT_BURST", float),
+            "max_wait": (f"{prefix}_RATE_LIMIT_MAX_WAIT", float),
+            "failure_threshold": (f"{prefix}_CIRCUIT_FAILURE_THRESHOLD", int),
+            "reset_timeout": (f"{prefix}_CIRCUIT_RESET_TIMEOUT", float),
+            "max_retries": (f"{prefix}_RETRY_ATTEMPTS", int),
+            "backoff_base": (f"{prefix}_RETRY_BACKOFF_BASE", float),
+            "backoff_max": (f"{prefix}_RETRY_BACKOFF_MAX", float),
+        }
+        params = dict(defaults)
+        for param, (env_name, cast) in env_names.items():
+            value = os.getenv(env_name)
+            if value:
+                params[param] = cast(value)
+        return cls(name, **params)
+
+    async def call(self, key: Hashable, fn: Callable[[], Awaitable[T]]) -> T:
+        """Выполняет запрос fn с учетом всех ограничений. key определяет одинаковые запросы."""
+        self.stats.requests += 1
+        coalesced = self.single_flight.is_in_flight(key)
+        if coalesced:
+            self.stats.coalesced += 1
+        self.coalesce_metrics.record(coalesced)
+        return await self.single_flight.do(key, lambda: self._call_with_retry(fn))
+
+    async def _call_with_retry(self, fn: Callable[[], Awaitable[T]]) -> T:
+        attempt = 0
+        while True:
+            if not self.breaker.allow():
+                self.stats.rejected_circuit_open += 1
+                raise UpstreamUnavailableError(self.name, "circuit_open")
+            probe = self.breaker.state == CircuitBreaker.HALF_OPEN
+            try:
+                result, error, retry_after = await self._attempt(fn)
+            finally:
+                # Пробный запрос без результата (отказ лимита, отмена): предохранитель
+                # не должен ждать его вечно. После record_* вызов ничего не меняет
+                if probe:
+                    self.breaker.release_probe()
+            if error is None:
+                return result
+
+            self.breaker.record_failure()
+            self.stats.failures += 1
+            if attempt >= self.max_retries:
+                raise error
+
+            attempt += 1
+            self.stats.retries += 1
+            await asyncio.sleep(self._backoff(attempt, retry_after))
+
+    async def _attempt(self, fn: Callable[[], Awaitable[T]]) -> Tuple[Optional[T], Optional[Exception], Optional[float]]:
+        """
+        Одна попытка: (результат, None, None) или (None, ошибка для повтора, Retry-After).
+        Остальные ошибки пробрасываются.
+        """
+        if not await self.bucket.acquire(self.max_wait):
+            self.stats.rejected_rate_limited += 1
+            raise UpstreamUnavailableError(self.name, "rate_limited")
+
+        started_at = time.perf_counter()
+        self.metrics.in_flight.inc()
+        try:
+            try:
+                result = await fn()
+            except httpx.HTTPStatusError as e:
+                self._observe_latency(started_at, ok=False)
+                if e.response.status_code not in RETRYABLE_STATUS_CODES:
+                    # Ошибка запроса (4xx), а не недоступность сервиса
+                    self.breaker.record_success()
+                    self.stats.failures += 1
+                    raise
+                return None, e, self._retry_after(e.response)
+            except httpx.TransportError as e:
+                self._observe_latency(started_at, ok=False)
+                return None, e, None
+            except Exception:
+                # Некорректный ответ (например, HTML вместо JSON): без повтора
+                self._observe_latency(started_at, ok=False)
+                self.breaker.record_failure()
+                self.stats.failures += 1
+                raise
+        finally:
+            self.metrics.in_flight.dec()
+        self._observe_latency(started_at, ok=True)
+        self.breaker.record_success()
+        self.stats.successes += 1
+        return result, None, None
+
+    def _observe_latency(self, started_at: float, ok: bool) -> None:
+        """Задержка одной попытки: в статистику провайдера и в метрики Prometheus."""
+        seconds = time.perf_counter() - started_at
+        self.metrics.observe(seconds, ok)
+        self.stats.observe_latency(seconds * 1000)
+
+    def _backoff(self, attempt: int, retry_after: Optional[float]) -> float:
+        """Экспоненциальная задержка с полным джиттером (не меньше Retry-After, если он задан)."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * (2 ** attempt)))
+        if retry_after is not None:
+            delay = max(delay, min(retry_after, self.backoff_max))
+        return delay
+
+    @staticmethod
+    def _retry_after(response: httpx.Response) -> Optional[float]:
+        value = response.headers.get("Retry-After")
+        try:
+            return float(value) if value else None
+        except ValueError:
+            return None
+
+    def snapshot(self) -> Dict[str, Any]:
+        data = self.stats.snapshot()
+        data["circuit_state"] = self.breaker.state
+        return data
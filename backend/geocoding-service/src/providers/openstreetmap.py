@@ -2,14 +2,35 @@ import httpx
 from typing import Dict, List, Optional
 import time
 
+from providers.governance import UpstreamGovernor
+
 class OpenStreetMapProvider:
     # Принимаем асинхронный клиент в конструкторе
-    def __init__(self, client: httpx.AsyncClient):
+    def __init__(self, client: httpx.AsyncClient, governor: Optional[UpstreamGovernor] = None):
         self.base_url = "https://nominatim.openstreetmap.org"
         self.headers = {
             "User-Agent": "GeoPhotoAnalyzer/1.0 (https://github.com/your-repo)"
         }
         self.client = client # Сохраняем httpx.AsyncClient
+        # Лимит скорости, объединение запросов и предохранитель (Nominatim допускает ~1 запрос/сек)
+        self.governor = governor
+
+    async def _get(self, path: str, params: Dict) -> Dict:
+        """GET-запрос к Nominatim через общий слой управления запросами"""
+        async def send() -> Dict:
+            # Используем асинхронный клиент
+            response = await self.client.get(
+                f"{self.base_url}/{path}", 
+                params=params, 
+                headers=self.headers,
+                timeout=15
+            )
+            response.raise_for_status()
+            return response.json()
+
+        if self.governor is None:
+            return await send()
+        return await self.governor.call((path, tuple(sorted(params.items()))), send)
 
     async def search(self, query: str, country: str = "", language: str = "ru", limit: int = 5) -> Dict:
         """Асинхронный поиск мест по запросу"""
@@ -24,16 +45,7 @@ class OpenStreetMapProvider:
         if country:
             params["countrycodes"] = country
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/search", 
-            params=params, 
-            headers=self.headers,
-            timeout=15
-        )
-        response.raise_for_status()
-        
-        return response.json()
+        return await self._get("search", params)
     
     async def reverse(self, lat: float, lon: float, language: str = "ru") -> Dict:
         """Асинхронное обратное геокодирование"""
@@ -46,16 +58,7 @@ class OpenStreetMapProvider:
             "accept-language": language
         }
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/reverse", 
-            params=params, 
-            headers=self.headers,
-            timeout=15
-        )
-        response.raise_for_status()
-        
-        return response.json()
+        return await self._get("reverse", params)
     
     async def get_place_details(self, osm_type: str, osm_id: int) -> Dict:
         """Асинхронная детальная информация о месте"""
@@ -65,13 +68,4 @@ class OpenStreetMapProvider:
             "format": "json"
         }
         
-        # Используем асинхронный клиент
-        response = await self.client.get(
-            f"{self.base_url}/details", 
-            params=params, 
-            headers=self.headers,
-            timeout=15
-        )
-        response.raise_for_status()
-        
-        return response.json()
+        return await self._get("details", params)
@@ -0,0 +1,313 @@
+import json
+import math
+import os
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+import torch
+import torch.nn as nn
+import torchvision.models
+from PIL import Image
+from torch import Tensor
+
+from providers.bulding_geolocation import BuildingGeolocationModel, arrays_to_tensor
+from utils.image_regions import crop_image_items, to_model_input
+
+# Файлы индекса (каталог ML_INDEX_PATH):
+#   meta.json          — размерности и параметры построения;
+#   embeddings.f16     — матрица эмбеддингов (count, dim) float16, memory-mapped;
+#                        строки упорядочены по спискам IVF, каждый список — непрерывный срез;
+#   centroids.npy      — центры списков IVF (nlist, dim) float32;
+#   list_offsets.npy   — границы списков в embeddings.f16 (nlist + 1);
+#   coords.npy         — координаты снимков (count, 2): latitude, longitude;
+#   photo_ids.npy      — photo_metadata.id для каждой строки;
+#   projection.npz     — PCA (mean, components), если размерность сокращалась;
+#   backbone.pt        — веса сети, которой считались эмбеддинги (запрос считается той же сетью).
+INDEX_VERSION = 1
+EMBEDDINGS_FILE = "embeddings.f16"
+
+# Температура при взвешивании соседей по косинусной близости
+SIMILARITY_TEMPERATURE = 0.05
+EARTH_RADIUS_M = 6371000.0
+
+
+class EmbeddingExtractor(nn.Module):
+    """ResNet50 без регрессионной головы: эмбеддинг здания, нормированный по L2."""
+
+    def __init__(self, feature_dim: int = 2048):
+        super().__init__()
+        self.feature_dim = feature_dim
+        self.backbone: nn.Module = torchvision.models.resnet50(weights=None)
+        # 2048 — признаки ResNet50 как есть; иначе линейный слой backbone геолокационной модели
+        self.backbone.fc = nn.Identity() if feature_dim == 2048 else nn.Linear(2048, feature_dim)
+
+    def forward(self, x: Tensor) -> Tensor:
+        return nn.functional.normalize(self.backbone(x), dim=1)
+
+    @classmethod
+    def pretrained(cls, model_path: Optional[str] = None) -> "EmbeddingExtractor":
+        """
+        Сеть для построения индекса: backbone обученной BuildingGeolocationModel
+        (эмбеддинг 512, уже учитывает географию), либо ResNet50 ImageNet.
+        """
+        if model_path:
+            model = BuildingGeolocationModel()
+            model.load_state_dict(torch.load(model_path, map_location='cpu'))
+            extractor = cls(feature_dim=512)
+            extractor.backbone.load_state_dict(model.backbone.state_dict())
+        else:
+            extractor = cls()
+            weights = torchvision.models.ResNet50_Weights.IMAGENET1K_V1
+            state = torchvision.models.resnet50(weights=weights).state_dict()
+            state = {k: v for k, v in state.items() if not k.startswith("fc.")}
+            extractor.backbone.load_state_dict(state)
+        return extractor.eval()
+
+    def embed(self, images: np.ndarray) -> np.ndarray:
+        """Пакет (N, 224, 224, 3) uint8 -> эмбеддинги (N, feature_dim) float32."""
+        with torch.inference_mode():
+            return self(arrays_to_tensor(images)).numpy()
+
+
+# --- ПОСТРОЕНИЕ ИНДЕКСА ---
+
+def l2_normalize(x: np.ndarray) -> np.ndarray:
+    norms = np.linalg.norm(x, axis=1, keepdims=True)
+    return x / np.maximum(norms, 1e-12)
+
+
+def fit_pca(x: np.ndarray, dim: int, sample_size: int = 20000, seed: int = 0) -> Tuple[np.ndarray, np.ndarray]:
+    """Главные компоненты по выборке эмбеддингов: (mean, components[dim, D])."""
+    rng = np.random.default_rng(seed)
+    sample = x[rng.choice(len(x), min(sample_size, len(x)), replace=False)]
+    mean = sample.mean(axis=0)
+    _, _, vt = np.linalg.svd(sample - mean, full_matrices=False)
+    return mean.astype(np.float32), vt[:dim].astype(np.float32)
+
+
+def apply_projection(x: np.ndarray, projection: Optional[Tuple[np.ndarray, np.ndarray]]) -> np.ndarray:
+    if projection is None:
+        return x
+    mean, components = projection
+    return l2_normalize((x - mean) @ components.T)
+
+
+def spherical_kmeans(
+    x: np.ndarray,
+    nlist: int,
+    iterations: int = 20,
+    sample_size: int = 50000,
+    seed: int = 0
+) -> np.ndarray:
+    """K-means по косинусной близости (на выборке) — центры списков IVF."""
+    rng = np.random.default_rng(seed)
+    sample = x[rng.choice(len(x), min(sample_size, len(x)), replace=False)]
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    for _ in range(iterations):
+        assignment = np.argmax(sample @ centroids.T, axis=1)
+        for cluster in range(nlist):
+            members = sample[assignment == cluster]
+            if len(members):
+                centroids[cluster] = members.sum(axis=0)
+            else:
+                # Пустой список: переносим центр в случайную точку выборки
+                centroids[cluster] = sample[rng.integers(len(sample))]
+        centroids = l2_normalize(centroids)
+    return centroids.astype(np.float32)
+
+
+def assign_lists(x: np.ndarray, centroids: np.ndarray, chunk_size: int = 65536) -> np.ndarray:
+    return np.concatenate([
+        np.argmax(x[start:start + chunk_size] @ centroids.T, axis=1)
+        for start in range(0, len(x), chunk_size)
+    ]) if len(x) else np.empty(0, dtype=np.int64)
+
+
+def write_index(
+    index_path: str,
+    embeddings: np.ndarray,
+    coords: np.ndarray,
+    photo_ids: np.ndarray,
+    extractor: EmbeddingExtractor,
+    dim: Optional[int] = None,
+    nlist: Optional[int] = None
+) -> Dict:
+    """
+    Сохраняет индекс: (опционально) PCA до dim, k-means на nlist списков,
+    строки упорядочиваются по спискам и записываются в float16.
+    """
+    os.makedirs(index_path, exist_ok=True)
+    embeddings = l2_normalize(embeddings.astype(np.float32))
+
+    projection = None
+    projection_path = os.path.join(index_path, "projection.npz")
+    if os.path.exists(projection_path):
+        os.remove(projection_path)
+    if dim and dim < embeddings.shape[1]:
+        projection = fit_pca(embeddings, dim)
+        embeddings = apply_projection(embeddings, projection)
+        np.savez(projection_path, mean=projection[0], components=projection[1])
+
+    # ~sqrt(N) списков — стандартный компромисс между числом центров и длиной списка
+    nlist = max(1, min(nlist or int(math.sqrt(len(embeddings))), len(embeddings)))
+    centroids = spherical_kmeans(embeddings, nlist)
+    assignment = assign_lists(embeddings, centroids)
+    order = np.argsort(assignment, kind="stable")
+    offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=nlist))]).astype(np.int64)
+
+    matrix = np.memmap(
+        os.path.join(index_path, EMBEDDINGS_FILE), dtype=np.float16, mode="w+", shape=embeddings.shape
+    )
+    matrix[:] = embeddings[order].astype(np.float16)
+    matrix.flush()
+    del matrix
+
+    np.save(os.path.join(index_path, "centroids.npy"), centroids)
+    np.save(os.path.join(index_path, "list_offsets.npy"), offsets)
+    np.save(os.path.join(index_path, "coords.npy"), coords[order].astype(np.float64))
+    np.save(os.path.join(index_path, "photo_ids.npy"), photo_ids[order].astype(np.int64))
+    torch.save(extractor.state_dict(), os.path.join(index_path, "backbone.pt"))
+
+    meta = {
+        "version": INDEX_VERSION,
+        "count": int(embeddings.shape[0]),
+        "dim": int(embeddings.shape[1]),
+        "feature_dim": extractor.feature_dim,
+        "nlist": nlist,
+    }
+    with open(os.path.join(index_path, "meta.json"), "w") as f:
+        json.dump(meta, f, indent=2)
+    return meta
+
+
+# --- ПОИСК ---
+
+class EmbeddingIndex:
+    """
+    Приближенный поиск ближайших соседей (IVF): запрос сравнивается с центрами
+    списков, затем точно — со строками nprobe ближайших списков.
+    Матрица эмбеддингов не загружается в память целиком (np.memmap).
+    """
+
+    def __init__(self, index_path: str):
+        with open(os.path.join(index_path, "meta.json")) as f:
+            self.meta = json.load(f)
+        if self.meta.get("version") != INDEX_VERSION:
+            raise ValueError(f"Неподдерживаемая версия индекса: {self.meta.get('version')}")
+
+        self.embeddings = np.memmap(
+            os.path.join(index_path, EMBEDDINGS_FILE), dtype=np.float16, mode="r",
+            shape=(self.meta["count"], self.meta["dim"])
+        )
+        self.centroids = np.load(os.path.join(index_path, "centroids.npy"))
+        self.offsets = np.load(os.path.join(index_path, "list_offsets.npy"))
+        self.coords = np.load(os.path.join(index_path, "coords.npy"))
+        self.photo_ids = np.load(os.path.join(index_path, "photo_ids.npy"))
+
+        self.projection: Optional[Tuple[np.ndarray, np.ndarray]] = None
+        projection_path = os.path.join(index_path, "projection.npz")
+        if os.path.exists(projection_path):
+            with np.load(projection_path) as projection:
+                self.projection = (projection["mean"], projection["components"])
+
+    def __len__(self) -> int:
+        return self.meta["count"]
+
+    def search(self, queries: np.ndarray, k: int, nprobe: int) -> List[Tuple[np.ndarray, np.ndarray]]:
+        """Для каждого запроса — (номера строк, косинусная близость) top-k по убыванию близости."""
+        queries = apply_projection(l2_normalize(queries.astype(np.float32)), self.projection)
+        nprobe = min(nprobe, len(self.centroids))
+        probes = np.argsort(-(queries @ self.centroids.T), axis=1)[:, :nprobe]
+
+        results = []
+        for query, lists in zip(queries, probes):
+            rows = np.concatenate([
+                np.arange(self.offsets[i], self.offsets[i + 1]) for i in np.sort(lists)
+            ])
+            if not len(rows):
+                results.append((rows, np.empty(0, dtype=np.float32)))
+                continue
+            # Списки лежат непрерывно: читаем с диска только их срезы
+            candidates = np.concatenate([
+                np.asarray(self.embeddings[self.offsets[i]:self.offsets[i + 1]], dtype=np.float32)
+                for i in np.sort(lists)
+            ])
+            similarity = candidates @ query
+            top = np.argpartition(-similarity, min(k, len(rows)) - 1)[:k]
+            top = top[np.argsort(-similarity[top])]
+            results.append((rows[top], similarity[top]))
+        return results
+
+
+def haversine_m(lat1: float, lng1: float, lat2: np.ndarray, lng2: np.ndarray) -> np.ndarray:
+    lat1, lng1, lat2, lng2 = map(np.radians, (lat1, lng1, lat2, lng2))
+    a = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * np.arcsin(np.sqrt(np.clip(a, 0, 1)))
+
+
+class RetrievalGeolocator:
+    """
+    Геолокация поиском: координаты top-k самых похожих зданий архива с известным GPS.
+
+    Реализует тот же интерфейс, что и BuildingGeolocator. Координаты — взвешенное
+    среднее соседей, согласных с лучшим совпадением (в пределах radius_m);
+    уверенность — близость лучшего совпадения, умноженная на долю веса согласных соседей.
+    """
+
+    def __init__(
+        self,
+        index_path: Optional[str] = None,
+        top_k: Optional[int] = None,
+        nprobe: Optional[int] = None,
+        radius_m: Optional[float] = None
+    ):
+        index_path = index_path or os.getenv("ML_INDEX_PATH")
+        if not index_path:
+            raise ValueError("Не задан путь к индексу эмбеддингов (ML_INDEX_PATH)")
+
+        self.index = EmbeddingIndex(index_path)
+        self.top_k = top_k or int(os.getenv("ML_RETRIEVAL_TOP_K", 10))
+        self.nprobe = nprobe or int(os.getenv("ML_RETRIEVAL_NPROBE", 8))
+        self.radius_m = radius_m or float(os.getenv("ML_RETRIEVAL_RADIUS_M", 300))
+
+        self.extractor = EmbeddingExtractor(self.index.meta["feature_dim"])
+        self.extractor.load_state_dict(torch.load(os.path.join(index_path, "backbone.pt"), map_location='cpu'))
+        self.extractor.eval()
+
+    def predict_coordinates(self, image: Image.Image, building_bbox: List[float]) -> Dict:
+        """Предсказание координат для здания"""
+        return self.predict_coordinates_batch([(image, building_bbox)])[0]
+
+    def predict_coordinates_batch(self, items: List[Tuple[Image.Image, List[float]]]) -> List[Dict]:
+        """Пакетное предсказание: один forward-проход на все здания, затем поиск по индексу."""
+        if not items:
+            return []
+        embeddings = self.extractor.embed(to_model_input(crop_image_items(items)))
+        return [
+            self.aggregate(rows, similarity)
+            for rows, similarity in self.index.search(embeddings, self.top_k, self.nprobe)
+        ]
+
+    def aggregate(self, rows: np.ndarray, similarity: np.ndarray) -> Dict:
+        """Координаты и уверенность по найденным соседям."""
+        if not len(rows):
+            raise ValueError("Индекс эмбеддингов пуст")
+
+        coords = self.index.coords[rows]
+        weights = np.exp((similarity - similarity[0]) / SIMILARITY_TEMPERATURE)
+        # Соседи далеко от лучшего совпадения (другая улица с похожим фасадом) не усредняются
+        agree = haversine_m(coords[0, 0], coords[0, 1], coords[:, 0], coords[:, 1]) <= self.radius_m
+        agree_weights = weights * agree
+        latitude, longitude = (coords * agree_weights[:, None]).sum(axis=0) / agree_weights.sum()
+
+        return {
+            "coordinates": {
+                "latitude": float(latitude),
+                "longitude": float(longitude)
+            },
+            "confidence": float(max(similarity[0], 0.0) * agree_weights.sum() / weights.sum()),
+            "method": "ml_retrieval",
+            "matched_photo_ids": [int(photo_id) for photo_id in self.index.photo_ids[rows[agree]]]
+        }
+
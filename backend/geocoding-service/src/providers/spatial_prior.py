@@ -0,0 +1,215 @@
+import json
+import math
+import os
+import time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+# Пространственный априор: для каждой камеры и каждого датасета — известные позиции
+# снимков из photo_metadata (строится scripts/build_spatial_prior.py).
+# Загружается в память целиком, поиск по camera_id / dataset_id — обращение к словарю.
+PRIOR_VERSION = 1
+DEFAULT_CELL_DEG = 0.002  # ~220 м по широте
+EARTH_RADIUS_M = 6371000.0
+DEGREE_M = math.pi * EARTH_RADIUS_M / 180
+
+
+def haversine_m(lat1: float, lng1: float, lat2: float, lng2: float) -> float:
+    lat1, lng1, lat2, lng2 = map(math.radians, (lat1, lng1, lat2, lng2))
+    a = math.sin((lat2 - lat1) / 2) ** 2 + math.cos(lat1) * math.cos(lat2) * math.sin((lng2 - lng1) / 2) ** 2
+    return 2 * EARTH_RADIUS_M * math.asin(math.sqrt(min(max(a, 0.0), 1.0)))
+
+
+def percentile(values: List[float], q: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(q * (len(ordered) - 1))))]
+
+
+class SpatialPrior:
+    """Известные позиции одного источника снимков (камеры или датасета)."""
+
+    def __init__(
+        self,
+        source: str,
+        count: int,
+        center: Tuple[float, float],
+        spread_m: float,
+        bounds: Tuple[float, float, float, float],
+        cells: Dict[Tuple[int, int], int],
+        cell_deg: float
+    ):
+        self.source = source
+        self.count = count
+        self.center = center
+        self.spread_m = spread_m
+        self.bounds = bounds  # lat_min, lat_max, lng_min, lng_max
+        self.cells = cells
+        self.cell_deg = cell_deg
+        # Диапазон занятых ячеек: поиск ближайшей не выходит за него
+        rows = [i for i, _ in cells]
+        columns = [j for _, j in cells]
+        self.cell_span = (min(rows), max(rows), min(columns), max(columns))
+
+    @classmethod
+    def from_points(cls, source: str, points: List[Tuple[float, float]], cell_deg: float) -> "SpatialPrior":
+        """Центр (медиана), разброс (90-й перцентиль расстояния до центра), границы и сетка."""
+        lats = [lat for lat, _ in points]
+        lngs = [lng for _, lng in points]
+        center = (percentile(lats, 0.5), percentile(lngs, 0.5))
+        distances = [haversine_m(center[0], center[1], lat, lng) for lat, lng in points]
+
+        # Единичные выбросы (ошибочные координаты в Excel) не расширяют границы
+        tail = 0.02 if len(points) >= 50 else 0.0
+        bounds = (percentile(lats, tail), percentile(lats, 1 - tail), percentile(lngs, tail), percentile(lngs, 1 - tail))
+
+        cells: Dict[Tuple[int, int], int] = {}
+        for lat, lng in points:
+            key = (math.floor(lat / cell_deg), math.floor(lng / cell_deg))
+            cells[key] = cells.get(key, 0) + 1
+
+        return cls(source, len(points), center, percentile(distances, 0.9), bounds, cells, cell_deg)
+
+    @classmethod
+    def from_dict(cls, source: str, data: Dict, cell_deg: float) -> "SpatialPrior":
+        cells = {}
+        for key, count in data["cells"].items():
+            i, j = key.split(":")
+            cells[(int(i), int(j))] = count
+        return cls(source, data["count"], tuple(data["center"]), data["spread_m"], tuple(data["bounds"]), cells, cell_deg)
+
+    def to_dict(self) -> Dict:
+        return {
+            "count": self.count,
+            "center": [round(v, 7) for v in self.center],
+            "spread_m": round(self.spread_m, 1),
+            "bounds": [round(v, 7) for v in self.bounds],
+            "cells": {f"{i}:{j}": count for (i, j), count in self.cells.items()},
+        }
+
+    def constrain(self, latitude: float, longitude: float) -> Tuple[float, float]:
+        """
+        Приводит предсказание к известным позициям источника: точка вне занятых ячеек
+        сетки переносится в центр ближайшей занятой ячейки и ограничивается границами.
+        """
+        key = (math.floor(latitude / self.cell_deg), math.floor(longitude / self.cell_deg))
+        if key not in self.cells:
+            i, j = self.nearest_cell(latitude, longitude, key)
+            latitude, longitude = (i + 0.5) * self.cell_deg, (j + 0.5) * self.cell_deg
+
+        lat_min, lat_max, lng_min, lng_max = self.bounds
+        return min(max(latitude, lat_min), lat_max), min(max(longitude, lng_min), lng_max)
+
+    def nearest_cell(self, latitude: float, longitude: float, key: Tuple[int, int]) -> Tuple[int, int]:
+        """
+        Занятая ячейка с ближайшим к точке центром. Кольца ячеек вокруг key просматриваются
+        по очереди, пока кольцо может содержать центр ближе уже найденного: стоимость
+        зависит от расстояния до занятых ячеек, а не от их числа. Если кольца вышли
+        дороже полного перебора (точка далеко от всех ячеек) — полный перебор.
+        """
+        def center_m(cell: Tuple[int, int]) -> float:
+            return haversine_m(latitude, longitude, (cell[0] + 0.5) * self.cell_deg, (cell[1] + 0.5) * self.cell_deg)
+
+        ki, kj = key
+        i_min, i_max, j_min, j_max = self.cell_span
+        ring = max(0, i_min - ki, ki - i_max, j_min - kj, kj - j_max)
+        last_ring = max(ki - i_min, i_max - ki, kj - j_min, j_max - kj)
+        best, best_m = key, math.inf
+        examined = 0
+        while ring <= last_ring:
+            # Центр ячейки кольца отстоит от точки минимум на ring - 0.5 ячейки по широте или долготе
+            far_lat = min(abs(latitude) + (ring + 1) * self.cell_deg, 90.0)
+            if (ring - 0.5) * self.cell_deg * DEGREE_M * math.cos(math.radians(far_lat)) > best_m:
+                break
+            for i in range(max(ki - ring, i_min), min(ki + ring, i_max) + 1):
+                if abs(i - ki) == ring:
+                    columns = range(max(kj - ring, j_min), min(kj + ring, j_max) + 1)
+                else:
+                    columns = [j for j in (kj - ring, kj + ring) if j_min <= j <= j_max]
+                examined += len(columns)
+                if examined > len(self.cells):
+                    return min(self.cells, key=center_m)
+                for j in columns:
+                    if (i, j) in self.cells:
+                        distance_m = center_m((i, j))
+                        if distance_m < best_m:
+                            best, best_m = (i, j), distance_m
+            ring += 1
+        return best
+
+
+class SpatialPriorIndex:
+    """Априоры по камерам и датасетам; камера точнее датасета и проверяется первой."""
+
+    def __init__(self, cameras: Dict[str, SpatialPrior], datasets: Dict[str, SpatialPrior], cell_deg: float = DEFAULT_CELL_DEG):
+        self.cameras = cameras
+        self.datasets = datasets
+        self.cell_deg = cell_deg
+
+    @classmethod
+    def empty(cls) -> "SpatialPriorIndex":
+        return cls({}, {})
+
+    @classmethod
+    def load(cls, path: Optional[str]) -> "SpatialPriorIndex":
+        """Загрузка файла априора; без файла — пустой индекс (геокодирование работает как раньше)."""
+        if not path or not os.path.exists(path):
+            print("⚠️ Файл пространственного априора не найден. Априор по камерам/датасетам отключен.")
+            return cls.empty()
+
+        with open(path) as f:
+            data = json.load(f)
+        if data.get("version") != PRIOR_VERSION:
+            print(f"❌ Неподдерживаемая версия пространственного априора: {data.get('version')}")
+            return cls.empty()
+
+        cell_deg = data["cell_deg"]
+        index = cls(
+            {key: SpatialPrior.from_dict(f"camera:{key}", value, cell_deg) for key, value in data["cameras"].items()},
+            {key: SpatialPrior.from_dict(f"dataset:{key}", value, cell_deg) for key, value in data["datasets"].items()},
+            cell_deg
+        )
+        print(f"✅ Пространственный априор загружен: {len(index.cameras)} камер, {len(index.datasets)} датасетов")
+        return index
+
+    @classmethod
+    def build(
+        cls,
+        rows: Iterable[Tuple[Optional[str], Optional[int], float, float]],
+        cell_deg: float = DEFAULT_CELL_DEG,
+        min_count: int = 3
+    ) -> "SpatialPriorIndex":
+        """Построение по строкам (camera_id, dataset_id, latitude, longitude)."""
+        by_camera: Dict[str, List[Tuple[float, float]]] = {}
+        by_dataset: Dict[str, List[Tuple[float, float]]] = {}
+        for camera_id, dataset_id, lat, lng in rows:
+            if camera_id:
+                by_camera.setdefault(str(camera_id), []).append((lat, lng))
+            if dataset_id is not None:
+                by_dataset.setdefault(str(dataset_id), []).append((lat, lng))
+
+        def priors(groups: Dict[str, List[Tuple[float, float]]], kind: str) -> Dict[str, SpatialPrior]:
+            # Слишком мало снимков — разброс не оценить
+            return {
+                key: SpatialPrior.from_points(f"{kind}:{key}", points, cell_deg)
+                for key, points in groups.items() if len(points) >= min_count
+            }
+
+        return cls(priors(by_camera, "camera"), priors(by_dataset, "dataset"), cell_deg)
+
+    def save(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        data = {
+            "version": PRIOR_VERSION,
+            "cell_deg": self.cell_deg,
+            "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "cameras": {key: prior.to_dict() for key, prior in self.cameras.items()},
+            "datasets": {key: prior.to_dict() for key, prior in self.datasets.items()},
+        }
+        with open(path, "w") as f:
+            json.dump(data, f, ensure_ascii=False)
+
+    def lookup(self, camera_id: Optional[str] = None, dataset_id: Optional[int] = None) -> Optional[SpatialPrior]:
+        if camera_id and camera_id in self.cameras:
+            return self.cameras[camera_id]
+        if dataset_id is not None:
+            return self.datasets.get(str(dataset_id))
+        return None
@@ -0,0 +1,179 @@
+import math
+from typing import Any, Dict, List, Optional, Tuple
+
+# Пространственные запросы к geocoding_results.
+#
+# Отбор идет через GiST-индекс по geo_mercator_point(широта, долгота) (см. init_db.sql):
+# окно карты — прямоугольник в проекции Меркатора, круг — circle в той же проекции.
+# Выдача упорядочена по удаленности от точки отсчета (центр окна / центр круга): такой
+# порядок дает KNN-обход индекса (оператор <->), который для первой страницы читает только
+# ее строки при любом размере области. Постраничная выдача — keyset-пагинация (курсор =
+# расстояние в проекции и id последней строки, плюс число уже выданных строк), а не OFFSET.
+#
+# Глубина выдачи ограничена. KNN-обход GiST всегда начинается от точки отсчета: начать его
+# с заданного расстояния нельзя, а условие "вне уже выданного круга" (NOT <@ circle) не
+# индексное. Поэтому страница на глубине N строк стоит O(N) (~25 мкс на пропущенную строку).
+# Сервис отдает не больше GEOCODING_RESULTS_MAX_DEPTH строк одной выдачи (дальше —
+# уточнить окно или радиус), а поддельный курсор упирается в statement_timeout.
+#
+# Оценка числа строк для <@ у PostgreSQL константная (0.1% таблицы): с фильтрами курсора и
+# расстояния она оказывается меньше LIMIT, и планировщик вместо KNN-обхода читает всю
+# область bitmap-сканом с сортировкой (секунды на миллионах строк). Запрос страницы
+# выполняется с отключенными bitmap-сканом и сортировкой, где без нее можно обойтись.
+
+EARTH_RADIUS_M = 6371000.0
+
+# SQLSTATE query_canceled: запрос прерван по statement_timeout
+QUERY_CANCELED = "57014"
+
+LOCATION = "geo_mercator_point(g.calculated_latitude, g.calculated_longitude)"
+ORIGIN = "geo_mercator_point($1::numeric, $2::numeric)"
+
+RESULT_COLUMNS = """
+    g.id, g.geocoding_uuid::text AS geocoding_uuid,
+    g.calculated_latitude::float8 AS latitude, g.calculated_longitude::float8 AS longitude,
+    g.formatted_address, g.coordinate_source, g.geocoding_confidence::float8 AS confidence,
+    g.geocoded_at, d.id AS detection_id, d.object_class,
+    p.id AS photo_id, p.photo_uuid::text AS photo_uuid, p.original_filename
+"""
+
+RESULT_JOINS = """
+    JOIN detection_results d ON d.id = g.detection_id
+    JOIN photo_metadata p ON p.id = d.photo_id
+"""
+
+# Расстояние на местности (формула гаверсинусов) от точки отсчета ($1, $2)
+HAVERSINE_M = f"""
+    2 * {EARTH_RADIUS_M} * asin(sqrt(
+        power(sin(radians(g.calculated_latitude::float8 - $1) / 2), 2) +
+        cos(radians($1)) * cos(radians(g.calculated_latitude::float8)) *
+        power(sin(radians(g.calculated_longitude::float8 - $2) / 2), 2)
+    ))
+"""
+
+
+def knn_page_query(region: str) -> str:
+    """
+    Страница строк области region, упорядоченных по (расстояние в проекции от $1/$2, id).
+    $3/$4 — курсор, $5 — размер страницы (+1).
+
+    KNN-обход индекса упорядочен только по расстоянию, поэтому сначала он находит
+    расстояние последней строки страницы, а затем страница с учетом равных расстояний
+    выбирается внутри круга этого радиуса.
+    """
+    return f"""
+WITH knn AS (
+    SELECT {LOCATION} <-> {ORIGIN} AS plane_distance
+    FROM geocoding_results g
+    WHERE {region}
+      AND ({LOCATION} <-> {ORIGIN}, g.id) > ($3, $4)
+    ORDER BY {LOCATION} <-> {ORIGIN}
+    LIMIT $5
+), page AS (
+    SELECT g.id, {LOCATION} <-> {ORIGIN} AS plane_distance, {HAVERSINE_M} AS distance_m
+    FROM geocoding_results g
+    WHERE {LOCATION} <@ circle({ORIGIN}, (SELECT coalesce(max(plane_distance), 0) FROM knn))
+      AND {region}
+      AND ({LOCATION} <-> {ORIGIN}, g.id) > ($3, $4)
+    ORDER BY plane_distance, g.id
+    LIMIT $5
+)
+SELECT {RESULT_COLUMNS}, page.distance_m, page.plane_distance
+FROM page
+JOIN geocoding_results g ON g.id = page.id
+{RESULT_JOINS}
+ORDER BY page.plane_distance, page.id
+"""
+
+
+VIEWPORT_QUERY = knn_page_query(
+    f"{LOCATION} <@ box(geo_mercator_point($6::numeric, $7::numeric), geo_mercator_point($8::numeric, $9::numeric))"
+)
+
+# Круг в проекции ($6) берется с запасом, точная граница — по расстоянию на местности ($7)
+NEARBY_QUERY = knn_page_query(f"{LOCATION} <@ circle({ORIGIN}, $6) AND {HAVERSINE_M} <= $7")
+
+
+def plane_radius(latitude: float, radius_m: float) -> float:
+    """
+    Радиус круга в проекции Меркатора, гарантированно покрывающий radius_m метров
+    на местности (масштаб проекции меняется с широтой в пределах круга — берется с запасом).
+    """
+    scale = EARTH_RADIUS_M * max(math.cos(math.radians(min(abs(latitude), 85.0))), 1e-6)
+    drift = math.tan(math.radians(min(abs(latitude), 85.0))) * radius_m / EARTH_RADIUS_M
+    return radius_m / scale * (1 + 2 * drift) * 1.001
+
+
+class ResultsQueryTimeout(Exception):
+    """Страница не уложилась в statement_timeout (слишком глубокий курсор или тяжелая область)."""
+
+
+class GeocodingResultsRepository:
+    """Чтение сохраненных результатов геокодирования."""
+
+    def __init__(self, pool, statement_timeout_ms: int = 2000):
+        self.pool = pool
+        self.statement_timeout_ms = statement_timeout_ms
+
+    async def _fetch_page(
+        self,
+        query: str,
+        latitude: float,
+        longitude: float,
+        limit: int,
+        after: Tuple[float, int, int],
+        *region_args: Any
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        distance, last_id, depth = after
+        async with self.pool.acquire() as connection, connection.transaction():
+            # SET LOCAL действует до конца транзакции: соединение вернется в пул с настройками по умолчанию
+            await connection.execute(
+                f"SET LOCAL statement_timeout = {int(self.statement_timeout_ms)}; "
+                "SET LOCAL enable_bitmapscan = off; SET LOCAL enable_sort = off"
+            )
+            try:
+                rows = await connection.fetch(query, latitude, longitude, distance, last_id, limit + 1, *region_args)
+            except Exception as e:
+                if getattr(e, "sqlstate", None) == QUERY_CANCELED:
+                    raise ResultsQueryTimeout(f"Страница не уложилась в {self.statement_timeout_ms} мс") from e
+                raise
+        items = [dict(row) for row in rows[:limit]]
+        next_cursor = None
+        if len(rows) > limit:
+            # repr сохраняет float без потерь: следующая страница начнется ровно после этой строки
+            next_cursor = f"{items[-1]['plane_distance']!r}:{items[-1]['id']}:{depth + len(items)}"
+        for item in items:
+            item.pop("plane_distance")
+        return items, next_cursor
+
+    async def in_viewport(
+        self,
+        min_lat: float,
+        min_lng: float,
+        max_lat: float,
+        max_lng: float,
+        limit: int,
+        after: Tuple[float, int, int] = (-1.0, 0, 0)
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """
+        Результаты внутри окна карты, от центра окна к краям.
+        Возвращает (строки, курсор следующей страницы).
+        """
+        return await self._fetch_page(
+            VIEWPORT_QUERY, (min_lat + max_lat) / 2, (min_lng + max_lng) / 2, limit, after,
+            min_lat, min_lng, max_lat, max_lng
+        )
+
+    async def within_radius(
+        self,
+        latitude: float,
+        longitude: float,
+        radius_m: float,
+        limit: int,
+        after: Tuple[float, int, int] = (-1.0, 0, 0)
+    ) -> Tuple[List[Dict[str, Any]], Optional[str]]:
+        """Результаты в радиусе radius_m метров, от ближайших. Возвращает (строки, курсор следующей страницы)."""
+        return await self._fetch_page(
+            NEARBY_QUERY, latitude, longitude, limit, after,
+            plane_radius(latitude, radius_m), radius_m
+        )
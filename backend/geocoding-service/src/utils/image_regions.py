@@ -0,0 +1,135 @@
+from typing import Dict, List, Optional, Sequence, Tuple, cast
+
+import numpy as np
+from PIL import Image
+
+# Размер входа ML-модели: вырезанное здание все равно приводится к 224x224
+MODEL_INPUT_SIZE = 224
+
+# JPEG умеет декодироваться сразу в 1/2, 1/4 или 1/8 исходного разрешения
+JPEG_DRAFT_SCALES = (8, 4, 2, 1)
+
+
+def is_decoded(image: Image.Image) -> bool:
+    """Были ли пиксели уже декодированы (Image.open только читает заголовок)."""
+    return not getattr(image, "tile", None)
+
+
+def draft_scale(image: Image.Image) -> int:
+    """Во сколько раз снимок уменьшен при декодировании (1, если draft не применялся)."""
+    decoder_config = getattr(image, "decoderconfig", None)
+    return decoder_config[0] if decoder_config else 1
+
+
+def clamp_bbox(bbox: Sequence[float], size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+    """Приводит bbox [x1, y1, x2, y2] к целым координатам в пределах снимка (не менее 1 пикселя)."""
+    width, height = size
+    x1, y1, x2, y2 = (float(v) for v in bbox)
+    x1 = min(max(int(x1), 0), width - 1)
+    y1 = min(max(int(y1), 0), height - 1)
+    x2 = min(max(int(round(x2)), x1 + 1), width)
+    y2 = min(max(int(round(y2)), y1 + 1), height)
+    return x1, y1, x2, y2
+
+
+def choose_draft_scale(bboxes: List[Tuple[int, int, int, int]], min_side: int) -> int:
+    """
+    Наибольший масштаб уменьшения JPEG, при котором каждая область
+    остается не меньше min_side по обеим сторонам.
+    """
+    smallest_side = min(min(x2 - x1, y2 - y1) for x1, y1, x2, y2 in bboxes)
+    for scale in JPEG_DRAFT_SCALES:
+        if smallest_side // scale >= min_side:
+            return scale
+    return 1
+
+
+def source_size(image: Image.Image) -> Tuple[int, int]:
+    """Размер исходного снимка (до уменьшения draft)."""
+    scale = draft_scale(image)
+    return image.size[0] * scale, image.size[1] * scale
+
+
+def apply_draft(image: Image.Image, bboxes: List[Sequence[float]], min_side: int = MODEL_INPUT_SIZE) -> None:
+    """
+    Задает масштаб декодирования еще не декодированного JPEG по самой маленькой из областей
+    bboxes (координаты исходного снимка). Pillow принимает draft только один раз, поэтому
+    снимок, здания которого обрабатываются в нескольких вызовах crop_regions, нужно
+    подготовить заранее по всем его областям.
+    """
+    if not bboxes or image.format != "JPEG" or is_decoded(image) or getattr(image, "decoderconfig", None):
+        return
+    width, height = image.size
+    scale = choose_draft_scale([clamp_bbox(bbox, image.size) for bbox in bboxes], min_side)
+    # draft и при масштабе 1: повторные вызовы Pillow игнорирует, масштаб зафиксирован
+    image.draft(image.mode, (-(-width // scale), -(-height // scale)))
+
+
+def crop_regions(
+    image: Image.Image,
+    bboxes: List[Sequence[float]],
+    min_side: int = MODEL_INPUT_SIZE
+) -> List[Image.Image]:
+    """
+    Вырезает области снимка, декодируя его не в большем разрешении, чем нужно.
+
+    bbox задаются в координатах исходного снимка. Для еще не декодированного JPEG
+    масштаб декодирования (draft) выбирается по самой маленькой области, так что
+    после приведения к входу модели качество не теряется. Остальные форматы
+    (PNG и др.) не поддерживают частичное декодирование и читаются целиком;
+    вырезанные области в любом случае копируются, и исходный снимок можно
+    закрыть сразу после вызова.
+    """
+    if not bboxes:
+        return []
+
+    # Если draft уже применен (apply_draft), он выбран по всем областям снимка
+    apply_draft(image, bboxes, min_side)
+    boxes = [clamp_bbox(bbox, source_size(image)) for bbox in bboxes]
+
+    scale = draft_scale(image)
+    crops = []
+    for x1, y1, x2, y2 in boxes:
+        left, top = x1 // scale, y1 // scale
+        right, bottom = max(x2 // scale, left + 1), max(y2 // scale, top + 1)
+        crop = image.crop((left, top, right, bottom))
+        crops.append(reduce_to_min_side(crop, min_side))
+    return crops
+
+
+def reduce_to_min_side(image: Image.Image, min_side: int = MODEL_INPUT_SIZE) -> Image.Image:
+    """Дешевое целочисленное уменьшение слишком большой области перед Resize модели."""
+    factor = min(image.size) // min_side
+    if factor < 2:
+        return image
+    return image.reduce(factor)
+
+
+def crop_image_items(
+    items: List[Tuple[Image.Image, Sequence[float]]],
+    min_side: int = MODEL_INPUT_SIZE
+) -> List[Image.Image]:
+    """
+    Вырезает области для пар (снимок, bbox), группируя их по снимку:
+    каждый снимок декодируется один раз для всех своих зданий. Порядок сохраняется.
+    """
+    crops: List[Optional[Image.Image]] = [None] * len(items)
+    groups: Dict[int, List[int]] = {}
+    for index, (image, _) in enumerate(items):
+        groups.setdefault(id(image), []).append(index)
+
+    for indexes in groups.values():
+        image = items[indexes[0]][0]
+        for index, crop in zip(indexes, crop_regions(image, [items[i][1] for i in indexes], min_side)):
+            crops[index] = crop
+    return cast(List[Image.Image], crops)
+
+
+def to_model_input(crops: List[Image.Image], size: int = MODEL_INPUT_SIZE) -> np.ndarray:
+    """Пакет вырезанных областей в виде массива (N, size, size, 3) uint8 — компактно для передачи между процессами."""
+    batch = np.empty((len(crops), size, size, 3), dtype=np.uint8)
+    for index, crop in enumerate(crops):
+        if crop.mode != "RGB":
+            crop = crop.convert("RGB")
+        batch[index] = np.asarray(crop.resize((size, size), Image.BILINEAR))
+    return batch
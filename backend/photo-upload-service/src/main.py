@@ -1,24 +1,54 @@
 from fastapi import FastAPI, UploadFile, File, HTTPException, status
 from fastapi.middleware.cors import CORSMiddleware
+from contextlib import asynccontextmanager
 import os
 import httpx
 import uuid
 import io
+import hashlib
 from PIL import Image
 from pydantic import BaseModel
-from typing import List, Dict, Optional
+from typing import List, Dict, Optional, Any, Tuple
 from datetime import datetime
 import traceback 
 
+from database import create_pool, close_pool
+from repository import PipelineRepository, DatasetStatsRepository, build_photo_record
+from write_behind import WriteBehindBuffer
+from timing import TimingRecorder, install_timing, httpx_event_hooks
+from metrics import install_metrics, instrument_httpx
+
 # Определение модели запроса для Geocoding Service (нужно для создания JSON-запроса)
 class BuildingGeocodingRequest(BaseModel):
     file_id: str
     building_bbox: Optional[List[float]] = None
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # Пул соединений с БД создается один раз; без БД сервис работает как раньше
+    app.state.db_pool = await create_pool()
+    app.state.repository = PipelineRepository(app.state.db_pool) if app.state.db_pool else None
+    app.state.dataset_stats = DatasetStatsRepository(app.state.db_pool) if app.state.db_pool else None
+    # Запись в БД не задерживает ответ: результаты сбрасываются пакетами в фоне
+    app.state.write_buffer = None
+    if app.state.repository:
+        app.state.write_buffer = WriteBehindBuffer(save_pipeline_batch)
+        app.state.write_buffer.start()
+    # Замеры этапов пишутся в processing_history пакетами
+    timings.start(app.state.db_pool)
+    yield
+    # Сначала сбрасываем накопленные результаты, затем закрываем пул
+    if app.state.write_buffer:
+        await app.state.write_buffer.stop()
+    await timings.stop()
+    await close_pool(app.state.db_pool)
+
+
 app = FastAPI(
     title="Photo Upload Service",
     description="Сервис загрузки и валидации фотографий",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan
 )
 
 app.add_middleware(
@@ -29,6 +59,12 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# Замеры этапов и X-Request-ID (см. timing.py)
+timings = TimingRecorder("photo-upload-service")
+install_timing(app, timings)
+# Метрики Prometheus: /metrics (см. metrics.py)
+install_metrics(app)
+
 # Конфигурация
 UPLOAD_DIR = os.getenv("UPLOAD_DIR", "storage/uploaded_photos/raw")
 ALLOWED_EXTENSIONS = {'.jpg', '.jpeg', '.png'}
@@ -44,12 +80,12 @@ os.makedirs(UPLOAD_DIR, exist_ok=True)
 # Вспомогательные функции
 # --------------------------------------------------------------------------------------------------
 
-async def call_cv_processing_service(file_id: str, original_filename: str, file_path: str) -> List[Dict]:
-    """Вызов CV Processing Service для детекции зданий."""
+async def call_cv_processing_service(file_id: str, original_filename: str, file_path: str) -> Dict[str, Any]:
+    """Вызов CV Processing Service для детекции зданий (метаданные снимка и список зданий)."""
     print(f"🔄 CV-Processing: Отправка на обработку {file_id}")
     
     try:
-        async with httpx.AsyncClient(timeout=60.0) as client:
+        async with httpx.AsyncClient(timeout=60.0, event_hooks=instrument_httpx(httpx_event_hooks(timings))) as client:
             # Предполагаем, что CV Service принимает JSON с file_id и file_path
             response = await client.post(
                 f"{CV_PROCESSING_SERVICE_URL}/api/process",
@@ -61,9 +97,9 @@ async def call_cv_processing_service(file_id: str, original_filename: str, file_
             )
             response.raise_for_status()
             
-            # Предполагаем, что CV Service возвращает данные в формате {"results": {"buildings": [...]}}
-            cv_result = response.json().get("results", {}).get("buildings", [])
-            print(f"✅ CV-Processing: Обнаружено {len(cv_result)} зданий.")
+            # Предполагаем, что CV Service возвращает данные в формате {"results": {"metadata": {...}, "buildings": [...]}}
+            cv_result = response.json().get("results", {})
+            print(f"✅ CV-Processing: Обнаружено {len(cv_result.get('buildings', []))} зданий.")
             return cv_result
             
     except httpx.HTTPStatusError as e:
@@ -80,7 +116,7 @@ async def call_geocoding_service(request_data: BuildingGeocodingRequest) -> Dict
     print(f"🔄 Geocoding: Отправка BBOX ({bbox_log}) для {request_data.file_id}")
     
     try:
-        async with httpx.AsyncClient(timeout=30.0) as client:
+        async with httpx.AsyncClient(timeout=30.0, event_hooks=instrument_httpx(httpx_event_hooks(timings))) as client:
             response = await client.post(
                 f"{GEOCODING_SERVICE_URL}/api/geocode-building",
                 json=request_data.model_dump(),
@@ -97,8 +133,8 @@ async def call_geocoding_service(request_data: BuildingGeocodingRequest) -> Dict
         print(f"❌ Geocoding Service Connection Error: {e}")
         raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, detail=f"Geocoding Service Unavailable: {str(e)}")
 
-async def upload_photo(file: UploadFile) -> Dict:
-    """Обработка одного загруженного файла."""
+async def upload_photo(file: UploadFile) -> Tuple[Dict, Dict[str, Any]]:
+    """Обработка одного загруженного файла: ответ клиенту и строки для сохранения в БД."""
     if file.filename is None:
         raise HTTPException(status.HTTP_400_BAD_REQUEST, "Отсутствует имя файла.")
         
@@ -125,9 +161,13 @@ async def upload_photo(file: UploadFile) -> Dict:
         
         if file_size > MAX_FILE_SIZE:
             raise HTTPException(status.HTTP_413_REQUEST_ENTITY_TOO_LARGE, f"Файл {file.filename} ({file_size} bytes) превышает максимальный размер {MAX_FILE_SIZE} bytes.")
+
+        # SHA-256 содержимого: ETag при скачивании снимка (export-service)
+        file_hash = hashlib.sha256(contents).hexdigest()
             
-        with open(file_path, "wb") as f:
-            f.write(contents)
+        with timings.stage("upload_write", file_id=file_id, file_size=file_size):
+            with open(file_path, "wb") as f:
+                f.write(contents)
             
         print(f"✅ Файл сохранен. Размер: {file_size} bytes")
         
@@ -139,7 +179,8 @@ async def upload_photo(file: UploadFile) -> Dict:
         raise HTTPException(status.HTTP_500_INTERNAL_SERVER_ERROR, f"Ошибка при сохранении файла: {str(e)}")
 
     # 1. Вызов CV Processing Service
-    cv_buildings = await call_cv_processing_service(file_id, original_filename_safe, file_path)
+    cv_results = await call_cv_processing_service(file_id, original_filename_safe, file_path)
+    cv_buildings = cv_results.get("buildings", [])
     
     geocoding_result = {"success": False, "note": "Здания не обнаружены."}
     
@@ -162,13 +203,33 @@ async def upload_photo(file: UploadFile) -> Dict:
             geocoding_result = {"success": False, "note": "Здания обнаружены, но BBOX отсутствует или некорректен."}
 
     # 3. Формирование финального ответа
+    record = build_photo_record(file_id, original_filename_safe, file_path, file_size, cv_results, geocoding_result, file_hash)
     return {
         "file_id": file_id,
         "filename": original_filename_safe,
         "size": file_size,
         "status": "processed",
         "geocoding_result": geocoding_result
-    }
+    }, record
+
+
+async def save_pipeline_batch(records: List[Dict[str, Any]]) -> None:
+    """Сброс пакета из буфера: все снимки, детекции и геокоды одним запросом к БД."""
+    with timings.stage("pipeline_persist", photos=len(records)):
+        saved = await app.state.repository.save_results(records)
+    print(f"💾 БД: сохранено снимков {saved['photos']}, детекций {saved['detections']}, геокодов {saved['geocodes']}")
+
+
+async def enqueue_pipeline_results(record: Dict[str, Any]) -> None:
+    """Передача результатов снимка в буфер отложенной записи в БД."""
+    write_buffer: Optional[WriteBehindBuffer] = app.state.write_buffer
+    if write_buffer is None:
+        return
+    try:
+        await write_buffer.put(record)
+    except Exception as e:
+        # Ошибка записи не отменяет обработку: результаты уже в ответе клиенту
+        print(f"❌ Результаты {record['photo']['file_path']} не поставлены в очередь записи: {e}")
 
 # --------------------------------------------------------------------------------------------------
 # Эндпоинты
@@ -195,7 +256,8 @@ async def upload_files(files: List[UploadFile] = File(...)): # <-- ИСПРАВ
             await file.seek(0) 
 
             # Вызов функции, обрабатывающей один файл
-            result = await upload_photo(file)
+            result, record = await upload_photo(file)
+            await enqueue_pipeline_results(record)
             results.append({
                 "filename": file.filename,
                 "status": "success",
@@ -222,6 +284,37 @@ async def upload_files(files: List[UploadFile] = File(...)): # <-- ИСПРАВ
         "results": results
     }
 
+@app.get("/api/persistence/stats")
+async def persistence_stats():
+    """Состояние буфера отложенной записи: размер пакетов, задержка записи, backpressure."""
+    write_buffer: Optional[WriteBehindBuffer] = app.state.write_buffer
+    if write_buffer is None:
+        return {"enabled": False}
+    return {"enabled": True, **write_buffer.snapshot()}
+
+def dataset_stats_repository() -> DatasetStatsRepository:
+    if app.state.dataset_stats is None:
+        raise HTTPException(status.HTTP_503_SERVICE_UNAVAILABLE, "База данных недоступна")
+    return app.state.dataset_stats
+
+@app.get("/api/datasets/stats")
+async def all_dataset_stats():
+    """Статистика по всем датасетам: число фото по статусам обработки и с координатами."""
+    return {"datasets": await dataset_stats_repository().all()}
+
+@app.get("/api/datasets/{dataset_id}/stats")
+async def dataset_stats(dataset_id: int):
+    """Статистика по датасету (чтение одной строки сводной таблицы)."""
+    stats = await dataset_stats_repository().get(dataset_id)
+    if stats is None:
+        raise HTTPException(status.HTTP_404_NOT_FOUND, f"Датасет {dataset_id} не найден")
+    return stats
+
+@app.get("/api/timings")
+async def timing_stats():
+    """Длительность этапов обработки (p50/p95, CPU) и состояние записи в processing_history."""
+    return timings.snapshot()
+
 @app.get("/api/files")
 async def list_uploaded_files():
     """Список загруженных файлов"""
@@ -0,0 +1,229 @@
+import uuid
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+# Запись результатов пайплайна (photo_metadata -> detection_results -> geocoding_results).
+#
+# Все строки пакета снимков сохраняются ОДНИМ SQL-запросом: данные передаются массивами
+# и разворачиваются через unnest, связи между таблицами устанавливаются внутри запроса
+# (CTE с RETURNING). Число обращений к БД не зависит от числа снимков, зданий и геокодов.
+#
+# UUID всех строк формируются на клиенте детерминированно (от file_id), а вставки —
+# upsert по уникальным ключам: повторная запись того же пакета не создает дублей.
+
+SAVE_RESULTS_QUERY = """
+WITH photos AS (
+    INSERT INTO photo_metadata (
+        photo_uuid, original_filename, file_path, file_size, mime_type, file_hash,
+        processing_status, processing_stage, processed_at
+    )
+    SELECT p.photo_uuid, p.original_filename, p.file_path, p.file_size, p.mime_type, p.file_hash,
+           'completed', p.processing_stage, CURRENT_TIMESTAMP
+    FROM unnest($1::uuid[], $2::text[], $3::text[], $4::bigint[], $5::text[], $6::text[], $7::text[])
+        AS p(photo_uuid, original_filename, file_path, file_size, mime_type, file_hash, processing_stage)
+    ON CONFLICT (file_path) DO UPDATE SET
+        file_hash = EXCLUDED.file_hash,
+        processing_status = EXCLUDED.processing_status,
+        processing_stage = EXCLUDED.processing_stage,
+        processed_at = EXCLUDED.processed_at,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING id, photo_uuid
+), detections AS (
+    INSERT INTO detection_results (
+        detection_uuid, photo_id, object_class, confidence_score,
+        bbox_x1, bbox_y1, bbox_x2, bbox_y2, model_name
+    )
+    SELECT d.detection_uuid, photos.id, d.object_class, d.confidence_score,
+           d.bbox_x1, d.bbox_y1, d.bbox_x2, d.bbox_y2, d.model_name
+    FROM unnest($8::uuid[], $9::uuid[], $10::text[], $11::float8[],
+                $12::float8[], $13::float8[], $14::float8[], $15::float8[], $16::text[])
+        AS d(detection_uuid, photo_uuid, object_class, confidence_score,
+             bbox_x1, bbox_y1, bbox_x2, bbox_y2, model_name)
+    JOIN photos ON photos.photo_uuid = d.photo_uuid
+    ON CONFLICT (detection_uuid) DO UPDATE SET
+        confidence_score = EXCLUDED.confidence_score
+    RETURNING id, detection_uuid
+), geocodes AS (
+    INSERT INTO geocoding_results (
+        geocoding_uuid, detection_id, calculated_latitude, calculated_longitude,
+        formatted_address, coordinate_source, geocoding_confidence, timezone, elevation
+    )
+    SELECT g.geocoding_uuid, detections.id, g.latitude, g.longitude,
+           g.formatted_address, g.coordinate_source, g.confidence, g.timezone, g.elevation
+    FROM unnest($17::uuid[], $18::uuid[], $19::float8[], $20::float8[],
+                $21::text[], $22::text[], $23::float8[], $24::text[], $25::float8[])
+        AS g(geocoding_uuid, detection_uuid, latitude, longitude,
+             formatted_address, coordinate_source, confidence, timezone, elevation)
+    JOIN detections ON detections.detection_uuid = g.detection_uuid
+    ON CONFLICT (geocoding_uuid) DO UPDATE SET
+        calculated_latitude = EXCLUDED.calculated_latitude,
+        calculated_longitude = EXCLUDED.calculated_longitude,
+        formatted_address = EXCLUDED.formatted_address,
+        updated_at = CURRENT_TIMESTAMP
+    RETURNING 1
+)
+SELECT (SELECT count(*) FROM photos) AS photos,
+       (SELECT count(*) FROM detections) AS detections,
+       (SELECT count(*) FROM geocodes) AS geocodes
+"""
+
+MIME_TYPES = {"JPEG": "image/jpeg", "PNG": "image/png"}
+
+
+def normalize_bbox(bbox: Sequence[float], image_size: Sequence[int]) -> Optional[Tuple[float, float, float, float]]:
+    """
+    BBOX в пикселях -> нормализованные координаты 0-1 (так хранит detection_results).
+    None, если рамка после обрезки по границам снимка вырождается.
+    """
+    width, height = image_size
+    x1, y1, x2, y2 = (float(v) for v in bbox)
+    x1, x2 = (min(max(v / width, 0.0), 1.0) for v in (x1, x2))
+    y1, y2 = (min(max(v / height, 0.0), 1.0) for v in (y1, y2))
+    x1, y1, x2, y2 = (round(v, 4) for v in (x1, y1, x2, y2))
+    if x1 >= x2 or y1 >= y2:
+        return None
+    return x1, y1, x2, y2
+
+
+def build_photo_record(
+    file_id: str,
+    original_filename: str,
+    file_path: str,
+    file_size: int,
+    cv_results: Dict[str, Any],
+    geocoding_result: Dict[str, Any],
+    file_hash: Optional[str] = None
+) -> Dict[str, Any]:
+    """Результаты обработки одного снимка в виде строк для save_results (file_hash — SHA-256 файла)."""
+    photo_uuid = uuid.UUID(file_id)
+    metadata = cv_results.get("metadata", {})
+    image_size = metadata.get("size")
+
+    detections = []
+    for index, building in enumerate(cv_results.get("buildings", [])):
+        bbox = building.get("bbox")
+        normalized = normalize_bbox(bbox, image_size) if bbox and image_size else None
+        if normalized is None:
+            print(f"⚠️ Детекция {index} снимка {file_id} не сохранена: некорректный BBOX {bbox}")
+            continue
+        detections.append({
+            # Детерминированный UUID: повторная запись обновляет ту же строку
+            "detection_uuid": uuid.uuid5(photo_uuid, f"detection:{index}"),
+            "index": index,
+            "object_class": building.get("class", "building"),
+            "confidence_score": round(min(max(float(building.get("confidence", 0)), 0.0), 1.0), 3),
+            "bbox": normalized,
+            "model_name": building.get("model_name", "yolov8"),
+        })
+
+    geocodes = []
+    # Геокодируется первое здание снимка (см. upload_photo)
+    if geocoding_result.get("success") and detections and detections[0]["index"] == 0:
+        coordinates = geocoding_result.get("coordinates", {})
+        meta = geocoding_result.get("meta") or {}
+        geocodes.append({
+            "geocoding_uuid": uuid.uuid5(photo_uuid, "geocoding:0"),
+            "detection_uuid": detections[0]["detection_uuid"],
+            "latitude": coordinates.get("latitude"),
+            "longitude": coordinates.get("longitude"),
+            "formatted_address": geocoding_result.get("address"),
+            "coordinate_source": geocoding_result.get("method", "unknown"),
+            "confidence": round(min(max(float(geocoding_result.get("confidence", 0)), 0.0), 1.0), 2),
+            "timezone": meta.get("timezone"),
+            "elevation": meta.get("elevation"),
+        })
+
+    return {
+        "photo": {
+            "photo_uuid": photo_uuid,
+            "original_filename": original_filename,
+            "file_path": file_path,
+            "file_size": file_size,
+            "mime_type": MIME_TYPES.get(str(metadata.get("format", "")).upper()),
+            "file_hash": file_hash,
+            "processing_stage": "geocoded" if geocodes else "detected",
+        },
+        "detections": detections,
+        "geocodes": geocodes,
+    }
+
+
+class PipelineRepository:
+    """Сохранение результатов пайплайна через общий пул соединений."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def save_results(self, records: List[Dict[str, Any]]) -> Dict[str, int]:
+        """Сохраняет пакет снимков со всеми детекциями и геокодами одним запросом (атомарно)."""
+        if not records:
+            return {"photos": 0, "detections": 0, "geocodes": 0}
+
+        photos = [record["photo"] for record in records]
+        detections = [
+            (record["photo"]["photo_uuid"], detection) for record in records for detection in record["detections"]
+        ]
+        geocodes = [geocode for record in records for geocode in record["geocodes"]]
+
+        row = await self.pool.fetchrow(
+            SAVE_RESULTS_QUERY,
+            # photo_metadata
+            [p["photo_uuid"] for p in photos],
+            [p["original_filename"] for p in photos],
+            [p["file_path"] for p in photos],
+            [p["file_size"] for p in photos],
+            [p["mime_type"] for p in photos],
+            [p["file_hash"] for p in photos],
+            [p["processing_stage"] for p in photos],
+            # detection_results
+            [d["detection_uuid"] for _, d in detections],
+            [photo_uuid for photo_uuid, _ in detections],
+            [d["object_class"] for _, d in detections],
+            [d["confidence_score"] for _, d in detections],
+            [d["bbox"][0] for _, d in detections],
+            [d["bbox"][1] for _, d in detections],
+            [d["bbox"][2] for _, d in detections],
+            [d["bbox"][3] for _, d in detections],
+            [d["model_name"] for _, d in detections],
+            # geocoding_results
+            [g["geocoding_uuid"] for g in geocodes],
+            [g["detection_uuid"] for g in geocodes],
+            [g["latitude"] for g in geocodes],
+            [g["longitude"] for g in geocodes],
+            [g["formatted_address"] for g in geocodes],
+            [g["coordinate_source"] for g in geocodes],
+            [g["confidence"] for g in geocodes],
+            [g["timezone"] for g in geocodes],
+            [g["elevation"] for g in geocodes],
+        )
+        return dict(row)
+
+
+# Статистика по датасетам из dataset_photo_stats (поддерживается триггерами photo_metadata,
+# см. init_db.sql): чтение не агрегирует photo_metadata и не зависит от числа фото
+DATASET_STATS_QUERY = """
+SELECT d.id AS dataset_id, d.name, d.source_type,
+       COALESCE(s.total_photos, 0) AS total_photos,
+       COALESCE(s.pending_photos, 0) AS pending_photos,
+       COALESCE(s.processing_photos, 0) AS processing_photos,
+       COALESCE(s.completed_photos, 0) AS completed_photos,
+       COALESCE(s.failed_photos, 0) AS failed_photos,
+       COALESCE(s.photos_with_coords, 0) AS photos_with_coords,
+       s.updated_at
+FROM datasets d
+LEFT JOIN dataset_photo_stats s ON s.dataset_id = d.id
+"""
+
+
+class DatasetStatsRepository:
+    """Чтение статистики по датасетам."""
+
+    def __init__(self, pool):
+        self.pool = pool
+
+    async def all(self) -> List[Dict[str, Any]]:
+        rows = await self.pool.fetch(DATASET_STATS_QUERY + " ORDER BY d.id")
+        return [dict(row) for row in rows]
+
+    async def get(self, dataset_id: int) -> Optional[Dict[str, Any]]:
+        row = await self.pool.fetchrow(DATASET_STATS_QUERY + " WHERE d.id = $1", dataset_id)
+        return dict(row) if row else None
@@ -0,0 +1,278 @@
+import asyncio
+import contextvars
+import json
+import os
+import resource
+import threading
+import time
+import uuid
+from collections import deque
+from contextlib import contextmanager, suppress
+from datetime import datetime, timezone
+from typing import Any, Deque, Dict, Iterator, List, Optional
+
+# Замеры этапов обработки (одинаковый модуль во всех сервисах).
+#
+# - ID запроса (заголовок X-Request-ID) принимается или создается middleware и передается
+#   во все исходящие вызовы httpx, поэтому этапы одного снимка во всех сервисах
+#   связаны общим request_id;
+# - этап — блок `with timings.stage("cv_inference"):`: длительность, CPU процесса и RSS;
+#   вызовы внешних сервисов через httpx замеряются автоматически (httpx_event_hooks);
+# - сводка по этапам отдается эндпоинтом сервиса, а сами замеры пакетами пишутся
+#   в processing_history (если у сервиса есть БД). Замеры — телеметрия: при ошибке
+#   записи пакет отбрасывается, при переполнении буфера отбрасываются старые замеры.
+
+REQUEST_ID_HEADER = "X-Request-ID"
+
+TIMING_FLUSH_INTERVAL = float(os.getenv("TIMING_FLUSH_INTERVAL", 2.0))
+TIMING_MAX_BATCH = int(os.getenv("TIMING_MAX_BATCH", 500))
+TIMING_MAX_PENDING = int(os.getenv("TIMING_MAX_PENDING", 10000))
+
+# Служебные пути не замеряются
+UNTIMED_PATHS = {"/health", "/api/health", "/api/timings", "/metrics"}
+# Запросы, не совпавшие ни с одним маршрутом (404 сканеров и т.п.), — одним этапом:
+# произвольные пути не должны порождать новые этапы
+UNMATCHED_ROUTE = "<unmatched>"
+# Длина processing_history.action
+ACTION_MAX_LENGTH = 100
+
+_request_id: contextvars.ContextVar[Optional[str]] = contextvars.ContextVar("request_id", default=None)
+
+INSERT_HISTORY_QUERY = """
+INSERT INTO processing_history (
+    service_name, action, status, input_data, error_details,
+    processing_time_ms, resource_usage, processed_at
+)
+SELECT $1, h.action, h.status, h.input_data, h.error_details,
+       h.processing_time_ms, h.resource_usage, h.processed_at
+FROM unnest($2::text[], $3::text[], $4::jsonb[], $5::text[], $6::int[], $7::jsonb[], $8::timestamptz[])
+    AS h(action, status, input_data, error_details, processing_time_ms, resource_usage, processed_at)
+"""
+
+_PAGE_SIZE = os.sysconf("SC_PAGE_SIZE") if hasattr(os, "sysconf") else 4096
+
+
+def current_request_id() -> Optional[str]:
+    return _request_id.get()
+
+
+def rss_mb() -> float:
+    """Текущий RSS процесса (на Linux), иначе пиковый."""
+    try:
+        with open("/proc/self/statm") as f:
+            return round(int(f.read().split()[1]) * _PAGE_SIZE / 2 ** 20, 1)
+    except (OSError, ValueError, IndexError):
+        return round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 1)
+
+
+class TimingRecorder:
+    """Замеры этапов сервиса: сводка в памяти и пакетная запись в processing_history."""
+
+    def __init__(self, service_name: str, window: int = 512):
+        self.service_name = service_name
+        self.window = window
+        self._lock = threading.Lock()
+        self._stages: Dict[str, Dict[str, Any]] = {}
+
+        self._pending: Deque[tuple] = deque()
+        self._pool = None
+        self._task: Optional[asyncio.Task] = None
+        self.written = 0
+        self.dropped = 0
+        self.last_error: Optional[str] = None
+
+    def start(self, pool) -> None:
+        """Запуск фоновой записи в processing_history (без БД замеры только в сводке)."""
+        self._pool = pool
+        if pool is not None and self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            # Отмененная запись возвращает пакет в очередь (flush): дописываем его ниже
+            with suppress(asyncio.CancelledError):
+                await self._task
+            self._task = None
+            await self.flush()
+
+    @contextmanager
+    def stage(self, action: str, **details: Any) -> Iterator[Dict[str, Any]]:
+        """
+        Замер этапа. details (и то, что добавлено в возвращаемый словарь внутри блока)
+        сохраняются в input_data. CPU — время процесса, в том числе параллельных запросов.
+        """
+        started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        error = None
+        try:
+            yield details
+        except BaseException as e:
+            error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            self.record(
+                action,
+                (time.perf_counter() - started_at) * 1000,
+                cpu_ms=(time.process_time() - cpu_started_at) * 1000,
+                error=error,
+                details=details
+            )
+
+    def record(
+        self,
+        action: str,
+        duration_ms: float,
+        cpu_ms: Optional[float] = None,
+        error: Optional[str] = None,
+        details: Optional[Dict[str, Any]] = None
+    ) -> None:
+        """Добавляет замер (потокобезопасно: этапы выполняются и в asyncio.to_thread)."""
+        # Слишком длинное имя сорвало бы запись всего пакета замеров в processing_history
+        action = action[:ACTION_MAX_LENGTH]
+        memory = rss_mb()
+        with self._lock:
+            stats = self._stages.get(action)
+            if stats is None:
+                stats = self._stages[action] = {
+                    "count": 0, "errors": 0, "total_ms": 0.0, "max_ms": 0.0, "cpu_ms": 0.0,
+                    "durations": deque(maxlen=self.window),
+                }
+            stats["count"] += 1
+            stats["errors"] += error is not None
+            stats["total_ms"] += duration_ms
+            stats["max_ms"] = max(stats["max_ms"], duration_ms)
+            stats["cpu_ms"] += cpu_ms or 0.0
+            stats["durations"].append(duration_ms)
+
+        if self._pool is None:
+            return
+        if len(self._pending) >= TIMING_MAX_PENDING:
+            self._pending.popleft()
+            self.dropped += 1
+        usage = {"rss_mb": memory}
+        if cpu_ms is not None:
+            usage["cpu_ms"] = round(cpu_ms, 1)
+        self._pending.append((
+            action,
+            "error" if error else "success",
+            json.dumps({"request_id": current_request_id(), **(details or {})}, default=str),
+            error,
+            int(round(duration_ms)),
+            json.dumps(usage),
+            datetime.now(timezone.utc),
+        ))
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(TIMING_FLUSH_INTERVAL)
+            await self.flush()
+
+    async def flush(self) -> None:
+        while self._pending and self._pool is not None:
+            batch = [self._pending.popleft() for _ in range(min(TIMING_MAX_BATCH, len(self._pending)))]
+            try:
+                await self._pool.execute(INSERT_HISTORY_QUERY, self.service_name, *map(list, zip(*batch)))
+                self.written += len(batch)
+            except asyncio.CancelledError:
+                self._pending.extendleft(reversed(batch))
+                raise
+            except Exception as e:
+                self.dropped += len(batch)
+                self.last_error = f"{type(e).__name__}: {e}"
+                print(f"❌ Замеры этапов не записаны в processing_history ({len(batch)} шт.): {self.last_error}")
+                return
+
+    def snapshot(self) -> Dict[str, Any]:
+        with self._lock:
+            stages = {
+                action: {
+                    "count": stats["count"],
+                    "errors": stats["errors"],
+                    "avg_ms": round(stats["total_ms"] / stats["count"], 1),
+                    "p50_ms": percentile(list(stats["durations"]), 0.5),
+                    "p95_ms": percentile(list(stats["durations"]), 0.95),
+                    "max_ms": round(stats["max_ms"], 1),
+                    "avg_cpu_ms": round(stats["cpu_ms"] / stats["count"], 1),
+                }
+                for action, stats in sorted(self._stages.items())
+            }
+        return {
+            "service": self.service_name,
+            "rss_mb": rss_mb(),
+            "stages": stages,
+            "history": {
+                "enabled": self._pool is not None,
+                "pending": len(self._pending),
+                "written": self.written,
+                "dropped": self.dropped,
+                "last_error": self.last_error,
+            },
+        }
+
+
+def route_template(request) -> str:
+    """
+    Шаблон маршрута запроса (/api/datasets/{dataset_id}/stats) или UNMATCHED_ROUTE.
+    Маршрут FastAPI записывает в scope при маршрутизации, поэтому вызывать после call_next.
+    """
+    return getattr(request.scope.get("route"), "path", None) or UNMATCHED_ROUTE
+
+
+def install_timing(app, recorder: TimingRecorder) -> None:
+    """Middleware: ID запроса (X-Request-ID) и замер обработки каждого запроса."""
+
+    @app.middleware("http")
+    async def timing_middleware(request, call_next):
+        request_id = request.headers.get(REQUEST_ID_HEADER) or uuid.uuid4().hex
+        token = _request_id.set(request_id)
+        started_at = time.perf_counter()
+        cpu_started_at = time.process_time()
+        try:
+            response = await call_next(request)
+            if request.url.path not in UNTIMED_PATHS:
+                recorder.record(
+                    f"request {request.method} {route_template(request)}",
+                    (time.perf_counter() - started_at) * 1000,
+                    cpu_ms=(time.process_time() - cpu_started_at) * 1000,
+                    error=f"HTTP {response.status_code}" if response.status_code >= 500 else None,
+                    details={"status_code": response.status_code}
+                )
+        finally:
+            _request_id.reset(token)
+        response.headers[REQUEST_ID_HEADER] = request_id
+        return response
+
+
+def httpx_event_hooks(recorder: TimingRecorder) -> Dict[str, list]:
+    """
+    Хуки для httpx.AsyncClient(event_hooks=...): передают X-Request-ID текущего запроса
+    и замеряют каждый вызов внешнего сервиса (до получения заголовков ответа).
+    """
+
+    async def on_request(request) -> None:
+        request_id = current_request_id()
+        if request_id and REQUEST_ID_HEADER not in request.headers:
+            request.headers[REQUEST_ID_HEADER] = request_id
+        request.extensions["timing_started_at"] = time.perf_counter()
+
+    async def on_response(response) -> None:
+        request = response.request
+        started_at = request.extensions.get("timing_started_at")
+        if started_at is None:
+            return
+        recorder.record(
+            f"http {request.method} {request.url.host}{request.url.path}",
+            (time.perf_counter() - started_at) * 1000,
+            error=f"HTTP {response.status_code}" if response.status_code >= 500 else None,
+            details={"status_code": response.status_code}
+        )
+
+    return {"request": [on_request], "response": [on_response]}
@@ -0,0 +1,250 @@
+import asyncio
+import os
+import random
+import time
+from collections import deque
+from typing import Any, Awaitable, Callable, Deque, Dict, List, Optional, Tuple
+
+# Параметры по умолчанию (переопределяются переменными окружения)
+WRITE_BEHIND_MAX_BATCH = int(os.getenv("WRITE_BEHIND_MAX_BATCH", 200))
+WRITE_BEHIND_FLUSH_INTERVAL = float(os.getenv("WRITE_BEHIND_FLUSH_INTERVAL", 1.0))
+WRITE_BEHIND_MAX_PENDING = int(os.getenv("WRITE_BEHIND_MAX_PENDING", 5000))
+WRITE_BEHIND_RETRY_BACKOFF_MAX = float(os.getenv("WRITE_BEHIND_RETRY_BACKOFF_MAX", 30.0))
+WRITE_BEHIND_SHUTDOWN_TIMEOUT = float(os.getenv("WRITE_BEHIND_SHUTDOWN_TIMEOUT", 30.0))
+# Попыток сброса одного пакета, после которых он делится в поисках ошибочной записи
+WRITE_BEHIND_MAX_ATTEMPTS = int(os.getenv("WRITE_BEHIND_MAX_ATTEMPTS", 8))
+# Сколько put() ждет места в переполненном буфере, прежде чем отказаться от записи
+WRITE_BEHIND_PUT_TIMEOUT = float(os.getenv("WRITE_BEHIND_PUT_TIMEOUT", 10.0))
+# Сколько символов записи из dead letter попадает в лог
+DEAD_LETTER_LOG_CHARS = 500
+
+
+class WriteBufferFull(Exception):
+    """Буфер переполнен дольше put_timeout: запись не принята."""
+
+
+def percentile(values: List[float], p: float) -> Optional[float]:
+    if not values:
+        return None
+    ordered = sorted(values)
+    return round(ordered[min(len(ordered) - 1, int(len(ordered) * p))], 1)
+
+
+class WriteBehindBuffer:
+    """
+    Отложенная пакетная запись: запросы кладут записи в память и сразу отвечают,
+    фоновая задача сбрасывает их в БД пакетами.
+
+    - сброс по размеру (max_batch записей) или по времени (flush_interval секунд);
+    - backpressure: при max_pending записей в буфере put() ждет освобождения места
+      не дольше put_timeout, затем запись отбрасывается (WriteBufferFull, счетчик dropped);
+    - at-least-once: запись удаляется из буфера только после успешного сброса,
+      при ошибке пакет повторяется с экспоненциальной задержкой. Повтор безопасен,
+      если flush_fn идемпотентна (upsert по ключам, см. PipelineRepository);
+    - пакет, не записанный за max_attempts попыток, делится пополам до отдельных записей:
+      записи, которые не пишутся и по одной, уходят в dead letter (лог и счетчик),
+      чтобы одна ошибочная запись не останавливала запись всех последующих;
+    - stop() дожидается сброса всех записей при штатной остановке сервиса.
+    """
+
+    def __init__(
+        self,
+        flush_fn: Callable[[List[Any]], Awaitable[Any]],
+        max_batch: int = WRITE_BEHIND_MAX_BATCH,
+        flush_interval: float = WRITE_BEHIND_FLUSH_INTERVAL,
+        max_pending: int = WRITE_BEHIND_MAX_PENDING,
+        retry_backoff_max: float = WRITE_BEHIND_RETRY_BACKOFF_MAX,
+        max_attempts: int = WRITE_BEHIND_MAX_ATTEMPTS,
+        put_timeout: float = WRITE_BEHIND_PUT_TIMEOUT,
+        window: int = 256
+    ):
+        self.flush_fn = flush_fn
+        self.max_batch = max_batch
+        self.flush_interval = flush_interval
+        self.max_pending = max(max_pending, max_batch)
+        self.retry_backoff_max = retry_backoff_max
+        self.max_attempts = max(max_attempts, 1)
+        self.put_timeout = put_timeout
+
+        # (время постановки, запись) в порядке поступления
+        self._pending: Deque[Tuple[float, Any]] = deque()
+        self._wakeup = asyncio.Event()
+        self._space = asyncio.Condition()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+        # Неудачные попытки сброса пакета в начале буфера
+        self._attempts = 0
+
+        # Метрики
+        self.enqueued = 0
+        self.flushed_records = 0
+        self.flushed_batches = 0
+        self.failed_flushes = 0
+        self.dead_letters = 0
+        self.dropped = 0
+        self.backpressure_waits = 0
+        self.backpressure_wait_ms = 0.0
+        self._batch_sizes: Deque[float] = deque(maxlen=window)
+        self._flush_ms: Deque[float] = deque(maxlen=window)
+        # Задержка записи: от постановки в буфер до фиксации в БД
+        self._lag_ms: Deque[float] = deque(maxlen=window)
+        self.last_error: Optional[str] = None
+
+    def start(self) -> None:
+        if self._task is None:
+            self._task = asyncio.create_task(self._run())
+
+    async def put(self, record: Any) -> None:
+        """
+        Добавляет запись; при переполненном буфере ждет, пока фоновый сброс освободит место,
+        но не дольше put_timeout (иначе WriteBufferFull).
+        """
+        if self._closing:
+            raise RuntimeError("Буфер записи остановлен")
+
+        if len(self._pending) >= self.max_pending:
+            self.backpressure_waits += 1
+            started_at = time.perf_counter()
+            self._wakeup.set()
+            try:
+                async with self._space:
+                    await asyncio.wait_for(
+                        self._space.wait_for(lambda: len(self._pending) < self.max_pending),
+                        timeout=self.put_timeout
+                    )
+                    # Запись добавляется под блокировкой: следующий разбуженный notify_all
+                    # ожидающий заново проверит место с учетом этой записи
+                    self._append(record)
+            except asyncio.TimeoutError:
+                self.dropped += 1
+                raise WriteBufferFull(f"Буфер записи заполнен ({self.max_pending}) дольше {self.put_timeout} с")
+            finally:
+                self.backpressure_wait_ms += (time.perf_counter() - started_at) * 1000
+        else:
+            self._append(record)
+
+    def _append(self, record: Any) -> None:
+        self._pending.append((time.monotonic(), record))
+        self.enqueued += 1
+        if len(self._pending) >= self.max_batch:
+            self._wakeup.set()
+
+    async def _run(self) -> None:
+        backoff = 0.0
+        while True:
+            if backoff:
+                await asyncio.sleep(backoff)
+            elif len(self._pending) < self.max_batch and not self._closing:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+                except asyncio.TimeoutError:
+                    pass
+            self._wakeup.clear()
+
+            if not self._pending:
+                if self._closing:
+                    return
+                continue
+
+            if await self._flush_batch():
+                backoff = 0.0
+            else:
+                # Пакет остается в начале буфера и будет повторен
+                backoff = min(max(backoff * 2, 0.5), self.retry_backoff_max) * random.uniform(0.5, 1.0)
+
+    async def _flush_batch(self) -> bool:
+        """
+        Сброс пакета из начала буфера. False — пакет не записан и будет повторен;
+        после max_attempts неудач пакет записывается по частям (_flush_split).
+        """
+        batch = [self._pending[i] for i in range(min(self.max_batch, len(self._pending)))]
+        if self._attempts >= self.max_attempts:
+            print(f"⚠️ Пакет из {len(batch)} записей не записан за {self._attempts} попыток, запись по частям")
+            await self._flush_split(batch)
+        elif not await self._try_flush(batch):
+            self._attempts += 1
+            print(f"❌ Ошибка сброса буфера записи ({len(batch)} записей, повтор позже): {self.last_error}")
+            return False
+
+        self._attempts = 0
+        for _ in batch:
+            self._pending.popleft()
+        async with self._space:
+            self._space.notify_all()
+        return True
+
+    async def _try_flush(self, batch: List[Tuple[float, Any]]) -> bool:
+        started_at = time.perf_counter()
+        try:
+            await self.flush_fn([record for _, record in batch])
+        except Exception as e:
+            self.failed_flushes += 1
+            self.last_error = f"{type(e).__name__}: {e}"
+            return False
+
+        self.flushed_records += len(batch)
+        self.flushed_batches += 1
+        self._batch_sizes.append(len(batch))
+        self._flush_ms.append((time.perf_counter() - started_at) * 1000)
+        self._lag_ms.append((time.monotonic() - batch[0][0]) * 1000)
+        return True
+
+    async def _flush_split(self, batch: List[Tuple[float, Any]]) -> None:
+        """Запись пакета половинами; запись, которая не пишется и одна, уходит в dead letter."""
+        if await self._try_flush(batch):
+            return
+        if len(batch) > 1:
+            middle = len(batch) // 2
+            await self._flush_split(batch[:middle])
+            await self._flush_split(batch[middle:])
+            return
+        self.dead_letters += 1
+        print(f"❌ Запись отброшена в dead letter ({self.last_error}): {repr(batch[0][1])[:DEAD_LETTER_LOG_CHARS]}")
+
+    async def stop(self, timeout: float = WRITE_BEHIND_SHUTDOWN_TIMEOUT) -> None:
+        """Штатная остановка: новые записи не принимаются, накопленные сбрасываются."""
+        self._closing = True
+        self._wakeup.set()
+        if self._task is None:
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(self._task), timeout=timeout)
+        except asyncio.TimeoutError:
+            self._task.cancel()
+            print(f"❌ Буфер записи не сброшен за {timeout} с: потеряно записей {len(self._pending)}")
+            return
+        print(f"✅ Буфер записи сброшен: {self.flushed_records} записей за {self.flushed_batches} пакетов")
+
+    def snapshot(self) -> Dict[str, Any]:
+        oldest_ms = (time.monotonic() - self._pending[0][0]) * 1000 if self._pending else 0.0
+        batch_sizes = list(self._batch_sizes)
+        return {
+            "pending": len(self._pending),
+            "max_pending": self.max_pending,
+            "enqueued": self.enqueued,
+            "flushed_records": self.flushed_records,
+            "flushed_batches": self.flushed_batches,
+            "failed_flushes": self.failed_flushes,
+            "dead_letters": self.dead_letters,
+            "dropped": self.dropped,
+            "last_error": self.last_error,
+            "batch_size": {
+                "max_batch": self.max_batch,
+                "avg": round(sum(batch_sizes) / len(batch_sizes), 1) if batch_sizes else None,
+                "p50": percentile(batch_sizes, 0.5),
+                "p95": percentile(batch_sizes, 0.95),
+            },
+            "flush_ms": {
+                "p50": percentile(list(self._flush_ms), 0.5),
+                "p95": percentile(list(self._flush_ms), 0.95),
+            },
+            "lag_ms": {
+                "oldest_pending": round(oldest_ms, 1),
+                "p50": percentile(list(self._lag_ms), 0.5),
+                "p95": percentile(list(self._lag_ms), 0.95),
+            },
+            "backpressure": {
+                "waits": self.backpressure_waits,
+                "wait_ms_total": round(self.backpressure_wait_ms, 1),
+            },
+        }
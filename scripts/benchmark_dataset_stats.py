@@ -0,0 +1,132 @@
+"""
+Бенчмарк чтения статистики по датасетам.
+
+Сравнивает прежний dataset_stats_view (LEFT JOIN photo_metadata ... GROUP BY при каждом
+чтении) с чтением сводной таблицы dataset_photo_stats, которую поддерживают триггеры
+photo_metadata. Для замера создается временный датасет с --photos фото (по умолчанию
+1 000 000), после замера он удаляется (--keep — оставить).
+
+Запуск из корня репозитория (БД из init_db.sql):
+    python scripts/benchmark_dataset_stats.py [--photos 1000000] [--repeats 50] [--keep]
+"""
+import argparse
+import os
+import time
+
+import psycopg2
+
+BENCH_DATASET = "benchmark_dataset_stats"
+
+# Определение dataset_stats_view до перехода на dataset_photo_stats
+LEGACY_STATS_QUERY = """
+    SELECT
+        d.name as dataset_name,
+        d.source_type,
+        d.total_photos,
+        d.processed_photos,
+        COUNT(pm.id) as actual_photos,
+        COUNT(CASE WHEN pm.processing_status = 'completed' THEN 1 END) as completed_photos,
+        COUNT(CASE WHEN pm.gps_latitude IS NOT NULL THEN 1 END) as photos_with_coords
+    FROM datasets d
+    LEFT JOIN photo_metadata pm ON d.id = pm.dataset_id
+    WHERE d.name = %s
+    GROUP BY d.id, d.name, d.source_type, d.total_photos, d.processed_photos
+"""
+
+SUMMARY_STATS_QUERY = "SELECT * FROM dataset_stats_view WHERE dataset_name = %s"
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "geo_photo_db"),
+        user=os.getenv("DB_USER", "admin"),
+        password=os.getenv("DB_PASSWORD", "admin123")
+    )
+
+
+def seed(conn, photos: int) -> float:
+    """Создает датасет с photos фото одним оператором INSERT ... SELECT. Возвращает время, с."""
+    with conn.cursor() as cursor:
+        cursor.execute(
+            "INSERT INTO datasets (name, description, source_type) VALUES (%s, %s, %s) RETURNING id",
+            (BENCH_DATASET, "Временный датасет бенчмарка", "benchmark")
+        )
+        dataset_id = cursor.fetchone()[0]
+        started_at = time.perf_counter()
+        cursor.execute("""
+            INSERT INTO photo_metadata
+            (dataset_id, original_filename, file_path, processing_status, gps_latitude, gps_longitude)
+            SELECT %s, 'photo_' || i || '.jpg', %s || '/photo_' || i || '.jpg',
+                   (ARRAY['pending', 'processing', 'completed', 'failed'])[1 + i %% 4],
+                   CASE WHEN i %% 3 = 0 THEN 55.75 + (i %% 1000) * 0.0001 END,
+                   CASE WHEN i %% 3 = 0 THEN 37.61 + (i %% 1000) * 0.0001 END
+            FROM generate_series(1, %s) AS i
+        """, (dataset_id, f"benchmark/{BENCH_DATASET}", photos))
+        conn.commit()
+        return time.perf_counter() - started_at
+
+
+def cleanup(conn) -> None:
+    with conn.cursor() as cursor:
+        cursor.execute("""
+            DELETE FROM photo_metadata
+            WHERE dataset_id = (SELECT id FROM datasets WHERE name = %s)
+        """, (BENCH_DATASET,))
+        cursor.execute("DELETE FROM datasets WHERE name = %s", (BENCH_DATASET,))
+    conn.commit()
+
+
+def measure(conn, query: str, repeats: int):
+    """Время чтения (мс): p50, p95 и результат последнего прогона."""
+    timings = []
+    row = None
+    with conn.cursor() as cursor:
+        for _ in range(repeats):
+            started_at = time.perf_counter()
+            cursor.execute(query, (BENCH_DATASET,))
+            row = cursor.fetchone()
+            timings.append((time.perf_counter() - started_at) * 1000)
+    timings.sort()
+    return timings[len(timings) // 2], timings[min(len(timings) - 1, int(len(timings) * 0.95))], row
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--photos", type=int, default=1_000_000)
+    parser.add_argument("--repeats", type=int, default=50)
+    parser.add_argument("--keep", action="store_true", help="Не удалять тестовый датасет")
+    args = parser.parse_args()
+
+    conn = connect()
+    try:
+        cleanup(conn)
+        print(f"🔄 Создание датасета с {args.photos} фото...")
+        seconds = seed(conn, args.photos)
+        print(f"✅ Вставлено за {seconds:.1f} с (счетчики обновлены триггером один раз)")
+
+        with conn.cursor() as cursor:
+            cursor.execute("ANALYZE photo_metadata")
+        conn.commit()
+
+        legacy_p50, legacy_p95, legacy_row = measure(conn, LEGACY_STATS_QUERY, max(args.repeats // 10, 3))
+        summary_p50, summary_p95, summary_row = measure(conn, SUMMARY_STATS_QUERY, args.repeats)
+
+        print(f"\n{'чтение статистики':>26} | {'p50, мс':>9} | {'p95, мс':>9}")
+        print("-" * 52)
+        print(f"{'GROUP BY по photo_metadata':>26} | {legacy_p50:>9.2f} | {legacy_p95:>9.2f}")
+        print(f"{'dataset_photo_stats':>26} | {summary_p50:>9.2f} | {summary_p95:>9.2f}")
+
+        if legacy_row != summary_row:
+            print(f"❌ Результаты расходятся:\n  {legacy_row}\n  {summary_row}")
+        else:
+            print(f"\n✅ Результаты совпадают: {summary_row}")
+    finally:
+        if not args.keep:
+            cleanup(conn)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Бенчмарк пропускной способности ML-геолокатора на CPU.
+
+Сравнивает поштучный вызов predict_coordinates (как раньше в /api/geocode-buildings)
+с пакетным predict_coordinates_batch при размерах пакета 1, 8 и 32.
+
+Запуск из корня репозитория:
+    python scripts/benchmark_geolocation_batch.py [--image path/to/photo.jpg] [--repeats 3]
+
+Результаты (1 vCPU Intel Xeon, torch 2.14, синтетический снимок 4000x3000, веса
+ImageNet; два прогона, --repeats 3 и 5), img/s:
+
+    batch |  loop     | batch
+        1 |  7.4, 5.6 | 7.7, 5.5
+        8 |  6.5, 5.4 | 6.2, 6.0
+       32 |  5.4, 6.2 | 4.5, 4.5
+
+На одном ядре пакет не дает выигрыша: torch нечем распараллелить пакет, а пакет из 32
+кадров медленнее поштучных вызовов. Выигрыш пакетной обработки ожидается на машинах с
+несколькими ядрами; перед изменением ML_MAX_BATCH_SIZE повторите замер на целевом железе.
+"""
+import argparse
+import os
+import sys
+import time
+
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "geocoding-service", "src"))
+
+from providers.bulding_geolocation import BuildingGeolocator  # noqa: E402
+
+BATCH_SIZES = [1, 8, 32]
+
+
+def make_items(image: Image.Image, count: int):
+    """Набор (снимок, bbox) со смещающимися рамками, как у нескольких зданий на одном фото."""
+    width, height = image.size
+    box_w, box_h = width // 3, height // 3
+    items = []
+    for i in range(count):
+        x1 = (i * 37) % (width - box_w)
+        y1 = (i * 53) % (height - box_h)
+        items.append((image, [x1, y1, x1 + box_w, y1 + box_h]))
+    return items
+
+
+def measure(fn, repeats: int) -> float:
+    """Лучшее время из нескольких прогонов, в секундах."""
+    best = float("inf")
+    for _ in range(repeats):
+        started_at = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - started_at)
+    return best
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--image", help="Снимок для теста (по умолчанию синтетический 4000x3000)")
+    parser.add_argument("--model-path", default=os.getenv("ML_MODEL_PATH"))
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    if args.image:
+        image = Image.open(args.image).convert("RGB")
+    else:
+        image = Image.new("RGB", (4000, 3000), (120, 130, 140))
+
+    print("🔄 Загрузка модели...")
+    geolocator = BuildingGeolocator(args.model_path)
+
+    # Прогрев: первые вызовы включают инициализацию ядер
+    geolocator.predict_coordinates_batch(make_items(image, 2))
+
+    print(f"\n{'batch':>6} | {'loop, img/s':>12} | {'batch, img/s':>13} | {'speedup':>7}")
+    print("-" * 48)
+    for batch_size in BATCH_SIZES:
+        items = make_items(image, batch_size)
+
+        loop_time = measure(lambda: [geolocator.predict_coordinates(img, bbox) for img, bbox in items], args.repeats)
+        batch_time = measure(lambda: geolocator.predict_coordinates_batch(items), args.repeats)
+
+        print(
+            f"{batch_size:>6} | {batch_size / loop_time:>12.1f} | "
+            f"{batch_size / batch_time:>13.1f} | {loop_time / batch_time:>6.2f}x"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,142 @@
+"""
+Построение индекса эмбеддингов для геолокации поиском (ML_INFERENCE_MODE=retrieval).
+
+Берет из photo_metadata снимки с известными gps_latitude/gps_longitude (импорт из Excel),
+вырезает здания по detection_results (или весь снимок, если детекций нет), считает
+эмбеддинги и сохраняет индекс в каталог: float16-матрица (memory-mapped) + списки IVF.
+
+Запуск из корня репозитория:
+    python scripts/build_embedding_index.py --output storage/embedding_index \\
+        [--model-path model.pt] [--dim 256] [--nlist 256]
+
+Затем для geocoding-service: ML_INFERENCE_MODE=retrieval, ML_INDEX_PATH=<каталог индекса>.
+"""
+import argparse
+import os
+import sys
+import time
+from typing import Dict, List, Tuple
+
+import numpy as np
+import psycopg2
+from PIL import Image
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "geocoding-service", "src"))
+
+from providers.retrieval_geolocation import EmbeddingExtractor, write_index  # noqa: E402
+from utils.image_regions import crop_image_items, to_model_input  # noqa: E402
+
+# Снимки с GPS и нормализованные (0-1) рамки их зданий; без детекций — NULL
+LABELLED_PHOTOS_QUERY = """
+    SELECT p.id, p.file_path, p.gps_latitude, p.gps_longitude,
+           d.bbox_x1, d.bbox_y1, d.bbox_x2, d.bbox_y2
+    FROM photo_metadata p
+    LEFT JOIN detection_results d ON d.photo_id = p.id AND d.object_class = %s
+    WHERE p.gps_latitude IS NOT NULL AND p.gps_longitude IS NOT NULL
+    ORDER BY p.id
+"""
+
+
+def connect():
+    return psycopg2.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "geo_photo_db"),
+        user=os.getenv("DB_USER", "admin"),
+        password=os.getenv("DB_PASSWORD", "admin123")
+    )
+
+
+def load_photos(object_class: str) -> Dict[int, Dict]:
+    """photo_id -> путь, координаты и список нормализованных рамок."""
+    photos: Dict[int, Dict] = {}
+    with connect() as conn:
+        # Серверный курсор: строки читаются порциями, а не целиком в память
+        with conn.cursor(name="labelled_photos") as cursor:
+            cursor.itersize = 5000
+            cursor.execute(LABELLED_PHOTOS_QUERY, (object_class,))
+            for photo_id, file_path, lat, lng, x1, y1, x2, y2 in cursor:
+                photo = photos.setdefault(photo_id, {
+                    "file_path": file_path, "coords": (float(lat), float(lng)), "bboxes": []
+                })
+                if x1 is not None:
+                    photo["bboxes"].append((float(x1), float(y1), float(x2), float(y2)))
+    return photos
+
+
+def embed_photos(photos: Dict[int, Dict], extractor: EmbeddingExtractor, data_root: str, batch_size: int):
+    embeddings: List[np.ndarray] = []
+    coords: List[Tuple[float, float]] = []
+    photo_ids: List[int] = []
+    pending: List[Tuple[Image.Image, List[float]]] = []
+    skipped = 0
+
+    def flush():
+        if pending:
+            embeddings.append(extractor.embed(to_model_input(crop_image_items(pending))))
+            for image in {id(image): image for image, _ in pending}.values():
+                image.close()
+            pending.clear()
+
+    for number, (photo_id, photo) in enumerate(photos.items(), start=1):
+        path = os.path.join(data_root, photo["file_path"])
+        try:
+            image = Image.open(path)
+        except Exception as e:
+            print(f"  ⚠️ Пропуск {path}: {e}")
+            skipped += 1
+            continue
+
+        width, height = image.size
+        bboxes = photo["bboxes"] or [(0.0, 0.0, 1.0, 1.0)]
+        for x1, y1, x2, y2 in bboxes:
+            pending.append((image, [x1 * width, y1 * height, x2 * width, y2 * height]))
+            coords.append(photo["coords"])
+            photo_ids.append(photo_id)
+
+        if len(pending) >= batch_size:
+            flush()
+        if number % 500 == 0:
+            print(f"  ⏳ Обработано {number}/{len(photos)} снимков...")
+    flush()
+
+    if skipped:
+        print(f"⚠️ Пропущено снимков: {skipped}")
+    if not embeddings:
+        return None, None, None
+    return np.concatenate(embeddings), np.array(coords), np.array(photo_ids)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", required=True, help="Каталог индекса (ML_INDEX_PATH)")
+    parser.add_argument("--model-path", default=os.getenv("ML_MODEL_PATH"),
+                        help="Веса BuildingGeolocationModel (по умолчанию — ResNet50 ImageNet)")
+    parser.add_argument("--data-root", default=".", help="Каталог, от которого отсчитываются file_path")
+    parser.add_argument("--object-class", default="building")
+    parser.add_argument("--dim", type=int, default=None, help="Сократить размерность PCA до dim")
+    parser.add_argument("--nlist", type=int, default=None, help="Число списков IVF (по умолчанию ~sqrt(N))")
+    parser.add_argument("--batch-size", type=int, default=32)
+    args = parser.parse_args()
+
+    started_at = time.perf_counter()
+    print("🔄 Загрузка снимков с GPS из базы данных...")
+    photos = load_photos(args.object_class)
+    print(f"📸 Снимков с координатами: {len(photos)}")
+
+    extractor = EmbeddingExtractor.pretrained(args.model_path)
+    embeddings, coords, photo_ids = embed_photos(photos, extractor, args.data_root, args.batch_size)
+    if embeddings is None:
+        print("❌ Нет ни одного снимка для индекса")
+        sys.exit(1)
+
+    meta = write_index(args.output, embeddings, coords, photo_ids, extractor, dim=args.dim, nlist=args.nlist)
+    size_mb = meta["count"] * meta["dim"] * 2 / 1024 / 1024
+    print(
+        f"✅ Индекс сохранен в {args.output}: {meta['count']} зданий, dim={meta['dim']}, "
+        f"nlist={meta['nlist']}, матрица {size_mb:.1f} МБ ({time.perf_counter() - started_at:.0f} с)"
+    )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+Построение пространственного априора для geocoding-service.
+
+По снимкам photo_metadata с известными координатами считает для каждой камеры
+(camera_id из Excel-импорта) и каждого датасета: центр, разброс, границы и сетку
+занятых ячеек. Результат — JSON, который geocoding-service загружает при старте
+(SPATIAL_PRIOR_PATH).
+
+Запуск из корня репозитория (после import_existing_data.py):
+    python scripts/build_spatial_prior.py [--output storage/spatial_prior.json] [--cell-deg 0.002]
+"""
+import argparse
+import os
+import sys
+
+import psycopg2
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "backend", "geocoding-service", "src"))
+
+from providers.spatial_prior import DEFAULT_CELL_DEG, SpatialPriorIndex  # noqa: E402
+
+
+def load_positions():
+    conn = psycopg2.connect(
+        host=os.getenv("DB_HOST", "localhost"),
+        port=os.getenv("DB_PORT", "5432"),
+        dbname=os.getenv("DB_NAME", "geo_photo_db"),
+        user=os.getenv("DB_USER", "admin"),
+        password=os.getenv("DB_PASSWORD", "admin123")
+    )
+    try:
+        with conn.cursor(name="photo_positions") as cursor:
+            cursor.itersize = 10000
+            cursor.execute("""
+                SELECT camera_id, dataset_id, gps_latitude, gps_longitude
+                FROM photo_metadata
+                WHERE gps_latitude IS NOT NULL AND gps_longitude IS NOT NULL
+            """)
+            return [(camera_id, dataset_id, float(lat), float(lng)) for camera_id, dataset_id, lat, lng in cursor]
+    finally:
+        conn.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--output", default="storage/spatial_prior.json")
+    parser.add_argument("--cell-deg", type=float, default=DEFAULT_CELL_DEG, help="Размер ячейки сетки в градусах")
+    parser.add_argument("--min-count", type=int, default=3, help="Минимум снимков для априора источника")
+    args = parser.parse_args()
+
+    print("🔄 Загрузка координат снимков из базы данных...")
+    rows = load_positions()
+    print(f"📸 Снимков с координатами: {len(rows)}")
+
+    index = SpatialPriorIndex.build(rows, cell_deg=args.cell_deg, min_count=args.min_count)
+    index.save(args.output)
+
+    max_spread_m = float(os.getenv("SPATIAL_PRIOR_MAX_SPREAD_M", 150))
+    tight = sum(1 for prior in index.cameras.values() if prior.spread_m <= max_spread_m)
+    print(f"✅ Априор сохранен в {args.output}: {len(index.cameras)} камер ({tight} с разбросом до {max_spread_m:.0f} м), "
+          f"{len(index.datasets)} датасетов")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,7 @@
 import pandas as pd
 import os
+import io
+import csv
 import psycopg2
 from datetime import datetime
 import uuid
@@ -134,8 +136,8 @@ def import_excel_data(cursor, conn, excel_file):
         # Создаем или получаем датасет
         dataset_id = get_or_create_dataset(cursor, conn, dataset_name, dataset_type)
         
-        # Импортируем записи из Excel
-        imported_count = 0
+        # Собираем записи из Excel и загружаем одним пакетом
+        rows = []
         for index, row in df.iterrows():
             try:
                 # Извлекаем данные из строки
@@ -143,6 +145,9 @@ def import_excel_data(cursor, conn, excel_file):
                 latitude = row['latitude'] if pd.notna(row['latitude']) else None
                 longitude = row['longitude'] if pd.notna(row['longitude']) else None
                 camera_id = row['camera'] if pd.notna(row['camera']) else None
+                if isinstance(camera_id, float) and camera_id.is_integer():
+                    # Номер камеры в Excel читается как float (12.0 -> "12")
+                    camera_id = int(camera_id)
                 
                 # Полный путь к файлу
                 folder_name = "dataset_1" if dataset_type == "building" else "dataset_2"
@@ -151,38 +156,28 @@ def import_excel_data(cursor, conn, excel_file):
                 # Проверяем существует ли файл
                 file_exists = os.path.exists(file_path)
                 
-                # Вставляем или обновляем запись о фото
-                cursor.execute("""
-                    INSERT INTO photo_metadata 
-                    (dataset_id, original_filename, file_path, file_size, 
-                     gps_latitude, gps_longitude, processing_status)
-                    VALUES (%s, %s, %s, %s, %s, %s, %s)
-                    ON CONFLICT (file_path) DO UPDATE SET
-                    gps_latitude = EXCLUDED.gps_latitude,
-                    gps_longitude = EXCLUDED.gps_longitude,
-                    updated_at = CURRENT_TIMESTAMP
-                """, (
+                rows.append((
                     dataset_id,
                     filename,
                     file_path,
                     os.path.getsize(file_path) if file_exists else 0,
                     latitude,
                     longitude,
+                    str(camera_id) if camera_id is not None else None,
                     'pending' if file_exists else 'file_not_found'
                 ))
                 
-                imported_count += 1
-                
-                if imported_count % 100 == 0:
-                    print(f"  ⏳ Обработано {imported_count} записей...")
-                    conn.commit()
+                if len(rows) % 1000 == 0:
+                    print(f"  ⏳ Обработано {len(rows)} записей...")
                     
             except Exception as e:
                 print(f"  ⚠️ Ошибка обработки строки {index}: {e}")
                 continue
         
-        print(f"  ✅ Импортировано {imported_count} записей из Excel")
+        # Вставляем новые записи о фото или обновляем существующие
+        imported_count = load_photos(cursor, rows, update_existing=True)
         conn.commit()
+        print(f"  ✅ Импортировано {imported_count} записей из Excel")
         
     except Exception as e:
         print(f"❌ Ошибка чтения Excel {excel_file}: {e}")
@@ -229,37 +224,32 @@ def import_photos_from_folder(cursor, conn, folder_path):
         dataset_id = get_or_create_dataset(cursor, conn, dataset_name, "folder_import")
         
         # Сканируем папку с фото
-        photo_count = 0
+        rows = []
         for filename in os.listdir(folder_path):
             if any(filename.lower().endswith(ext) for ext in photo_extensions):
                 file_path = os.path.join(folder_path, filename)
                 
                 try:
-                    # Вставляем запись о фото
-                    cursor.execute("""
-                        INSERT INTO photo_metadata 
-                        (dataset_id, original_filename, file_path, file_size, processing_status)
-                        VALUES (%s, %s, %s, %s, %s)
-                        ON CONFLICT (file_path) DO NOTHING
-                    """, (
+                    rows.append((
                         dataset_id,
                         filename,
                         file_path,
                         os.path.getsize(file_path),
+                        None,
+                        None,
+                        None,
                         'pending'
                     ))
                     
-                    if cursor.rowcount > 0:
-                        photo_count += 1
-                    
-                    if photo_count % 100 == 0:
-                        print(f"  ⏳ Обработано {photo_count} фото...")
-                        conn.commit()
+                    if len(rows) % 1000 == 0:
+                        print(f"  ⏳ Обработано {len(rows)} фото...")
                         
                 except Exception as e:
                     print(f"  ⚠️ Ошибка обработки файла {filename}: {e}")
                     continue
         
+        # Добавляем только новые фото
+        photo_count = load_photos(cursor, rows, update_existing=False)
         conn.commit()
         print(f"  ✅ Добавлено {photo_count} фото в датасет '{dataset_name}'")
         
@@ -267,5 +257,65 @@ def import_photos_from_folder(cursor, conn, folder_path):
         print(f"❌ Ошибка импорта из папки {folder_path}: {e}")
         raise
 
+def load_photos(cursor, rows, update_existing):
+    """
+    Загрузка записей о фото одним оператором INSERT ... SELECT через временную таблицу.
+    
+    Счетчики датасетов обновляются триггером уровня оператора, поэтому пакетная
+    вставка обновляет строку датасета один раз, а не на каждое фото.
+    Возвращает число вставленных (и обновленных, если update_existing) записей.
+    """
+    if not rows:
+        return 0
+    
+    cursor.execute("""
+        CREATE TEMP TABLE photo_import_staging (
+            row_number SERIAL,
+            dataset_id INTEGER,
+            original_filename VARCHAR(500),
+            file_path VARCHAR(1000),
+            file_size BIGINT,
+            gps_latitude DECIMAL(10, 8),
+            gps_longitude DECIMAL(11, 8),
+            camera_id VARCHAR(100),
+            processing_status VARCHAR(20)
+        ) ON COMMIT DROP
+    """)
+    
+    # COPY вместо построчных INSERT; пустое поле CSV = NULL
+    buffer = io.StringIO()
+    csv.writer(buffer).writerows(rows)
+    buffer.seek(0)
+    cursor.copy_expert("""
+        COPY photo_import_staging
+        (dataset_id, original_filename, file_path, file_size,
+         gps_latitude, gps_longitude, camera_id, processing_status)
+        FROM STDIN WITH (FORMAT csv)
+    """, buffer)
+    
+    # Повторы одного файла в источнике: побеждает последняя запись (как при построчном импорте)
+    on_conflict = """
+        ON CONFLICT (file_path) DO UPDATE SET
+        gps_latitude = EXCLUDED.gps_latitude,
+        gps_longitude = EXCLUDED.gps_longitude,
+        camera_id = EXCLUDED.camera_id,
+        updated_at = CURRENT_TIMESTAMP
+    """ if update_existing else "ON CONFLICT (file_path) DO NOTHING"
+    cursor.execute(f"""
+        INSERT INTO photo_metadata 
+        (dataset_id, original_filename, file_path, file_size, 
+         gps_latitude, gps_longitude, camera_id, processing_status)
+        SELECT DISTINCT ON (file_path)
+               dataset_id, original_filename, file_path, file_size,
+               gps_latitude, gps_longitude, camera_id, processing_status
+        FROM photo_import_staging
+        ORDER BY file_path, row_number DESC
+        {on_conflict}
+    """)
+    loaded = cursor.rowcount
+    
+    cursor.execute("DROP TABLE photo_import_staging")
+    return loaded
+
 if __name__ == "__main__":
     import_existing_data()
\ No newline at end of file
@@ -5,6 +5,21 @@
 -- Создаем расширение для генерации UUID
 CREATE EXTENSION IF NOT EXISTS "uuid-ossp";
 
+-- Координаты -> точка в проекции Меркатора (x = долгота, y = ордината, радианы).
+-- Используется в пространственном индексе GiST по geocoding_results (PostGIS в образе
+-- postgres:13 недоступен, индекс строится по встроенному типу point):
+--   - проекция монотонна по каждой оси: окно карты переходит в прямоугольник (<@ box);
+--   - проекция конформна: в окрестности точки евклидово расстояние пропорционально
+--     расстоянию на местности (множитель cos(широты)), поэтому сортировка по <-> дает
+--     ближайших соседей (KNN-обход индекса).
+CREATE OR REPLACE FUNCTION geo_mercator_point(latitude NUMERIC, longitude NUMERIC)
+RETURNS POINT AS $$
+    SELECT point(
+        radians(longitude::float8),
+        ln(tan(pi() / 4 + radians(least(greatest(latitude::float8, -85.0511), 85.0511)) / 2))
+    )
+$$ LANGUAGE sql IMMUTABLE STRICT PARALLEL SAFE;
+
 -- =============================================
 -- ТАБЛИЦА: users (Пользователи системы)
 -- =============================================
@@ -80,6 +95,9 @@ CREATE TABLE IF NOT EXISTS photo_metadata (
     gps_altitude DECIMAL(8, 2),
     gps_dop DECIMAL(5, 2),
     
+    -- Источник снимка (колонка camera из Excel-импорта)
+    camera_id VARCHAR(100),
+    
     -- Статус обработки
     processing_status VARCHAR(20) DEFAULT 'pending',
     processing_stage VARCHAR(50) DEFAULT 'uploaded',
@@ -166,9 +184,13 @@ CREATE TABLE IF NOT EXISTS geocoding_results (
 -- =============================================
 -- ТАБЛИЦА: processing_history (История обработки)
 -- =============================================
+-- Журнал только дополняется и растет быстрее остальных таблиц, поэтому секционирован
+-- по месяцам processed_at: вставка и запросы за недавний период работают с небольшими
+-- секциями, а старая история удаляется целыми секциями (см. функции ниже).
+-- Первичный и уникальный ключи секционированной таблицы включают ключ секционирования.
 CREATE TABLE IF NOT EXISTS processing_history (
-    id SERIAL PRIMARY KEY,
-    history_uuid UUID DEFAULT uuid_generate_v4() UNIQUE,
+    id BIGSERIAL,
+    history_uuid UUID DEFAULT uuid_generate_v4(),
     photo_id INTEGER REFERENCES photo_metadata(id) ON DELETE CASCADE,
     detection_id INTEGER REFERENCES detection_results(id) ON DELETE SET NULL,
     
@@ -183,8 +205,15 @@ CREATE TABLE IF NOT EXISTS processing_history (
     processing_time_ms INTEGER,
     resource_usage JSONB,
     
-    processed_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
-);
+    processed_at TIMESTAMP WITH TIME ZONE NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    
+    PRIMARY KEY (id, processed_at),
+    CONSTRAINT unique_processing_history_uuid UNIQUE (history_uuid, processed_at)
+) PARTITION BY RANGE (processed_at);
+
+-- Секция для строк вне созданных месячных секций: вставка не падает, даже если
+-- обслуживание секций давно не запускалось
+CREATE TABLE IF NOT EXISTS processing_history_default PARTITION OF processing_history DEFAULT;
 
 -- =============================================
 -- ТАБЛИЦА: exports (Экспорты данных)
@@ -198,6 +227,8 @@ CREATE TABLE IF NOT EXISTS exports (
     export_format VARCHAR(20) DEFAULT 'xlsx',
     file_path VARCHAR(1000),
     file_size BIGINT,
+    -- SHA-256 файла экспорта (ETag при скачивании)
+    content_hash VARCHAR(64),
     
     -- Параметры экспорта
     filters_applied JSONB,
@@ -208,10 +239,23 @@ CREATE TABLE IF NOT EXISTS exports (
     total_records INTEGER DEFAULT 0,
     exported_records INTEGER DEFAULT 0,
     
+    -- Инкрементальный экспорт: нижняя граница (since) и водяной знак снимка данных экспорта
+    since_watermark TIMESTAMP WITH TIME ZONE,
+    watermark TIMESTAMP WITH TIME ZONE,
+    -- Число снимков по датасетам выборки в снимке данных экспорта (md5, см. DATA_VERSION_SQL)
+    data_version VARCHAR(64),
+    
+    -- queued -> processing -> completed | failed; completed -> expired (файл вытеснен из кэша)
     status VARCHAR(20) DEFAULT 'processing',
+    error_message TEXT,
+    -- SHA-256 канонического запроса: одинаковые незавершенные экспорты объединяются
+    request_hash VARCHAR(64),
     
     created_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP,
-    completed_at TIMESTAMP WITH TIME ZONE
+    started_at TIMESTAMP WITH TIME ZONE,
+    completed_at TIMESTAMP WITH TIME ZONE,
+    -- Последнее скачивание или повторное использование (LRU-вытеснение файлов экспорта)
+    last_accessed_at TIMESTAMP WITH TIME ZONE
 );
 
 -- =============================================
@@ -226,6 +270,22 @@ CREATE TABLE IF NOT EXISTS export_photos (
     CONSTRAINT unique_export_photo UNIQUE (export_id, photo_id)
 );
 
+-- =============================================
+-- ТАБЛИЦА: dataset_photo_stats (Статистика по датасетам)
+-- =============================================
+-- Поддерживается инкрементально триггерами photo_metadata (update_dataset_photo_count):
+-- чтение статистики не зависит от числа фото
+CREATE TABLE IF NOT EXISTS dataset_photo_stats (
+    dataset_id INTEGER PRIMARY KEY REFERENCES datasets(id) ON DELETE CASCADE,
+    total_photos INTEGER NOT NULL DEFAULT 0,
+    pending_photos INTEGER NOT NULL DEFAULT 0,
+    processing_photos INTEGER NOT NULL DEFAULT 0,
+    completed_photos INTEGER NOT NULL DEFAULT 0,
+    failed_photos INTEGER NOT NULL DEFAULT 0,
+    photos_with_coords INTEGER NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP WITH TIME ZONE DEFAULT CURRENT_TIMESTAMP
+);
+
 -- =============================================
 -- ИНДЕКСЫ ДЛЯ ПРОИЗВОДИТЕЛЬНОСТИ
 -- =============================================
@@ -236,7 +296,10 @@ CREATE INDEX IF NOT EXISTS idx_photo_metadata_status ON photo_metadata(processin
 CREATE INDEX IF NOT EXISTS idx_photo_metadata_dataset ON photo_metadata(dataset_id);
 CREATE INDEX IF NOT EXISTS idx_photo_metadata_taken_at ON photo_metadata(taken_at);
 CREATE INDEX IF NOT EXISTS idx_photo_metadata_created_at ON photo_metadata(created_at);
+-- Инкрементальный экспорт: снимки, измененные после водяного знака
+CREATE INDEX IF NOT EXISTS idx_photo_metadata_updated_at ON photo_metadata(updated_at);
 CREATE INDEX IF NOT EXISTS idx_photo_metadata_coords ON photo_metadata(gps_latitude, gps_longitude);
+CREATE INDEX IF NOT EXISTS idx_photo_metadata_camera ON photo_metadata(camera_id);
 
 -- Индексы для detection_results
 CREATE INDEX IF NOT EXISTS idx_detection_results_photo ON detection_results(photo_id);
@@ -246,20 +309,30 @@ CREATE INDEX IF NOT EXISTS idx_detection_results_detected_at ON detection_result
 
 -- Индексы для geocoding_results
 CREATE INDEX IF NOT EXISTS idx_geocoding_results_detection ON geocoding_results(detection_id);
+CREATE INDEX IF NOT EXISTS idx_geocoding_results_updated_at ON geocoding_results(updated_at);
 CREATE INDEX IF NOT EXISTS idx_geocoding_results_city ON geocoding_results(city);
 CREATE INDEX IF NOT EXISTS idx_geocoding_results_country ON geocoding_results(country);
 CREATE INDEX IF NOT EXISTS idx_geocoding_results_coords ON geocoding_results(calculated_latitude, calculated_longitude);
+-- Запросы "в окне карты" и "ближайшие" (см. geo_mercator_point)
+CREATE INDEX IF NOT EXISTS idx_geocoding_results_location
+    ON geocoding_results USING gist (geo_mercator_point(calculated_latitude, calculated_longitude));
 
 -- Индексы для processing_history
+-- (создаются на секционированной таблице и наследуются секциями)
 CREATE INDEX IF NOT EXISTS idx_processing_history_photo ON processing_history(photo_id);
-CREATE INDEX IF NOT EXISTS idx_processing_history_service ON processing_history(service_name);
-CREATE INDEX IF NOT EXISTS idx_processing_history_status ON processing_history(status);
-CREATE INDEX IF NOT EXISTS idx_processing_history_date ON processing_history(processed_at);
+CREATE INDEX IF NOT EXISTS idx_processing_history_service ON processing_history(service_name, processed_at);
+-- Строки пишутся в порядке времени: BRIN по processed_at в сотни раз меньше B-tree
+-- и почти не замедляет вставку
+CREATE INDEX IF NOT EXISTS idx_processing_history_date ON processing_history USING brin (processed_at);
 
 -- Индексы для exports
 CREATE INDEX IF NOT EXISTS idx_exports_user ON exports(user_id);
 CREATE INDEX IF NOT EXISTS idx_exports_status ON exports(status);
 CREATE INDEX IF NOT EXISTS idx_exports_created_at ON exports(created_at);
+-- Не больше одного незавершенного экспорта на запрос (дедупликация через ON CONFLICT)
+CREATE UNIQUE INDEX IF NOT EXISTS idx_exports_in_flight ON exports(request_hash) WHERE status IN ('queued', 'processing');
+-- Повторное использование готового экспорта того же запроса
+CREATE INDEX IF NOT EXISTS idx_exports_completed ON exports(request_hash, completed_at) WHERE status = 'completed';
 
 -- Индексы для users
 CREATE INDEX IF NOT EXISTS idx_users_username ON users(username);
@@ -295,41 +368,253 @@ CREATE TRIGGER update_users_updated_at
     BEFORE UPDATE ON users 
     FOR EACH ROW EXECUTE FUNCTION update_updated_at_column();
 
--- Функция для обновления счетчика фото в датасетах
+-- Функция для обновления счетчиков фото в датасетах (datasets.total_photos и
+-- dataset_photo_stats). Триггеры уровня оператора с таблицами переходов: массовая
+-- вставка или смена статусов (импорт, пакетная запись результатов) обновляет строки
+-- каждого затронутого датасета один раз за оператор, а не на каждое фото.
+-- Изменения агрегируются по dataset_id (новые строки со знаком +1, старые со знаком -1),
+-- датасеты блокируются в порядке id (параллельные загрузки не взаимоблокируются).
 CREATE OR REPLACE FUNCTION update_dataset_photo_count()
 RETURNS TRIGGER AS $$
+DECLARE
+    changed_rows TEXT;
+    dataset_ids INTEGER[];
+    total_deltas INTEGER[];
+    pending_deltas INTEGER[];
+    processing_deltas INTEGER[];
+    completed_deltas INTEGER[];
+    failed_deltas INTEGER[];
+    coords_deltas INTEGER[];
 BEGIN
-    IF TG_OP = 'INSERT' THEN
-        UPDATE datasets 
-        SET total_photos = total_photos + 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = NEW.dataset_id;
-    ELSIF TG_OP = 'DELETE' THEN
-        UPDATE datasets 
-        SET total_photos = total_photos - 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = OLD.dataset_id;
-    ELSIF TG_OP = 'UPDATE' AND OLD.dataset_id IS DISTINCT FROM NEW.dataset_id THEN
-        -- Уменьшаем счетчик у старого датасета
-        UPDATE datasets 
-        SET total_photos = total_photos - 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = OLD.dataset_id;
-        
-        -- Увеличиваем счетчик у нового датасета
-        UPDATE datasets 
-        SET total_photos = total_photos + 1,
-            updated_at = CURRENT_TIMESTAMP
-        WHERE id = NEW.dataset_id;
+    changed_rows := CASE TG_OP
+        WHEN 'INSERT' THEN 'SELECT 1 AS sign, dataset_id, processing_status, gps_latitude FROM new_photos'
+        WHEN 'DELETE' THEN 'SELECT -1 AS sign, dataset_id, processing_status, gps_latitude FROM old_photos'
+        ELSE 'SELECT 1 AS sign, dataset_id, processing_status, gps_latitude FROM new_photos
+              UNION ALL
+              SELECT -1 AS sign, dataset_id, processing_status, gps_latitude FROM old_photos'
+    END;
+
+    EXECUTE format($query$
+        SELECT array_agg(dataset_id ORDER BY dataset_id),
+               array_agg(total ORDER BY dataset_id),
+               array_agg(pending ORDER BY dataset_id),
+               array_agg(processing ORDER BY dataset_id),
+               array_agg(completed ORDER BY dataset_id),
+               array_agg(failed ORDER BY dataset_id),
+               array_agg(with_coords ORDER BY dataset_id)
+        FROM (
+            SELECT dataset_id,
+                   sum(sign) AS total,
+                   sum(sign) FILTER (WHERE processing_status = 'pending') AS pending,
+                   sum(sign) FILTER (WHERE processing_status = 'processing') AS processing,
+                   sum(sign) FILTER (WHERE processing_status = 'completed') AS completed,
+                   sum(sign) FILTER (WHERE processing_status = 'failed') AS failed,
+                   sum(sign) FILTER (WHERE gps_latitude IS NOT NULL) AS with_coords
+            FROM (%s) changed
+            WHERE dataset_id IS NOT NULL
+            GROUP BY dataset_id
+        ) changes
+        -- UPDATE без изменения счетчиков (например, правка адреса) ничего не пишет
+        WHERE total <> 0 OR pending <> 0 OR processing <> 0
+           OR completed <> 0 OR failed <> 0 OR with_coords <> 0
+    $query$, changed_rows)
+    INTO dataset_ids, total_deltas, pending_deltas, processing_deltas,
+         completed_deltas, failed_deltas, coords_deltas;
+
+    IF dataset_ids IS NULL THEN
+        RETURN NULL;
     END IF;
+
+    PERFORM 1 FROM datasets WHERE id = ANY(dataset_ids) ORDER BY id FOR UPDATE;
+
+    UPDATE datasets d
+    SET total_photos = d.total_photos + changes.total,
+        updated_at = CURRENT_TIMESTAMP
+    FROM unnest(dataset_ids, total_deltas) AS changes(dataset_id, total)
+    WHERE d.id = changes.dataset_id AND changes.total <> 0;
+
+    -- Датасет мог быть удален этим же оператором (ON DELETE SET NULL у photo_metadata)
+    INSERT INTO dataset_photo_stats AS stats (
+        dataset_id, total_photos, pending_photos, processing_photos,
+        completed_photos, failed_photos, photos_with_coords
+    )
+    SELECT changes.dataset_id, changes.total, coalesce(changes.pending, 0), coalesce(changes.processing, 0),
+           coalesce(changes.completed, 0), coalesce(changes.failed, 0), coalesce(changes.with_coords, 0)
+    FROM unnest(dataset_ids, total_deltas, pending_deltas, processing_deltas,
+                completed_deltas, failed_deltas, coords_deltas)
+        AS changes(dataset_id, total, pending, processing, completed, failed, with_coords)
+    JOIN datasets d ON d.id = changes.dataset_id
+    ORDER BY changes.dataset_id
+    ON CONFLICT (dataset_id) DO UPDATE SET
+        total_photos = stats.total_photos + EXCLUDED.total_photos,
+        pending_photos = stats.pending_photos + EXCLUDED.pending_photos,
+        processing_photos = stats.processing_photos + EXCLUDED.processing_photos,
+        completed_photos = stats.completed_photos + EXCLUDED.completed_photos,
+        failed_photos = stats.failed_photos + EXCLUDED.failed_photos,
+        photos_with_coords = stats.photos_with_coords + EXCLUDED.photos_with_coords,
+        updated_at = CURRENT_TIMESTAMP;
     RETURN NULL;
 END;
 $$ language 'plpgsql';
 
--- Триггер для обновления счетчика фото
-CREATE TRIGGER update_dataset_photo_count_trigger
-    AFTER INSERT OR DELETE OR UPDATE OF dataset_id ON photo_metadata
-    FOR EACH ROW EXECUTE FUNCTION update_dataset_photo_count();
+-- Триггеры для обновления счетчика фото (таблицы переходов допускают только одно
+-- событие на триггер и не допускают UPDATE OF <столбцы>)
+CREATE TRIGGER update_dataset_photo_count_insert
+    AFTER INSERT ON photo_metadata
+    REFERENCING NEW TABLE AS new_photos
+    FOR EACH STATEMENT EXECUTE FUNCTION update_dataset_photo_count();
+
+CREATE TRIGGER update_dataset_photo_count_delete
+    AFTER DELETE ON photo_metadata
+    REFERENCING OLD TABLE AS old_photos
+    FOR EACH STATEMENT EXECUTE FUNCTION update_dataset_photo_count();
+
+CREATE TRIGGER update_dataset_photo_count_update
+    AFTER UPDATE ON photo_metadata
+    REFERENCING OLD TABLE AS old_photos NEW TABLE AS new_photos
+    FOR EACH STATEMENT EXECUTE FUNCTION update_dataset_photo_count();
+
+-- Сверка счетчиков с фактическими данными photo_metadata (после ручных правок, сбоев,
+-- TRUNCATE — он не вызывает триггеры). Пересчитывает datasets.total_photos и
+-- dataset_photo_stats, возвращает исправленные счетчики:
+--   SELECT * FROM reconcile_dataset_photo_counts();
+CREATE OR REPLACE FUNCTION reconcile_dataset_photo_counts()
+RETURNS TABLE (dataset_id INTEGER, counter TEXT, stored_value INTEGER, actual_value INTEGER) AS $$
+    WITH actual AS (
+        SELECT d.id AS dataset_id,
+               count(pm.id)::integer AS total_photos,
+               count(*) FILTER (WHERE pm.processing_status = 'pending')::integer AS pending_photos,
+               count(*) FILTER (WHERE pm.processing_status = 'processing')::integer AS processing_photos,
+               count(*) FILTER (WHERE pm.processing_status = 'completed')::integer AS completed_photos,
+               count(*) FILTER (WHERE pm.processing_status = 'failed')::integer AS failed_photos,
+               count(*) FILTER (WHERE pm.gps_latitude IS NOT NULL)::integer AS photos_with_coords
+        FROM datasets d
+        LEFT JOIN photo_metadata pm ON pm.dataset_id = d.id
+        GROUP BY d.id
+    ), drift AS (
+        SELECT a.dataset_id, c.counter, c.stored_value, c.actual_value
+        FROM actual a
+        JOIN datasets d ON d.id = a.dataset_id
+        LEFT JOIN dataset_photo_stats s ON s.dataset_id = a.dataset_id
+        CROSS JOIN LATERAL (VALUES
+            ('datasets.total_photos', d.total_photos, a.total_photos),
+            ('total_photos', COALESCE(s.total_photos, 0), a.total_photos),
+            ('pending_photos', COALESCE(s.pending_photos, 0), a.pending_photos),
+            ('processing_photos', COALESCE(s.processing_photos, 0), a.processing_photos),
+            ('completed_photos', COALESCE(s.completed_photos, 0), a.completed_photos),
+            ('failed_photos', COALESCE(s.failed_photos, 0), a.failed_photos),
+            ('photos_with_coords', COALESCE(s.photos_with_coords, 0), a.photos_with_coords)
+        ) AS c(counter, stored_value, actual_value)
+        WHERE c.stored_value IS DISTINCT FROM c.actual_value
+    ), fixed_datasets AS (
+        UPDATE datasets d
+        SET total_photos = a.total_photos,
+            updated_at = CURRENT_TIMESTAMP
+        FROM actual a
+        WHERE d.id = a.dataset_id AND d.total_photos IS DISTINCT FROM a.total_photos
+    ), fixed_stats AS (
+        INSERT INTO dataset_photo_stats AS stats (
+            dataset_id, total_photos, pending_photos, processing_photos,
+            completed_photos, failed_photos, photos_with_coords
+        )
+        SELECT a.dataset_id, a.total_photos, a.pending_photos, a.processing_photos,
+               a.completed_photos, a.failed_photos, a.photos_with_coords
+        FROM actual a
+        WHERE a.dataset_id IN (SELECT drift.dataset_id FROM drift)
+        ON CONFLICT (dataset_id) DO UPDATE SET
+            total_photos = EXCLUDED.total_photos,
+            pending_photos = EXCLUDED.pending_photos,
+            processing_photos = EXCLUDED.processing_photos,
+            completed_photos = EXCLUDED.completed_photos,
+            failed_photos = EXCLUDED.failed_photos,
+            photos_with_coords = EXCLUDED.photos_with_coords,
+            updated_at = CURRENT_TIMESTAMP
+    )
+    SELECT dataset_id, counter, stored_value, actual_value
+    FROM drift
+    ORDER BY dataset_id, counter
+$$ LANGUAGE sql;
+
+-- Месячные секции processing_history: создание будущих секций (текущий месяц и
+-- months_ahead следующих). Строки, уже попавшие в секцию по умолчанию, переносятся
+-- в новую секцию. Возвращает имена созданных секций.
+CREATE OR REPLACE FUNCTION create_processing_history_partitions(months_ahead INTEGER DEFAULT 3)
+RETURNS SETOF TEXT AS $$
+DECLARE
+    month_start TIMESTAMP WITH TIME ZONE;
+    month_end TIMESTAMP WITH TIME ZONE;
+    partition_name TEXT;
+BEGIN
+    FOR i IN 0..months_ahead LOOP
+        month_start := (date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => i)) AT TIME ZONE 'UTC';
+        month_end := (date_trunc('month', now() AT TIME ZONE 'UTC') + make_interval(months => i + 1)) AT TIME ZONE 'UTC';
+        partition_name := 'processing_history_' || to_char(month_start AT TIME ZONE 'UTC', 'YYYY_MM');
+        
+        CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+        
+        -- Вставки ждут до конца транзакции: иначе строки месяца, попавшие в секцию по
+        -- умолчанию после проверки, сорвут ATTACH / CREATE ... PARTITION OF. Блокируется
+        -- родитель (вместе с секциями): вставка блокирует его первым, поэтому взаимной
+        -- блокировки с ACCESS EXCLUSIVE на родителе при создании секции нет.
+        LOCK TABLE processing_history IN SHARE ROW EXCLUSIVE MODE;
+        -- Секцию мог создать параллельный запуск, пока ждали блокировку
+        CONTINUE WHEN to_regclass(partition_name) IS NOT NULL;
+        
+        IF EXISTS (
+            SELECT 1 FROM processing_history_default
+            WHERE processed_at >= month_start AND processed_at < month_end
+        ) THEN
+            EXECUTE format('CREATE TABLE %I (LIKE processing_history INCLUDING DEFAULTS)', partition_name);
+            EXECUTE format(
+                'WITH moved AS (DELETE FROM processing_history_default
+                                WHERE processed_at >= %L AND processed_at < %L RETURNING *)
+                 INSERT INTO %I SELECT * FROM moved',
+                month_start, month_end, partition_name
+            );
+            EXECUTE format(
+                'ALTER TABLE processing_history ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+        ELSE
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF processing_history FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, month_end
+            );
+        END IF;
+        RETURN NEXT partition_name;
+    END LOOP;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Хранение истории: удаляет месячные секции, целиком старше retention (DROP секции
+-- вместо DELETE строк: без нагрузки на WAL и без вакуума), и старые строки секции
+-- по умолчанию. Возвращает имена удаленных секций.
+CREATE OR REPLACE FUNCTION drop_processing_history_partitions(retention INTERVAL DEFAULT '12 months')
+RETURNS SETOF TEXT AS $$
+DECLARE
+    cutoff TIMESTAMP WITH TIME ZONE := now() - retention;
+    partition_name TEXT;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'processing_history'::regclass
+          AND c.relname ~ '^processing_history_[0-9]{4}_[0-9]{2}$'
+        ORDER BY c.relname
+    LOOP
+        -- Верхняя граница секции — начало следующего месяца
+        CONTINUE WHEN (to_date(right(partition_name, 7), 'YYYY_MM') + interval '1 month') AT TIME ZONE 'UTC' > cutoff;
+        EXECUTE format('DROP TABLE %I', partition_name);
+        RETURN NEXT partition_name;
+    END LOOP;
+    
+    DELETE FROM processing_history_default WHERE processed_at < cutoff;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Секции на ближайшие месяцы (далее — сервис db-maintenance / make partitions)
+SELECT create_processing_history_partitions();
 
 -- =============================================
 -- ТЕСТОВЫЕ ДАННЫЕ
@@ -369,24 +654,31 @@ SELECT
     gr.calculated_longitude as building_lng,
     gr.formatted_address,
     gr.city,
-    gr.country
+    gr.country,
+    -- Ключи и путь к файлу для export-service (новые колонки только в конце:
+    -- CREATE OR REPLACE VIEW не меняет порядок существующих)
+    pm.id as photo_id,
+    pm.dataset_id,
+    pm.file_path,
+    pm.updated_at,
+    dr.id as detection_id
 FROM photo_metadata pm
 LEFT JOIN detection_results dr ON pm.id = dr.photo_id
 LEFT JOIN geocoding_results gr ON dr.id = gr.detection_id;
 
--- Представление для статистики по датасетам
+-- Представление для статистики по датасетам (читает dataset_photo_stats,
+-- без агрегации по photo_metadata)
 CREATE OR REPLACE VIEW dataset_stats_view AS
 SELECT 
     d.name as dataset_name,
     d.source_type,
     d.total_photos,
     d.processed_photos,
-    COUNT(pm.id) as actual_photos,
-    COUNT(CASE WHEN pm.processing_status = 'completed' THEN 1 END) as completed_photos,
-    COUNT(CASE WHEN pm.gps_latitude IS NOT NULL THEN 1 END) as photos_with_coords
+    COALESCE(s.total_photos, 0)::bigint as actual_photos,
+    COALESCE(s.completed_photos, 0)::bigint as completed_photos,
+    COALESCE(s.photos_with_coords, 0)::bigint as photos_with_coords
 FROM datasets d
-LEFT JOIN photo_metadata pm ON d.id = pm.dataset_id
-GROUP BY d.id, d.name, d.source_type, d.total_photos, d.processed_photos;
+LEFT JOIN dataset_photo_stats s ON s.dataset_id = d.id;
 
 -- =============================================
 -- КОММЕНТАРИИ К ТАБЛИЦАМ
@@ -397,9 +689,10 @@ COMMENT ON TABLE datasets IS 'Датасеты для организации ф
 COMMENT ON TABLE photo_metadata IS 'Метаданные загруженных фотографий';
 COMMENT ON TABLE detection_results IS 'Результаты детекции объектов на фотографиях';
 COMMENT ON TABLE geocoding_results IS 'Геокодированные результаты с адресами';
-COMMENT ON TABLE processing_history IS 'История обработки фотографий';
+COMMENT ON TABLE processing_history IS 'История обработки фотографий (секции по месяцам processed_at)';
 COMMENT ON TABLE exports IS 'Экспорты данных';
 COMMENT ON TABLE export_photos IS 'Связь фото с экспортами';
+COMMENT ON TABLE dataset_photo_stats IS 'Статистика по датасетам (поддерживается триггерами photo_metadata)';
 
 COMMENT ON COLUMN photo_metadata.processing_status IS 'Статусы: pending, processing, completed, failed, partial';
 COMMENT ON COLUMN photo_metadata.processing_stage IS 'Этапы: uploaded, metadata_extracted, buildings_detected, geocoded, exported';